@@ -11,15 +11,30 @@ import pandas as pd
 import json
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Добавляем путь к плагинам
 sys.path.insert(0, '/opt/airflow/plugins')
 
 # Импортируем плагины напрямую
 from extractors.postgres_extractor import PostgresExtractor
+from extractors.extract_spec import ExtractSpec
 from extractors.mongo_extractor import MongoExtractor
 from loaders.scd_type2_handler import SCDType2Handler
-from extractors.csv_extractor import CSVExtractor
+from loaders.watermark_store import WatermarkStore
+from loaders.postgres_copy_loader import PostgresCopyLoader
+from loaders.surrogate_key_lookup import KeyLookupCache
+from loaders.calendar_dimensions import CalendarDimensions
+from loaders.partial_aggregates import PartialAggregateStore
+from loaders.aggregate_refresher import AggregateRefresher
+from loaders.partition_manager import PartitionManager, PARTITIONED_FACTS, month_start, add_months
+from extractors.csv_extractor import CSVExtractor, PRODUCT_FEED_DTYPES, PRODUCT_FEED_DATE_COLUMNS
+from storage.artifact_store import ArtifactStore, read_artifact, iter_artifact
+from transformers.column_coercer import ColumnCoercer
+from monitoring.stage_metrics import (
+    instrumented_task, track_stage, in_current_stages, write_stage_metrics, METRICS_XCOM_KEY
+)
+from transformers.daily_metrics import metrics_from_partials, upsert_daily_metrics, DailyMetricsAggregator
 
 print("✅ Все плагины загружены для final_etl_working")
 
@@ -43,81 +58,152 @@ dag = DAG(
     tags=['etl', 'dwh', 'scd_type2', 'diploma', 'final', 'working'],
 )
 
+# Инкрементальные источники: колонка watermark и БД, где watermark
+# фиксируется в одной транзакции с загрузкой данных источника
+INCREMENTAL_SOURCES = {
+    'customers': {'column': 'updated_at', 'conn_id': 'postgres_dwh'},
+    'products': {'column': 'updated_at', 'conn_id': 'postgres_dwh'},
+    'orders': {'column': 'created_at', 'conn_id': 'postgres_analytics'},
+    'order_items': {'column': 'created_at', 'conn_id': 'postgres_dwh'},
+}
+
+# Перекрытие окна на случай строк из транзакций, зафиксированных после
+# чтения с более ранним updated_at (повторно прочитанные строки отсеиваются
+# по хэшу в SCD и идемпотентным upsert в аналитике)
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# Поля отзывов, которые используются при трансформации и загрузке fact_feedback
+FEEDBACK_PROJECTION = ['feedback_id', 'customer_id', 'product_id', 'rating',
+                       'comment', 'feedback', 'feedback_date']
+
+# Колонки fact_orders, заполняемые из строк заказов
+FACT_ORDERS_COLUMNS = ['customer_key', 'product_key', 'date_key', 'time_key', 'status_key',
+                       'order_id', 'customer_id', 'product_id', 'order_status', 'payment_method',
+                       'shipping_city', 'quantity', 'unit_price', 'total_amount', 'cost_amount',
+                       'profit_amount']
+
+# Колонки csv_products, загружаемые из CSV (типы и ширины берутся из таблицы)
+CSV_PRODUCTS_LOAD_COLUMNS = ['product_id', 'product_name', 'category', 'subcategory', 'unit_price',
+                             'stock_quantity', 'supplier', 'country_of_origin', 'weight_kg', 'dimensions']
+
 # ========== ФУНКЦИИ ETL ==========
 
+def incremental_spec(source_name):
+    """Спецификация извлечения строк, изменившихся после последней успешной загрузки"""
+    source = INCREMENTAL_SOURCES[source_name]
+    watermark = WatermarkStore(conn_id=source['conn_id']).get(source_name)
+    if watermark is None:
+        print(f"   {source_name}: watermark отсутствует, полная загрузка")
+        return ExtractSpec(source_name)
+    
+    since = watermark - WATERMARK_OVERLAP
+    print(f"   {source_name}: изменения с {since}")
+    return ExtractSpec(source_name, incremental_column=source['column'], incremental_value=since)
+
+def pending_watermark(source_name, max_value, rows):
+    """Новый watermark источника для фиксации задачей загрузки"""
+    if rows == 0 or max_value is None or pd.isna(max_value):
+        return None
+    return {
+        'column': INCREMENTAL_SOURCES[source_name]['column'],
+        'value': pd.Timestamp(max_value).isoformat(),
+        'rows': int(rows),
+    }
+
+
+def extract_postgres_source(store, source_name):
+    """Инкрементальное извлечение таблицы PostgreSQL потоком порций в артефакт"""
+    column = INCREMENTAL_SOURCES[source_name]['column']
+    
+    partition_column = EXTRACT_SOURCES[source_name].get('partition_column')
+    spec = incremental_spec(source_name)
+    
+    # У каждого источника свое соединение - потоки не делят курсоры
+    with PostgresExtractor(conn_id='postgres_source') as extractor:
+        extractor.explain(spec)
+        if partition_column:
+            # Крупные таблицы читаются диапазонами ключа на нескольких соединениях
+            chunks = extractor.extract_table_partitioned(spec, partition_column)
+        else:
+            chunks = extractor.extract_table_chunks(spec)
+        ref = store.write_chunks(source_name, chunks)
+    
+    # Новый watermark фиксируется задачей загрузки вместе с данными
+    max_value = read_artifact(ref, columns=[column])[column].max() if ref['rows'] else None
+    return ref, pending_watermark(source_name, max_value, ref['rows'])
+
+def extract_mongo_feedback(store, source_name):
+    """
+    Отзывы читаются порциями курсора сразу в артефакт (только проекция нужных полей)
+
+    Отзывы загружаются в DWH как полный снимок (merge удаляет отсутствующие
+    ключи), поэтому тестовые данные вместо недоступной MongoDB недопустимы -
+    ошибка подключения завершает извлечение с ошибкой.
+    """
+    mongo_extractor = MongoExtractor(conn_id='mongodb_source')
+    ref = store.write_chunks(source_name, mongo_extractor.extract_collection_batches(
+        'customer_feedback',
+        database='source_mongo_db',
+        projection=FEEDBACK_PROJECTION,
+        fallback_to_test_data=False
+    ))
+    return ref, None
+
+# Реестр извлекаемых источников: ключ XCom ссылки на артефакт, функция извлечения
+# и (для крупных таблиц) колонка секционирования параллельного чтения
+EXTRACT_SOURCES = {
+    'customers': {'xcom_key': 'customers_df', 'extract': extract_postgres_source},
+    'products': {'xcom_key': 'products_df', 'extract': extract_postgres_source},
+    'orders': {'xcom_key': 'orders_df', 'extract': extract_postgres_source, 'partition_column': 'order_id'},
+    'order_items': {'xcom_key': 'order_items_df', 'extract': extract_postgres_source,
+                    'partition_column': 'order_item_id'},
+    'feedback': {'xcom_key': 'feedback_df', 'extract': extract_mongo_feedback},
+}
+
+
+@instrumented_task
 def extract_with_plugins(**kwargs):
-    """Извлечение данных с плагинами"""
+    """Извлечение данных с плагинами (источники извлекаются параллельно)"""
     print("=" * 60)
     print("📥 ИЗВЛЕЧЕНИЕ С ПЛАГИНАМИ")
     print("=" * 60)
     
     ti = kwargs.get('ti')
-    execution_date = kwargs.get('execution_date', datetime.now())
     
     try:
-        # 1. Извлекаем из PostgreSQL
-        print("\n1. Извлечение из PostgreSQL:")
-        with PostgresExtractor(conn_id='postgres_source') as extractor:
-            print(f"   Экстрактор создан: {extractor}")
-            
-            # Извлекаем данные
-            customers_df = extractor.extract_table('customers', where_clause='1=1 LIMIT 10')
-            products_df = extractor.extract_table('products', where_clause='1=1 LIMIT 10')
-            
-            # Заказы за последние 7 дней
-            start_date = (execution_date - timedelta(days=7)).strftime('%Y-%m-%d')
-            orders_df = extractor.extract_table(
-                'orders', 
-                where_clause=f"order_date >= '{start_date}' LIMIT 10"
-            )
-        
-        print(f"   ✅ Клиенты: {len(customers_df)} записей")
-        print(f"   ✅ Продукты: {len(products_df)} записей")
-        print(f"   ✅ Заказы: {len(orders_df)} записей")
-        
-        if len(customers_df) > 0:
-            print(f"   Пример клиентов:\n{customers_df.head(2).to_string()}")
-        
-        # 2. Извлекаем из MongoDB
-        print("\n2. Извлечение из MongoDB:")
-        mongo_extractor = MongoExtractor(conn_id='mongodb_source')
-        
-        feedback_data = mongo_extractor.extract_collection(
-            'customer_feedback', 
-            database='source_mongo_db',
-            limit=10
-        )
-        feedback_df = pd.DataFrame(feedback_data) if feedback_data else pd.DataFrame()
-        print(f"   ✅ Отзывы: {len(feedback_df)} документов")
-        
-        if not feedback_df.empty:
-            print(f"   Колонки отзывов: {list(feedback_df.columns)}")
-            print(f"   Пример отзывов:\n{feedback_df.head(2).to_string()}")
-        
-        # Сохраняем данные в XCom
-        print("\n💾 Сохранение данных в XCom...")
+        store = ArtifactStore.from_context(kwargs)
+        store.purge_expired()
+        
+        # Источники независимы и ждут сетевой I/O - время извлечения
+        # определяется самым медленным источником, а не суммой
+        print(f"\nПараллельное извлечение источников: {list(EXTRACT_SOURCES)}")
+        refs = {}
+        pending_watermarks = {}
+        with ThreadPoolExecutor(max_workers=len(EXTRACT_SOURCES), thread_name_prefix='extract') as executor:
+            futures = {
+                executor.submit(in_current_stages(source['extract']), store, source_name): source_name
+                for source_name, source in EXTRACT_SOURCES.items()
+            }
+            for future in as_completed(futures):
+                source_name = futures[future]
+                refs[source_name], mark = future.result()
+                if source_name in INCREMENTAL_SOURCES:
+                    pending_watermarks[source_name] = mark
+                print(f"   ✅ {source_name}: {refs[source_name]['rows']} записей")
+        
+        # В XCom передаются только ссылки на артефакты
+        print("\n💾 Ссылки на артефакты:")
         if ti:
-            # Используем orient='split' для сохранения структуры DataFrame
-            ti.xcom_push(key='customers_df', value=customers_df.to_json(orient='split', date_format='iso'))
-            ti.xcom_push(key='products_df', value=products_df.to_json(orient='split', date_format='iso'))
-            ti.xcom_push(key='orders_df', value=orders_df.to_json(orient='split', date_format='iso'))
-            ti.xcom_push(key='feedback_df', value=feedback_df.to_json(orient='split', date_format='iso'))
-            
-            print(f"   Сохранено в XCom:")
-            print(f"   - customers_df: {len(customers_df)} записей")
-            print(f"   - products_df: {len(products_df)} записей")
-            print(f"   - orders_df: {len(orders_df)} записей")
-            print(f"   - feedback_df: {len(feedback_df)} записей")
+            ti.xcom_push(key='pending_watermarks', value=pending_watermarks)
+            for source_name, source in EXTRACT_SOURCES.items():
+                ti.xcom_push(key=source['xcom_key'], value=refs[source_name])
+                print(f"   - {source['xcom_key']}: {refs[source_name]['rows']} записей")
         
         print(f"\n✅ Извлечение с плагинами завершено!")
         
-        return {
-            'status': 'success',
-            'customers': len(customers_df),
-            'products': len(products_df),
-            'orders': len(orders_df),
-            'feedback': len(feedback_df)
-        }
+        result = {'status': 'success'}
+        result.update({source_name: ref['rows'] for source_name, ref in refs.items()})
+        return result
         
     except Exception as e:
         print(f"❌ Ошибка извлечения: {e}")
@@ -125,6 +211,7 @@ def extract_with_plugins(**kwargs):
         traceback.print_exc()
         return {'status': 'error', 'error': str(e)}
 
+@instrumented_task
 def transform_data(**kwargs):
     """Трансформация данных"""
     print("=" * 60)
@@ -134,24 +221,19 @@ def transform_data(**kwargs):
     ti = kwargs.get('ti')
     
     try:
-        # Получаем данные из XCom
-        print("🔍 Получение данных из XCom...")
-        
-        customers_json = ti.xcom_pull(task_ids='extract_with_plugins', key='customers_df')
-        products_json = ti.xcom_pull(task_ids='extract_with_plugins', key='products_df')
-        orders_json = ti.xcom_pull(task_ids='extract_with_plugins', key='orders_df')
-        feedback_json = ti.xcom_pull(task_ids='extract_with_plugins', key='feedback_df')
+        # Получаем ссылки на артефакты из XCom
+        print("🔍 Получение артефактов из XCom...")
         
-        print(f"   Длина customers_json: {len(customers_json) if customers_json else 0} chars")
-        print(f"   Длина products_json: {len(products_json) if products_json else 0} chars")
-        print(f"   Длина orders_json: {len(orders_json) if orders_json else 0} chars")
-        print(f"   Длина feedback_json: {len(feedback_json) if feedback_json else 0} chars")
+        customers_ref = ti.xcom_pull(task_ids='extract_with_plugins', key='customers_df')
+        products_ref = ti.xcom_pull(task_ids='extract_with_plugins', key='products_df')
+        orders_ref = ti.xcom_pull(task_ids='extract_with_plugins', key='orders_df')
+        feedback_ref = ti.xcom_pull(task_ids='extract_with_plugins', key='feedback_df')
         
-        # Конвертируем в DataFrame
-        customers_df = pd.read_json(customers_json, orient='split') if customers_json else pd.DataFrame()
-        products_df = pd.read_json(products_json, orient='split') if products_json else pd.DataFrame()
-        orders_df = pd.read_json(orders_json, orient='split') if orders_json else pd.DataFrame()
-        feedback_df = pd.read_json(feedback_json, orient='split') if feedback_json else pd.DataFrame()
+        # Читаем артефакты в DataFrame
+        customers_df = read_artifact(customers_ref)
+        products_df = read_artifact(products_ref)
+        orders_df = read_artifact(orders_ref)
+        feedback_df = read_artifact(feedback_ref)
         
         print(f"📥 Получено для трансформации:")
         print(f"   Клиенты: {len(customers_df)} записей")
@@ -187,13 +269,14 @@ def transform_data(**kwargs):
             print(f"✅ Заказы трансформированы")
         
         # Сохраняем трансформированные данные
-        print("\n💾 Сохранение трансформированных данных в XCom...")
+        print("\n💾 Сохранение трансформированных данных в артефакты...")
         if ti:
-            ti.xcom_push(key='transformed_customers', value=customers_df.to_json(orient='split', date_format='iso'))
-            ti.xcom_push(key='transformed_products', value=products_df.to_json(orient='split', date_format='iso'))
-            ti.xcom_push(key='transformed_orders', value=orders_df.to_json(orient='split', date_format='iso'))
-            ti.xcom_push(key='transformed_feedback', value=feedback_df.to_json(orient='split', date_format='iso'))
-            print("✅ Данные сохранены в XCom")
+            store = ArtifactStore.from_context(kwargs)
+            ti.xcom_push(key='transformed_customers', value=store.write('transformed_customers', customers_df))
+            ti.xcom_push(key='transformed_products', value=store.write('transformed_products', products_df))
+            ti.xcom_push(key='transformed_orders', value=store.write('transformed_orders', orders_df))
+            ti.xcom_push(key='transformed_feedback', value=store.write('transformed_feedback', feedback_df))
+            print("✅ Данные сохранены в артефакты")
         
         print(f"\n✅ Трансформация завершена!")
         print(f"📊 Трансформировано таблиц: {len(transformations)}")
@@ -210,6 +293,7 @@ def transform_data(**kwargs):
         traceback.print_exc()
         return {'status': 'error', 'error': str(e)}
 
+@instrumented_task
 def load_to_dwh_scd_type2(**kwargs):
     """Загрузка в DWH с SCD Type 2"""
     print("=" * 60)
@@ -221,38 +305,329 @@ def load_to_dwh_scd_type2(**kwargs):
     
     try:
         # Получаем трансформированные данные
-        customers_json = ti.xcom_pull(task_ids='transform_data', key='transformed_customers')
+        customers_ref = ti.xcom_pull(task_ids='transform_data', key='transformed_customers')
+        products_ref = ti.xcom_pull(task_ids='transform_data', key='transformed_products')
         
-        if not customers_json:
-            print("⚠ Нет данных о клиентах для загрузки в DWH")
+        if not customers_ref and not products_ref:
+            print("⚠ Нет данных об измерениях для загрузки в DWH")
             return {'status': 'no_data'}
         
-        customers_df = pd.read_json(customers_json, orient='split')
+        dimensions = {
+            'dim_customers': read_artifact(customers_ref),
+            'dim_products': read_artifact(products_ref),
+        }
         
-        print(f"🔄 Обработка {len(customers_df)} клиентов...")
+        # Watermark источника сдвигается в транзакции SCD-слияния его измерения
+        pending = ti.xcom_pull(task_ids='extract_with_plugins', key='pending_watermarks') or {}
+        watermarks = WatermarkStore(conn_id='postgres_dwh')
+        sources = {'dim_customers': 'customers', 'dim_products': 'products'}
         
-        # Создаем обработчик SCD Type 2
-        scd_handler = SCDType2Handler(
-            conn_id='postgres_dwh',
-            table_name='dim_customers',
-            natural_key='customer_id'
+        result = {}
+        for table_name, dimension_df in dimensions.items():
+            if dimension_df.empty:
+                print(f"⚠ Нет данных для {table_name}")
+                continue
+            
+            print(f"🔄 Обработка {len(dimension_df)} записей для {table_name}...")
+            
+            # Обработчик SCD Type 2 по спецификации измерения
+            scd_handler = SCDType2Handler(conn_id='postgres_dwh', table_name=table_name)
+            result[table_name] = scd_handler.process_dimension(
+                dimension_df,
+                effective_date=execution_date.date(),
+                before_commit=lambda cursor, source=sources[table_name]: watermarks.advance_pending(
+                    pending, [source], cursor=cursor
+                )
+            )
+            
+            print(f"✅ SCD Type 2 обработка {table_name} завершена:")
+            print(f"   Новые записи: {result[table_name].get('new_records', 0)}")
+            print(f"   Обновленные: {result[table_name].get('updated_records', 0)}")
+        
+        return {'status': 'success', 'scd_result': result}
+        
+    except Exception as e:
+        print(f"❌ Ошибка загрузки в DWH: {e}")
+        import traceback
+        traceback.print_exc()
+        return {'status': 'error', 'error': str(e)}
+
+def build_fact_orders(items_df, orders_df, lookups):
+    """
+    Строки fact_orders из строк заказов: натуральные ключи заменяются
+    суррогатными по картам ключей в памяти (без подзапросов на строку).
+    Клиент и продукт связываются с версией SCD Type 2, действовавшей на
+    дату заказа, поэтому опоздавшие факты и перезагрузки истории получают
+    исторические версии, а не текущие.
+    """
+    order_columns = ['order_id', 'customer_id', 'order_date', 'order_time', 'status',
+                     'payment_method', 'shipping_city']
+    facts = items_df[['order_id', 'product_id', 'quantity', 'unit_price', 'total_price']].merge(
+        orders_df[[col for col in order_columns if col in orders_df.columns]],
+        on='order_id', how='inner'
+    )
+    # Натуральные ключи приводятся к числам до поиска ключей: строки с пустым
+    # или нечисловым ключом не загружаются (NOT NULL в fact_orders) и учитываются
+    key_ids = {col: pd.to_numeric(facts[col], errors='coerce') for col in ('order_id', 'customer_id', 'product_id')}
+    invalid_keys = pd.Series(False, index=facts.index)
+    for col, ids in key_ids.items():
+        invalid = ids.isna()
+        if invalid.any():
+            print(f"   ⚠ {col}: пустой или нечисловой ключ в {int(invalid.sum())} строках - строки пропущены")
+        invalid_keys |= invalid
+    facts = facts.assign(**key_ids)
+    
+    # Ограничения fact_orders: NOT NULL ключи, quantity > 0
+    facts = facts[~invalid_keys & (pd.to_numeric(facts['quantity'], errors='coerce') > 0)]
+    
+    quantity = pd.to_numeric(facts['quantity'], errors='coerce')
+    unit_price = pd.to_numeric(facts['unit_price'], errors='coerce')
+    total_amount = pd.to_numeric(facts['total_price'], errors='coerce').fillna(quantity * unit_price)
+    products = lookups.get_as_of('product').lookup(facts['product_id'], facts['order_date'])
+    cost_price = pd.to_numeric(products['cost_price'], errors='coerce')
+    cost_amount = (quantity * cost_price).round(2)
+    
+    return pd.DataFrame({
+        'customer_key': lookups.resolve_as_of('customer', facts['customer_id'], facts['order_date']),
+        'product_key': products['product_key'],
+        'date_key': lookups.resolve('date', facts['order_date']),
+        'time_key': lookups.resolve('time', facts['order_time']),
+        'status_key': lookups.resolve('status', facts['status']),
+        'order_id': facts['order_id'].astype('int64'),
+        'customer_id': facts['customer_id'].astype('int64'),
+        'product_id': facts['product_id'].astype('int64'),
+        'order_status': facts['status'],
+        'payment_method': facts.get('payment_method'),
+        'shipping_city': facts.get('shipping_city'),
+        'quantity': quantity.astype('int64'),
+        'unit_price': unit_price.round(2),
+        'total_amount': total_amount.round(2),
+        'cost_amount': cost_amount,
+        'profit_amount': (total_amount - cost_amount).round(2),
+    })
+
+@instrumented_task
+def load_fact_orders(**kwargs):
+    """Загрузка фактов заказов в DWH (fact_orders) с поиском суррогатных ключей"""
+    print("=" * 60)
+    print("📦 ЗАГРУЗКА ФАКТОВ ЗАКАЗОВ (fact_orders)")
+    print("=" * 60)
+    
+    ti = kwargs.get('ti')
+    
+    try:
+        items_ref = ti.xcom_pull(task_ids='extract_with_plugins', key='order_items_df')
+        if not items_ref or items_ref['rows'] == 0:
+            print("⚠ Нет новых строк заказов")
+            return {'status': 'no_data'}
+        
+        items_df = read_artifact(items_ref)
+        orders_df = read_artifact(
+            ti.xcom_pull(task_ids='transform_data', key='transformed_orders'),
+            columns=['order_id', 'customer_id', 'order_date', 'order_time', 'status',
+                     'payment_method', 'shipping_city']
         )
         
-        # Обрабатываем данные
-        result = scd_handler.process_dimension(customers_df, effective_date=execution_date.date())
+        # Заголовки заказов, не попавшие в инкремент заказов (строки добавлены позже)
+        missing_ids = sorted(set(items_df['order_id'].dropna().astype(int)) - set(orders_df.get('order_id', [])))
+        if missing_ids:
+            print(f"🔍 Дочитываем заголовки {len(missing_ids)} заказов из источника")
+            with PostgresExtractor(conn_id='postgres_source') as extractor:
+                late_orders = extractor.extract_table(ExtractSpec(
+                    'orders',
+                    columns=['order_id', 'customer_id', 'order_date', 'order_time', 'status',
+                             'payment_method', 'shipping_city'],
+                    predicates=[('order_id', 'IN', missing_ids)]
+                ))
+            orders_df = pd.concat([orders_df, late_orders], ignore_index=True)
+        
+        # Календарные измерения должны покрывать даты заказов до построения карт ключей
+        calendar = CalendarDimensions(conn_id='postgres_dwh')
+        order_dates = pd.to_datetime(orders_df['order_date'], errors='coerce').dropna()
+        if not order_dates.empty:
+            calendar.ensure_dates(order_dates.min(), order_dates.max())
+        calendar.ensure_times()
+        
+        # Карты ключей измерений строятся один раз на запуск
+        with track_stage('fact_orders_key_lookup') as stage:
+            lookups = KeyLookupCache(conn_id='postgres_dwh')
+            facts_df = build_fact_orders(items_df, orders_df, lookups)
+            stage.add(rows_in=len(items_df), rows_out=len(facts_df))
+        print(f"🔑 Карты ключей: {lookups.stats()}")
+        
+        for key in ('customer_key', 'product_key', 'date_key', 'time_key', 'status_key'):
+            unresolved = int(facts_df[key].isna().sum())
+            if unresolved:
+                print(f"   ⚠ {key}: не найдено для {unresolved} строк")
+        
+        # date_key - ключ секционирования: строки без даты не попадут ни в одну секцию
+        undated = facts_df['date_key'].isna()
+        if undated.any():
+            print(f"   ⚠ Пропущено {int(undated.sum())} строк без date_key")
+            facts_df = facts_df[~undated]
+        date_keys = facts_df['date_key'].astype('int64').unique()
+        
+        # Секции месяцев загрузки и пустые секции на будущие месяцы
+        partitions = PartitionManager(conn_id='postgres_dwh', table_name='fact_orders')
+        partitions.ensure_for_keys(date_keys)
+        for table_name in PARTITIONED_FACTS:
+            PartitionManager(conn_id='postgres_dwh', table_name=table_name).ensure_future()
+        
+        # Перезагрузка строк тех же заказов/продуктов идемпотентна (перекрытие watermark)
+        pending = ti.xcom_pull(task_ids='extract_with_plugins', key='pending_watermarks') or {}
+        watermarks = WatermarkStore(conn_id='postgres_dwh')
+        partials = PartialAggregateStore(conn_id='postgres_dwh')
+        # Дельты загрузки сливаются только с полными агрегатами дней
+        partials.ensure_backfilled()
+        
+        def before_commit(cursor):
+            # Дельта частичных агрегатов (вставленные минус замененные строки)
+            # и watermark фиксируются вместе с фактами
+            partials.merge_delta(cursor, 'stg_fact_orders', 'replaced_fact_orders')
+            watermarks.advance_pending(pending, ['order_items'], cursor=cursor)
+        
+        with track_stage('fact_orders_copy'), \
+                PostgresCopyLoader(conn_id='postgres_dwh', table_name='fact_orders', mode='staging') as loader:
+            stats = loader.load(
+                facts_df,
+                columns=FACT_ORDERS_COLUMNS,
+                merge_sql=f"""
+                    DROP TABLE IF EXISTS replaced_fact_orders;
+                    CREATE TEMP TABLE replaced_fact_orders (LIKE fact_orders) ON COMMIT DROP;
+                    
+                    -- Условие по date_key ограничивает удаление секциями месяцев загрузки
+                    WITH replaced AS (
+                        DELETE FROM fact_orders f
+                        USING stg_fact_orders s
+                        WHERE f.order_id = s.order_id AND f.product_id = s.product_id
+                          AND f.date_key = ANY(%s)
+                        RETURNING f.*
+                    )
+                    INSERT INTO replaced_fact_orders SELECT * FROM replaced;
+                    
+                    {partitions.insert_by_partition_sql('stg_fact_orders', FACT_ORDERS_COLUMNS, date_keys)}
+                """,
+                parameters=([int(key) for key in date_keys],),
+                before_commit=before_commit
+            )
         
-        print(f"✅ SCD Type 2 обработка завершена:")
-        print(f"   Новые записи: {result.get('new_records', 0)}")
-        print(f"   Обновленные: {result.get('updated_records', 0)}")
+        # Даты загруженных фактов - для пересчета дневных метрик в аналитике
+        fact_dates = sorted(
+            datetime.strptime(str(key), '%Y%m%d').date().isoformat()
+            for key in date_keys
+        )
+        ti.xcom_push(key='fact_dates', value=fact_dates)
         
-        return {'status': 'success', 'scd_result': result}
+        print(f"✅ Загружено {stats['rows_loaded']} строк в fact_orders")
+        return {'status': 'success', 'records_loaded': stats['rows_loaded'], 'lookups': lookups.stats()}
         
     except Exception as e:
-        print(f"❌ Ошибка загрузки в DWH: {e}")
+        print(f"❌ Ошибка загрузки fact_orders: {e}")
         import traceback
         traceback.print_exc()
         return {'status': 'error', 'error': str(e)}
 
+@instrumented_task
+def backfill_fact_partitions(**kwargs):
+    """
+    Бэкфилл месяцев fact_orders по запросу: месяцы из dag_run.conf
+    (например {"backfill_months": ["2024-01"]}) пересобираются из источника
+    в отдельной таблице и подменяют секции целиком
+    """
+    print("=" * 60)
+    print("🔁 БЭКФИЛЛ СЕКЦИЙ fact_orders")
+    print("=" * 60)
+    
+    dag_run = kwargs.get('dag_run')
+    months = (getattr(dag_run, 'conf', None) or {}).get('backfill_months') or []
+    if not months:
+        print("ℹ Бэкфилл не запрошен")
+        return {'status': 'skipped'}
+    
+    try:
+        starts = sorted({month_start(f"{month}-01") for month in months})
+        partitions = PartitionManager(conn_id='postgres_dwh', table_name='fact_orders')
+        partitions.ensure_partitions(starts[0], starts[-1])
+        partials = PartialAggregateStore(conn_id='postgres_dwh')
+        partials.ensure_backfilled()
+        
+        # Календарь покрывает все месяцы до построения карт ключей
+        calendar = CalendarDimensions(conn_id='postgres_dwh')
+        calendar.ensure_dates(starts[0], add_months(starts[-1], 1) - timedelta(days=1))
+        calendar.ensure_times()
+        lookups = KeyLookupCache(conn_id='postgres_dwh')
+        refresher = AggregateRefresher(conn_id='postgres_dwh')
+        
+        result = {}
+        for start in starts:
+            end = add_months(start, 1)
+            with PostgresExtractor(conn_id='postgres_source') as extractor:
+                orders_df = extractor.extract_table(ExtractSpec(
+                    'orders',
+                    columns=['order_id', 'customer_id', 'order_date', 'order_time', 'status',
+                             'payment_method', 'shipping_city'],
+                    predicates=[('order_date', '>=', start), ('order_date', '<', end)]
+                ))
+                if orders_df.empty:
+                    # Пустой месяц источника скорее означает сбой - секцию не подменяем
+                    print(f"⚠ Нет заказов за {start:%Y-%m} в источнике, секция не подменяется")
+                    result[f"{start:%Y-%m}"] = None
+                    continue
+                items_df = extractor.extract_table(ExtractSpec(
+                    'order_items',
+                    columns=['order_id', 'product_id', 'quantity', 'unit_price', 'total_price'],
+                    predicates=[('order_id', 'IN', orders_df['order_id'].tolist())]
+                ))
+            
+            orders_df['status'] = orders_df['status'].fillna('Pending')
+            facts_df = build_fact_orders(items_df, orders_df, lookups)
+            facts_df = facts_df[facts_df['date_key'].notna()]
+            
+            def fill(staged, facts_df=facts_df):
+                with PostgresCopyLoader(conn_id='postgres_dwh', table_name=staged, mode='append') as loader:
+                    return loader.load(facts_df, columns=FACT_ORDERS_COLUMNS)['rows_loaded']
+            
+            result[f"{start:%Y-%m}"] = partitions.swap_partition(start, fill)
+            # Частичные агрегаты и агрегаты продаж месяца пересобираются по новой
+            # секции одной транзакцией (агрегаты продаж читают частичные агрегаты)
+            last_day = end - timedelta(days=1)
+            
+            def refresh_aggregates(cursor, start=start, last_day=last_day):
+                refresher.refresh_range(cursor, start, last_day)
+            
+            partials.rebuild(start, last_day, before_commit=refresh_aggregates)
+        
+        print(f"✅ Бэкфилл завершен: {result}")
+        return {'status': 'success', 'months': result}
+        
+    except Exception as e:
+        print(f"❌ Ошибка бэкфилла секций: {e}")
+        import traceback
+        traceback.print_exc()
+        return {'status': 'error', 'error': str(e)}
+
+@instrumented_task
+def refresh_dwh_aggregates(**kwargs):
+    """Инкрементальное обновление материализованных агрегатов DWH"""
+    print("=" * 60)
+    print("🧱 ОБНОВЛЕНИЕ АГРЕГАТОВ DWH")
+    print("=" * 60)
+    
+    try:
+        # Агрегаты продаж собираются из частичных агрегатов - они должны быть полными
+        PartialAggregateStore(conn_id='postgres_dwh').ensure_backfilled()
+        
+        # Пересчитываются только дни фактов, загруженных после прошлого обновления
+        results = AggregateRefresher(conn_id='postgres_dwh').refresh_all()
+        return {'status': 'success', 'aggregates': results}
+        
+    except Exception as e:
+        print(f"❌ Ошибка обновления агрегатов: {e}")
+        import traceback
+        traceback.print_exc()
+        return {'status': 'error', 'error': str(e)}
+
+@instrumented_task
 def load_feedback_to_dwh(**kwargs):
     """Загрузка отзывов в DWH (fact_feedback)"""
     print("=" * 60)
@@ -264,13 +639,13 @@ def load_feedback_to_dwh(**kwargs):
     
     try:
         # Получаем трансформированные отзывы
-        feedback_json = ti.xcom_pull(task_ids='transform_data', key='transformed_feedback')
+        feedback_ref = ti.xcom_pull(task_ids='transform_data', key='transformed_feedback')
         
-        if not feedback_json:
+        if not feedback_ref:
             print("⚠ Нет данных об отзывах для загрузки в DWH")
             return {'status': 'no_data'}
         
-        feedback_df = pd.read_json(feedback_json, orient='split')
+        feedback_df = read_artifact(feedback_ref)
         
         print(f"🔄 Загрузка {len(feedback_df)} отзывов в DWH...")
         print(f"📋 Колонки в данных: {list(feedback_df.columns)}")
@@ -289,51 +664,47 @@ def load_feedback_to_dwh(**kwargs):
             rating INTEGER DEFAULT 0,
             source_system VARCHAR(50) DEFAULT 'mongo_source',
             load_date DATE DEFAULT CURRENT_DATE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            row_digest BIGINT
+        );
+        CREATE INDEX IF NOT EXISTS idx_fact_feedback_feedback_id ON fact_feedback(feedback_id);
         """
         dwh_hook.run(create_table_sql)
         
-        # Очищаем таблицу перед загрузкой новых данных
-        dwh_hook.run("TRUNCATE TABLE fact_feedback RESTART IDENTITY")
+        # Подготавливаем данные для загрузки
+        default_ids = pd.Series([f'FB_{i:04d}' for i in range(len(feedback_df))], index=feedback_df.index)
+        if 'feedback' in feedback_df.columns:
+            texts = feedback_df['feedback']
+        elif 'comment' in feedback_df.columns:
+            texts = feedback_df['comment']
+        else:
+            texts = pd.Series('', index=feedback_df.index)
+        if 'rating' in feedback_df.columns:
+            ratings = pd.to_numeric(feedback_df['rating'], errors='coerce').fillna(0).astype(int)
+        else:
+            ratings = pd.Series(0, index=feedback_df.index)
         
-        # Подготавливаем данные для вставки
-        records = []
-        for index, row in feedback_df.iterrows():
-            feedback_id = str(row.get('feedback_id', f'FB_{index:04d}'))
-            feedback_text = str(row.get('feedback', row.get('comment', '')))
-            
-            # Получаем рейтинг
-            rating = 0
-            if 'rating' in row:
-                try:
-                    rating = int(row['rating'])
-                except:
-                    rating = 0
-            
-            records.append((
-                feedback_id,
-                feedback_text[:500],  # ограничиваем длину
-                rating,
-                'mongo_source'
-            ))
-        
-        # Вставляем данные
-        insert_sql = """
-        INSERT INTO fact_feedback 
-        (feedback_id, feedback_text, rating, source_system)
-        VALUES (%s, %s, %s, %s)
-        """
+        records_df = pd.DataFrame({
+            'feedback_id': feedback_df['feedback_id'].astype(str) if 'feedback_id' in feedback_df.columns else default_ids,
+            'feedback_text': texts.fillna('').astype(str).str[:500],  # ограничиваем длину
+            'rating': ratings,
+            'source_system': 'mongo_source',
+        })
         
-        dwh_hook.insert_rows(
-            table='fact_feedback',
-            rows=records,
-            target_fields=['feedback_id', 'feedback_text', 'rating', 'source_system']
-        )
+        # Снимок отзывов применяется к таблице по feedback_id в одной транзакции:
+        # вставки, изменившиеся по дайджесту строки и удаленные отзывы
+        loader = PostgresCopyLoader(conn_id='postgres_dwh', table_name='fact_feedback', mode='merge')
+        load_stats = loader.load(records_df, key_columns=['feedback_id'])
         
-        print(f"✅ Загружено {len(records)} отзывов в fact_feedback")
+        print(f"✅ Обработано {load_stats['rows_loaded']} отзывов в fact_feedback")
         
-        return {'status': 'success', 'records_loaded': len(records)}
+        return {
+            'status': 'success',
+            'records_loaded': load_stats['rows_loaded'],
+            'inserted': load_stats.get('inserted', 0),
+            'updated': load_stats.get('updated', 0),
+            'deleted': load_stats.get('deleted', 0)
+        }
             
     except Exception as e:
         print(f"❌ Ошибка загрузки отзывов: {e}")
@@ -341,6 +712,17 @@ def load_feedback_to_dwh(**kwargs):
         traceback.print_exc()
         return {'status': 'error', 'error': str(e)}
 
+def _print_daily_metrics(metrics, data_source):
+    """Вывод рассчитанных дневных метрик"""
+    print(f"📈 РАССЧИТАННЫЕ МЕТРИКИ ({data_source}):")
+    for row in metrics:
+        print(f"   {row['analytics_date']}: заказов {row['total_orders']} "
+              f"(новых {row.get('new_orders')}, отменено {row.get('cancelled_orders')}), "
+              f"выручка {row['total_revenue']:.2f}, прибыль {row.get('total_profit')}, "
+              f"клиентов {row['active_customers']}, топ город {row.get('top_city')}, "
+              f"топ категория {row.get('top_category')}")
+
+@instrumented_task
 def load_to_analytics(**kwargs):
     """Загрузка в аналитическую БД"""
     print("=" * 60)
@@ -348,53 +730,64 @@ def load_to_analytics(**kwargs):
     print("=" * 60)
     
     ti = kwargs.get('ti')
-    execution_date = kwargs.get('execution_date', datetime.now())
     
     try:
-        # Получаем данные из трансформации
-        orders_json = ti.xcom_pull(task_ids='transform_data', key='transformed_orders')
-        
-        if not orders_json:
-            print("⚠ Нет данных о заказах, используем тестовые метрики")
-            total_orders = 15
-            total_revenue = 2500.75
-            avg_order_value = 166.72
-            active_customers = 8
-            top_city = 'Москва'
-            avg_rating = 4.2
-        else:
-            orders_df = pd.read_json(orders_json, orient='split')
-            print(f"✅ Получено {len(orders_df)} заказов")
-            
-            # Расчет метрик
-            total_orders = len(orders_df)
-            total_revenue = orders_df['total_amount'].sum() if 'total_amount' in orders_df.columns else 2500.75
-            avg_order_value = total_revenue / total_orders if total_orders > 0 else 166.72
-            active_customers = orders_df['customer_id'].nunique() if 'customer_id' in orders_df.columns else 8
-            
-            # География
-            if 'shipping_city' in orders_df.columns:
-                city_counts = orders_df['shipping_city'].value_counts()
-                top_city = city_counts.index[0] if len(city_counts) > 0 else 'Москва'
-            else:
-                top_city = 'Москва'
+        orders_ref = ti.xcom_pull(task_ids='transform_data', key='transformed_orders')
+        fact_result = ti.xcom_pull(task_ids='load_fact_orders') or {}
+        
+        # Пересчитываются дни загруженных фактов и дни заказов из инкремента
+        analytics_dates = set(ti.xcom_pull(task_ids='load_fact_orders', key='fact_dates') or [])
+        if orders_ref and orders_ref['rows'] > 0:
+            for chunk in iter_artifact(orders_ref, columns=['order_date']):
+                analytics_dates.update(
+                    pd.to_datetime(chunk['order_date'], errors='coerce').dropna().dt.date.astype(str)
+                )
+        
+        if not analytics_dates:
+            print("⚠ Нет новых заказов - метрики не пересчитываются")
+            return {'status': 'no_data'}
+        
+        if fact_result.get('status') in ('success', 'no_data'):
+            # Метрики из частичных агрегатов затронутых дней (без сканирования фактов)
+            partials = PartialAggregateStore(conn_id='postgres_dwh')
+            daily = partials.daily(analytics_dates)
+            metrics = [row for row in (metrics_from_partials(day, grains) for day, grains in daily.items())
+                       if row is not None]
+            product_names = partials.product_names({row['top_product_id'] for row in metrics})
+            for row in metrics:
+                row['top_product_name'] = product_names.get(row['top_product_id'])
+            data_source = 'dwh_partials'
             
-            # Рейтинг (пока фиксированный)
-            avg_rating = 4.2
-        
-        print(f"📈 РАССЧИТАННЫЕ МЕТРИКИ:")
-        print(f"   Заказы: {total_orders}")
-        print(f"   Выручка: {total_revenue:.2f}")
-        print(f"   Средний чек: {avg_order_value:.2f}")
-        print(f"   Клиентов: {active_customers}")
-        print(f"   Топ город: {top_city}")
-        print(f"   Средний рейтинг: {avg_rating:.2f}")
-        
-        # Загрузка в аналитическую БД
+            # Месяц с начала по дням из частичных агрегатов (клиенты - объединение множеств)
+            if daily:
+                last_day = max(daily)
+                month_start = last_day.replace(day=1)
+                month = partials.rollup(month_start, last_day, period='month')
+                month_metrics = metrics_from_partials(month_start, month.get(month_start, {}))
+                if month_metrics:
+                    print(f"🗓 Месяц {month_start:%Y-%m}: заказов {month_metrics['total_orders']}, "
+                          f"выручка {month_metrics['total_revenue']:.2f}, "
+                          f"клиентов {month_metrics['active_customers']}")
+        else:
+            # Факты не загружены - метрики по заказам инкремента только для отчета:
+            # итоги инкремента перезаписали бы полные итоги дней, поэтому строки
+            # не пишутся и watermark заказов не сдвигается (инкремент будет
+            # извлечен повторно и посчитан из фактов в следующем запуске)
+            print("⚠ fact_orders не загружен, метрики по заказам инкремента не записываются")
+            aggregator = DailyMetricsAggregator()
+            for chunk in iter_artifact(orders_ref, columns=['order_date', 'total_amount', 'status',
+                                                           'customer_id', 'shipping_city']):
+                aggregator.update(chunk)
+            _print_daily_metrics(aggregator.results(), 'orders_increment')
+            return {'status': 'skipped', 'metrics_loaded': 0, 'data_source': 'orders_increment'}
+        
+        _print_daily_metrics(metrics, data_source)
+        
         analytics_hook = PostgresHook(postgres_conn_id='postgres_analytics')
         
-        # Создаем таблицу
-        create_table = """
+        # Таблица из init_analytics_db.sql; колонки, которых нет в ранних
+        # версиях таблицы, добавляются
+        analytics_hook.run("""
         CREATE TABLE IF NOT EXISTS daily_business_analytics (
             analytics_date DATE PRIMARY KEY,
             total_orders INTEGER,
@@ -406,42 +799,42 @@ def load_to_analytics(**kwargs):
             data_source VARCHAR(50),
             processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """
-        analytics_hook.run(create_table)
-        
-        # Вставляем данные
-        insert_sql = """
-        INSERT INTO daily_business_analytics (
-            analytics_date, total_orders, total_revenue, 
-            avg_order_value, active_customers, top_city,
-            avg_customer_rating, data_source
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (analytics_date) DO UPDATE SET
-            total_orders = EXCLUDED.total_orders,
-            total_revenue = EXCLUDED.total_revenue,
-            avg_order_value = EXCLUDED.avg_order_value,
-            active_customers = EXCLUDED.active_customers,
-            top_city = EXCLUDED.top_city,
-            avg_customer_rating = EXCLUDED.avg_customer_rating,
-            data_source = EXCLUDED.data_source,
-            updated_at = CURRENT_TIMESTAMP
-        """
-        
-        analytics_hook.run(insert_sql, parameters=(
-            execution_date.date(),
-            total_orders,
-            float(total_revenue),
-            float(avg_order_value),
-            active_customers,
-            top_city,
-            float(avg_rating),
-            'final_etl_working'
-        ))
+        );
+        ALTER TABLE daily_business_analytics
+            ADD COLUMN IF NOT EXISTS new_orders INTEGER,
+            ADD COLUMN IF NOT EXISTS cancelled_orders INTEGER,
+            ADD COLUMN IF NOT EXISTS total_cost DECIMAL(12, 2),
+            ADD COLUMN IF NOT EXISTS total_profit DECIMAL(12, 2),
+            ADD COLUMN IF NOT EXISTS profit_margin DECIMAL(5, 2),
+            ADD COLUMN IF NOT EXISTS top_product_id INTEGER,
+            ADD COLUMN IF NOT EXISTS top_product_name VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS top_product_revenue DECIMAL(12, 2),
+            ADD COLUMN IF NOT EXISTS orders_by_city JSONB,
+            ADD COLUMN IF NOT EXISTS top_category VARCHAR(100),
+            ADD COLUMN IF NOT EXISTS revenue_by_category JSONB;
+        """)
+        
+        # Метрики и watermark заказов фиксируются в одной транзакции
+        pending = ti.xcom_pull(task_ids='extract_with_plugins', key='pending_watermarks') or {}
+        watermarks = WatermarkStore(conn_id='postgres_analytics')
+        watermarks.ensure_table()
+        
+        conn = analytics_hook.get_conn()
+        cursor = conn.cursor()
+        try:
+            rows_written = upsert_daily_metrics(cursor, metrics, data_source)
+            watermarks.advance_pending(pending, ['orders'], cursor=cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
         
-        print(f"✅ Данные загружены в таблицу daily_business_analytics")
+        print(f"✅ Метрики за {rows_written} дн. загружены в daily_business_analytics")
         
-        return {'status': 'success', 'metrics_loaded': True}
+        return {'status': 'success', 'metrics_loaded': rows_written, 'data_source': data_source}
         
     except Exception as e:
         print(f"❌ Ошибка загрузки в аналитическую БД: {e}")
@@ -449,6 +842,7 @@ def load_to_analytics(**kwargs):
         traceback.print_exc()
         return {'status': 'error', 'error': str(e)}
 
+@instrumented_task
 def validate_results(**kwargs):
     """Валидация результатов"""
     print("=" * 60)
@@ -469,6 +863,13 @@ def validate_results(**kwargs):
         except Exception as e:
             print(f"   👥 Клиенты: таблица не доступна ({e})")
         
+        # Проверяем таблицу dim_products
+        try:
+            products_count = dwh_hook.get_first("SELECT COUNT(*) FROM dim_products")[0]
+            print(f"   🛒 Продукты (dim_products): {products_count}")
+        except Exception as e:
+            print(f"   🛒 Продукты: таблица не доступна ({e})")
+        
         # Проверяем таблицу csv_products
         try:
             csv_products_count = dwh_hook.get_first("SELECT COUNT(*) FROM csv_products")[0]
@@ -521,7 +922,7 @@ def validate_results(**kwargs):
             
             # Последняя запись
             last_record = analytics_hook.get_first("""
-                SELECT analytics_date, total_orders, total_revenue, active_customers, top_city, avg_customer_rating
+                SELECT analytics_date, total_orders, total_revenue, active_customers, top_city, total_profit, top_category
                 FROM daily_business_analytics 
                 ORDER BY analytics_date DESC 
                 LIMIT 1
@@ -533,7 +934,8 @@ def validate_results(**kwargs):
                 print(f"     • Выручка: {float(last_record[2]):,.2f}")
                 print(f"     • Клиентов: {last_record[3]}")
                 print(f"     • Топ город: {last_record[4]}")
-                print(f"     • Средний рейтинг: {float(last_record[5]):.1f}")
+                print(f"     • Прибыль: {float(last_record[5] or 0):,.2f}")
+                print(f"     • Топ категория: {last_record[6]}")
                 
         except Exception as e:
             print(f"   📈 Аналитика: таблица не доступна ({e})")
@@ -544,7 +946,7 @@ def validate_results(**kwargs):
         print("   1. 📥 Extract с плагинами (PostgreSQL + MongoDB)")
         print("   2. 📄 Extract CSV данных")
         print("   3. 🔄 Transform данных")
-        print("   4. 🏗 Load to DWH с SCD Type 2 (клиенты)")
+        print("   4. 🏗 Load to DWH с SCD Type 2 (клиенты и продукты)")
         print("   5. 📦 Load CSV to DWH (продукты из CSV)")
         print("   6. 📝 Load feedback to DWH (отзывы)")
         print("   7. 📊 Load to Analytics (метрики)")
@@ -556,7 +958,7 @@ def validate_results(**kwargs):
             total_records = 0
             
             # DWH таблицы
-            dwh_tables = ['dim_customers', 'csv_products', 'fact_feedback']
+            dwh_tables = ['dim_customers', 'dim_products', 'csv_products', 'fact_feedback']
             for table in dwh_tables:
                 try:
                     count = dwh_hook.get_first(f"SELECT COUNT(*) FROM {table}")[0]
@@ -584,6 +986,7 @@ def validate_results(**kwargs):
         traceback.print_exc()
         return {'status': 'error', 'error': str(e)}
 
+@instrumented_task
 def extract_csv_data(**kwargs):
     """Извлечение данных из CSV файла"""
     print("=" * 60)
@@ -606,50 +1009,53 @@ def extract_csv_data(**kwargs):
         else:
             print(f"⚠ Директория {csv_dir} не существует")
         
-        # Используем CSV экстрактор
+        # Используем CSV экстрактор в потоковом режиме: типизированные порции
+        # сразу пишутся в артефакт, ошибки файла прерывают задачу
         csv_extractor = CSVExtractor(file_path=csv_file_path)
-        
-        # Извлекаем данные
-        csv_df = csv_extractor.extract_csv(
-            sep=',',
-            encoding='utf-8',
-            parse_dates=['created_at', 'updated_at']
-        )
-        
-        # Валидация данных
         required_columns = ['product_id', 'product_name', 'category', 'unit_price']
-        validation = csv_extractor.validate_csv(csv_df, required_columns)
         
-        print(f"📊 Результаты извлечения:")
-        print(f"   Записей: {len(csv_df)}")
-        print(f"   Колонок: {len(csv_df.columns)}")
-        print(f"   Статус валидации: {'✅ Успешно' if validation['is_valid'] else '❌ Ошибки'}")
+        store = ArtifactStore.from_context(kwargs)
+        csv_ref = store.write_chunks('csv_products', csv_extractor.extract_csv_chunks(
+            dtype=PRODUCT_FEED_DTYPES,
+            parse_dates=PRODUCT_FEED_DATE_COLUMNS,
+            required_columns=required_columns,
+            engine='pyarrow'
+        ))
         
-        if validation['errors']:
-            print(f"   Ошибки: {validation['errors']}")
+        validation = {
+            'is_valid': True,
+            'errors': [],
+            'warnings': [] if csv_ref['rows'] else ["CSV файл пуст"],
+            'stats': csv_extractor.stream_stats,
+        }
         
-        if not csv_df.empty:
-            print(f"   Пример данных:\n{csv_df.head(2).to_string()}")
+        print(f"📊 Результаты извлечения:")
+        print(f"   Записей: {csv_ref['rows']}")
+        print(f"   Колонок: {len(csv_ref['schema'])}")
+        print(f"   Порций: {validation['stats']['chunks']}")
+        print(f"   Пропущенных значений: {validation['stats']['missing_values']}")
         
-        # Сохраняем в XCom
+        # В XCom передается ссылка на артефакт
         if ti:
-            ti.xcom_push(key='csv_products_df', value=csv_df.to_json(orient='split', date_format='iso'))
-            print(f"💾 Сохранено в XCom: {len(csv_df)} записей")
+            ti.xcom_push(key='csv_products_df', value=csv_ref)
+            print(f"💾 Сохранено в артефакт: {csv_ref['rows']} записей")
         
         return {
             'status': 'success',
-            'records': len(csv_df),
+            'records': csv_ref['rows'],
             'validation': validation,
             'file_path': csv_file_path
         }
         
     except Exception as e:
+        # Без подмены тестовыми данными: задача падает, загрузка не запускается
         print(f"❌ Ошибка извлечения CSV: {e}")
         import traceback
         traceback.print_exc()
-        return {'status': 'error', 'error': str(e)}
+        raise
 
 
+@instrumented_task
 def load_csv_to_dwh(**kwargs):
     """Загрузка CSV данных в DWH"""
     print("=" * 60)
@@ -660,13 +1066,13 @@ def load_csv_to_dwh(**kwargs):
     
     try:
         # Получаем данные из XCom
-        csv_json = ti.xcom_pull(task_ids='extract_csv_data', key='csv_products_df')
+        csv_ref = ti.xcom_pull(task_ids='extract_csv_data', key='csv_products_df')
         
-        if not csv_json:
+        if not csv_ref:
             print("⚠ Нет CSV данных для загрузки")
             return {'status': 'no_data'}
         
-        csv_df = pd.read_json(csv_json, orient='split')
+        csv_df = read_artifact(csv_ref)
         
         print(f"🔄 Загрузка {len(csv_df)} продуктов из CSV в DWH...")
         
@@ -689,44 +1095,23 @@ def load_csv_to_dwh(**kwargs):
             dimensions VARCHAR(100),
             source_system VARCHAR(50) DEFAULT 'csv_source',
             load_date DATE DEFAULT CURRENT_DATE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            row_digest BIGINT
+        );
+        CREATE INDEX IF NOT EXISTS idx_csv_products_product_id ON csv_products(product_id);
         """
         dwh_hook.run(create_table_sql)
         
-        # Очищаем таблицу перед загрузкой новых данных
-        dwh_hook.run("TRUNCATE TABLE csv_products RESTART IDENTITY")
+        # Приводим колонки к типам и ширинам csv_products векторно и применяем
+        # снимок по product_id (только вставки, изменения и удаления)
+        loader = PostgresCopyLoader(conn_id='postgres_dwh', table_name='csv_products', mode='merge')
+        column_types = loader.get_column_types(columns=CSV_PRODUCTS_LOAD_COLUMNS)
         
-        # Подготавливаем данные для вставки
-        records = []
-        for _, row in csv_df.iterrows():
-            records.append((
-                int(row.get('product_id', 0)),
-                str(row.get('product_name', ''))[:255],
-                str(row.get('category', ''))[:100],
-                str(row.get('subcategory', ''))[:100] if 'subcategory' in row else '',
-                float(row.get('unit_price', 0.0)),
-                int(row.get('stock_quantity', 0)),
-                str(row.get('supplier', ''))[:100],
-                str(row.get('country_of_origin', ''))[:100],
-                float(row.get('weight_kg', 0.0)),
-                str(row.get('dimensions', ''))[:100]
-            ))
-        
-        # Вставляем данные
-        insert_sql = """
-        INSERT INTO csv_products 
-        (product_id, product_name, category, subcategory, unit_price, 
-         stock_quantity, supplier, country_of_origin, weight_kg, dimensions)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
+        coercer = ColumnCoercer()
+        records_df = coercer.transform(csv_df, column_types=column_types, key_columns=['product_id'])
+        print(f"🔧 Приведение колонок: {coercer.get_stats()}")
         
-        dwh_hook.insert_rows(
-            table='csv_products',
-            rows=records,
-            target_fields=['product_id', 'product_name', 'category', 'subcategory', 'unit_price',
-                          'stock_quantity', 'supplier', 'country_of_origin', 'weight_kg', 'dimensions']
-        )
+        load_stats = loader.load(records_df, key_columns=['product_id'])
         
         # Считаем статистику
         stats_sql = """
@@ -740,7 +1125,7 @@ def load_csv_to_dwh(**kwargs):
         """
         stats = dwh_hook.get_first(stats_sql)
         
-        print(f"✅ Загружено {len(records)} продуктов из CSV в DWH")
+        print(f"✅ Загружено {len(records_df)} продуктов из CSV в DWH")
         print(f"📊 Статистика CSV продуктов:")
         print(f"   Всего продуктов: {stats[0]}")
         print(f"   Общий остаток: {stats[1]}")
@@ -750,7 +1135,8 @@ def load_csv_to_dwh(**kwargs):
         
         return {
             'status': 'success',
-            'records_loaded': len(records),
+            'records_loaded': len(records_df),
+            'merge': {key: load_stats.get(key, 0) for key in ('inserted', 'updated', 'deleted', 'unchanged')},
             'stats': {
                 'total_products': stats[0],
                 'total_stock': stats[1],
@@ -766,6 +1152,36 @@ def load_csv_to_dwh(**kwargs):
         traceback.print_exc()
         return {'status': 'error', 'error': str(e)}
 
+def write_run_metrics(**kwargs):
+    """Запись измерений этапов запуска в data_quality_metrics одной пачкой"""
+    print("=" * 60)
+    print("⏱ ЗАПИСЬ МЕТРИК ЭТАПОВ")
+    print("=" * 60)
+    
+    ti = kwargs.get('ti')
+    dag_obj = kwargs.get('dag')
+    
+    try:
+        # Каждая задача кладет свои этапы в XCom; здесь они собираются вместе
+        task_ids = [task_id for task_id in dag_obj.task_ids if task_id != ti.task_id]
+        records = []
+        for task_records in ti.xcom_pull(task_ids=task_ids, key=METRICS_XCOM_KEY) or []:
+            records.extend(task_records or [])
+        
+        for record in sorted(records, key=lambda r: r['processing_time_seconds'] or 0, reverse=True):
+            print(f"   {record['source_name']}: {record['processing_time_seconds']} с, "
+                  f"строк {record['rows_in']} -> {record['rows_out']}, "
+                  f"обращений к БД {record['db_round_trips']}, RSS {record['peak_rss_mb']} МБ")
+        
+        written = write_stage_metrics(PostgresHook(postgres_conn_id='postgres_analytics'), records)
+        return {'status': 'success', 'stages_written': written}
+        
+    except Exception as e:
+        print(f"❌ Ошибка записи метрик этапов: {e}")
+        import traceback
+        traceback.print_exc()
+        return {'status': 'error', 'error': str(e)}
+
 # ========== СОЗДАНИЕ ОПЕРАТОРОВ ==========
 
 start_task = DummyOperator(task_id='start_etl', dag=dag)
@@ -792,6 +1208,27 @@ load_dwh_task = PythonOperator(
     provide_context=True,
 )
 
+load_fact_orders_task = PythonOperator(
+    task_id='load_fact_orders',
+    python_callable=load_fact_orders,
+    dag=dag,
+    provide_context=True,
+)
+
+backfill_facts_task = PythonOperator(
+    task_id='backfill_fact_partitions',
+    python_callable=backfill_fact_partitions,
+    dag=dag,
+    provide_context=True,
+)
+
+refresh_aggregates_task = PythonOperator(
+    task_id='refresh_dwh_aggregates',
+    python_callable=refresh_dwh_aggregates,
+    dag=dag,
+    provide_context=True,
+)
+
 load_feedback_task = PythonOperator(
     task_id='load_feedback_to_dwh',
     python_callable=load_feedback_to_dwh,
@@ -813,6 +1250,15 @@ validate_task = PythonOperator(
     provide_context=True,
     trigger_rule='all_done',
 )
+
+write_metrics_task = PythonOperator(
+    task_id='write_run_metrics',
+    python_callable=write_run_metrics,
+    dag=dag,
+    provide_context=True,
+    trigger_rule='all_done',
+)
+
 extract_csv_task = PythonOperator(
     task_id='extract_csv_data',
     python_callable=extract_csv_data,
@@ -831,14 +1277,17 @@ load_csv_task = PythonOperator(
 # Основной поток ETL
 start_task >> extract_task >> transform_task
 transform_task >> [load_feedback_task, load_dwh_task]
-[load_feedback_task, load_dwh_task] >> load_analytics_task
+load_dwh_task >> load_fact_orders_task  # факты после измерений: нужны их суррогатные ключи
+[load_feedback_task, load_fact_orders_task] >> load_analytics_task
+load_fact_orders_task >> backfill_facts_task  # подмена секций после обычной загрузки фактов
+backfill_facts_task >> refresh_aggregates_task  # агрегаты пересчитываются по load_date фактов
 
 # CSV поток (параллельный, низкий приоритет)
 start_task >> extract_csv_task >> load_csv_task
 load_csv_task >> validate_task  # CSV должен завершиться перед валидацией
 
 # Валидация запускается когда все остальное завершено
-[load_analytics_task, load_csv_task] >> validate_task >> end_task
+[load_analytics_task, load_csv_task, refresh_aggregates_task] >> validate_task >> write_metrics_task >> end_task
 
 print("✅ DAG 'final_etl_working' создан успешно!")
 print("📋 Особенности этой версии:")
@@ -846,5 +1295,5 @@ print("   - Использует плагины через прямой импо
 print("   - Реализует полный ETL процесс")
 print("   - SCD Type 2 для измерений")
 print("   - Загрузка в DWH и аналитическую БД")
-print("   - Исправлена передача данных через XCom")
+print("   - Данные передаются через артефакты Arrow, в XCom только ссылки")
 print("=" * 60)
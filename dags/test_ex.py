@@ -6,12 +6,13 @@ import os
 sys.path.insert(0, '/opt/airflow/plugins')
 
 from extractors.postgres_extractor import PostgresExtractor
+from extractors.extract_spec import ExtractSpec
 from extractors.mongo_extractor import MongoExtractor
 
 print("Testing PostgreSQL extractor...")
 try:
     with PostgresExtractor(conn_id='postgres_source') as extractor:
-        customers = extractor.extract_table('customers', where_clause='1=1 LIMIT 5')
+        customers = extractor.extract_table(ExtractSpec('customers', limit=5))
         print(f"✅ PostgreSQL extracted {len(customers)} customers")
         if len(customers) > 0:
             print(customers.head())
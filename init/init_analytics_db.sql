@@ -71,6 +71,13 @@ CREATE TABLE IF NOT EXISTS data_quality_metrics (
     start_time TIMESTAMP,
     end_time TIMESTAMP,
     
+    -- Производительность этапа (monitoring.stage_metrics)
+    rows_in BIGINT DEFAULT 0,
+    rows_out BIGINT DEFAULT 0,
+    bytes_moved BIGINT DEFAULT 0,
+    peak_rss_mb DECIMAL(10, 1),
+    db_round_trips INTEGER DEFAULT 0,
+    
     -- Статус
     status VARCHAR(50),
     error_message TEXT,
@@ -81,6 +88,16 @@ CREATE TABLE IF NOT EXISTS data_quality_metrics (
 -- Индексы для качества данных
 CREATE INDEX idx_quality_run_date ON data_quality_metrics(run_date);
 CREATE INDEX idx_quality_source ON data_quality_metrics(source_name);
+CREATE INDEX idx_quality_dag_task ON data_quality_metrics(dag_id, task_id, run_date);
+
+-- Контрольная таблица инкрементальной загрузки (high-watermark по источникам)
+CREATE TABLE IF NOT EXISTS etl_watermarks (
+    source_name VARCHAR(100) PRIMARY KEY,
+    watermark_column VARCHAR(100) NOT NULL,
+    watermark_value TIMESTAMP,
+    rows_loaded INTEGER DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
 
 -- Представление для быстрого доступа к последним метрикам
 CREATE OR REPLACE VIEW latest_data_quality AS
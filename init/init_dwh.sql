@@ -53,6 +53,8 @@ CREATE TABLE IF NOT EXISTS dim_customers (
     is_current BOOLEAN DEFAULT TRUE,        -- Флаг текущей версии
     
     -- Технические поля
+    attr_hash BIGINT,                       -- Хэш атрибутов SCD Type 2
+    type1_hash BIGINT,                      -- Хэш атрибутов SCD Type 1
     source_system VARCHAR(50) DEFAULT 'postgres_source',
     load_date DATE DEFAULT CURRENT_DATE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -79,6 +81,8 @@ CREATE TABLE IF NOT EXISTS dim_products (
     is_current BOOLEAN DEFAULT TRUE,
     
     -- Технические поля
+    attr_hash BIGINT,                       -- Хэш атрибутов SCD Type 2
+    type1_hash BIGINT,                      -- Хэш атрибутов SCD Type 1
     source_system VARCHAR(50) DEFAULT 'postgres_source',
     load_date DATE DEFAULT CURRENT_DATE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -98,14 +102,14 @@ CREATE TABLE IF NOT EXISTS dim_order_status (
 
 -- ========== ТАБЛИЦЫ ФАКТОВ ==========
 
--- Факты заказов
+-- Факты заказов (секции по месяцам date_key, create_monthly_partitions)
 CREATE TABLE IF NOT EXISTS fact_orders (
-    fact_order_id BIGSERIAL PRIMARY KEY,
+    fact_order_id BIGSERIAL,
     
     -- Surrogate keys измерений
     customer_key INTEGER REFERENCES dim_customers(customer_key),
     product_key INTEGER REFERENCES dim_products(product_key),
-    date_key INTEGER REFERENCES dim_date(date_key),
+    date_key INTEGER NOT NULL REFERENCES dim_date(date_key),
     time_key INTEGER REFERENCES dim_time(time_key),
     status_key INTEGER REFERENCES dim_order_status(status_key),
     
@@ -132,18 +136,19 @@ CREATE TABLE IF NOT EXISTS fact_orders (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
     -- Ограничения
+    PRIMARY KEY (fact_order_id, date_key),
     CHECK (quantity > 0),
     CHECK (unit_price >= 0),
     CHECK (total_amount >= 0)
-);
+) PARTITION BY RANGE (date_key);
 
--- Факты платежей
+-- Факты платежей (секции по месяцам date_key)
 CREATE TABLE IF NOT EXISTS fact_payments (
-    fact_payment_id BIGSERIAL PRIMARY KEY,
+    fact_payment_id BIGSERIAL,
     
     -- Surrogate keys
     customer_key INTEGER REFERENCES dim_customers(customer_key),
-    date_key INTEGER REFERENCES dim_date(date_key),
+    date_key INTEGER NOT NULL REFERENCES dim_date(date_key),
     time_key INTEGER REFERENCES dim_time(time_key),
     
     -- Natural keys
@@ -161,7 +166,90 @@ CREATE TABLE IF NOT EXISTS fact_payments (
     -- Технические поля
     source_system VARCHAR(50) DEFAULT 'postgres_source',
     load_date DATE DEFAULT CURRENT_DATE,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    
+    PRIMARY KEY (fact_payment_id, date_key)
+) PARTITION BY RANGE (date_key);
+
+-- Контрольная таблица инкрементальной загрузки (high-watermark по источникам)
+CREATE TABLE IF NOT EXISTS etl_watermarks (
+    source_name VARCHAR(100) PRIMARY KEY,
+    watermark_column VARCHAR(100) NOT NULL,
+    watermark_value TIMESTAMP,
+    rows_loaded INTEGER DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Сливаемые частичные агрегаты fact_orders по дням и разрезам
+-- (day / city / category / product): суммы и сжатые множества
+-- идентификаторов заказов и клиентов для точного числа уникальных (только
+-- в разрезах, где оно читается; у продуктов - только суммы); мощности
+-- множеств хранятся числами для чтения из SQL (agg_daily_sales)
+CREATE TABLE IF NOT EXISTS agg_daily_partials (
+    date_key INTEGER NOT NULL,
+    grain VARCHAR(20) NOT NULL,
+    grain_value VARCHAR(200) NOT NULL,
+    line_count INTEGER NOT NULL DEFAULT 0,
+    quantity BIGINT NOT NULL DEFAULT 0,
+    total_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    cost_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    profit_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    orders_count INTEGER,
+    customers_count INTEGER,
+    order_ids BYTEA,
+    customer_ids BYTEA,
+    new_order_ids BYTEA,
+    cancelled_order_ids BYTEA,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (date_key, grain, grain_value)
+);
+
+-- ========== МАТЕРИАЛИЗОВАННЫЕ АГРЕГАТЫ ==========
+-- Обновляются инкрементально (AggregateRefresher): пересчитываются дни,
+-- в которые попали факты с load_date не раньше предыдущего обновления.
+-- agg_daily_sales и agg_daily_category_sales собираются из строк 'day' и
+-- 'category' agg_daily_partials (без повторного сканирования fact_orders)
+
+CREATE TABLE IF NOT EXISTS agg_daily_sales (
+    date_key INTEGER PRIMARY KEY,
+    full_date DATE NOT NULL,
+    total_orders INTEGER NOT NULL,
+    unique_customers INTEGER NOT NULL,
+    total_items BIGINT NOT NULL,
+    line_count INTEGER NOT NULL,
+    total_revenue DECIMAL(14, 2) NOT NULL,
+    total_cost DECIMAL(14, 2) NOT NULL,
+    total_profit DECIMAL(14, 2) NOT NULL,
+    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS agg_daily_category_sales (
+    date_key INTEGER NOT NULL,
+    category VARCHAR(100) NOT NULL,
+    total_orders INTEGER NOT NULL,
+    total_items BIGINT NOT NULL,
+    total_revenue DECIMAL(14, 2) NOT NULL,
+    total_profit DECIMAL(14, 2) NOT NULL,
+    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (date_key, category)
+);
+
+CREATE TABLE IF NOT EXISTS agg_daily_payments (
+    date_key INTEGER NOT NULL,
+    payment_method VARCHAR(50) NOT NULL,
+    payments_count INTEGER NOT NULL,
+    orders_count INTEGER NOT NULL,
+    payment_amount DECIMAL(14, 2) NOT NULL,
+    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (date_key, payment_method)
+);
+
+-- Отметки обновления агрегатов (последний обработанный load_date)
+CREATE TABLE IF NOT EXISTS etl_aggregate_refresh (
+    aggregate_name VARCHAR(100) PRIMARY KEY,
+    last_load_date DATE,
+    days_refreshed INTEGER DEFAULT 0,
+    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- ========== ИНДЕКСЫ ==========
@@ -182,10 +270,12 @@ CREATE INDEX idx_fact_orders_date_key ON fact_orders(date_key);
 CREATE INDEX idx_fact_orders_customer_key ON fact_orders(customer_key);
 CREATE INDEX idx_fact_orders_product_key ON fact_orders(product_key);
 CREATE INDEX idx_fact_orders_order_id ON fact_orders(order_id);
+CREATE INDEX idx_fact_orders_load_date ON fact_orders(load_date);
 
 -- Для fact_payments
 CREATE INDEX idx_fact_payments_date_key ON fact_payments(date_key);
 CREATE INDEX idx_fact_payments_customer_key ON fact_payments(customer_key);
+CREATE INDEX idx_fact_payments_load_date ON fact_payments(load_date);
 
 -- ========== ВСТАВКА СТАТИЧЕСКИХ ДАННЫХ ==========
 
@@ -199,13 +289,39 @@ INSERT INTO dim_order_status (status_code, status_name, status_category, descrip
 ('REFUNDED', 'Возвращен', 'Возврат', 'Заказ был возвращен')
 ON CONFLICT (status_code) DO NOTHING;
 
--- Функция для заполнения dim_date (заполняет на 10 лет вперед и 2 года назад)
+-- Календарь праздников и перенесенных выходных (дополняет фиксированные праздники)
+CREATE TABLE IF NOT EXISTS dim_holiday_calendar (
+    holiday_date DATE PRIMARY KEY,
+    holiday_name VARCHAR(100) NOT NULL
+);
+
+-- Функция для заполнения dim_date одним INSERT ... SELECT по generate_series.
+-- Повторный вызов для диапазона обновляет только изменившиеся признаки праздников.
+DROP FUNCTION IF EXISTS populate_dim_date(DATE, DATE);
 CREATE OR REPLACE FUNCTION populate_dim_date(start_date DATE DEFAULT '2023-01-01', end_date DATE DEFAULT '2030-12-31')
-RETURNS VOID AS $$
-DECLARE
-    current_date DATE := start_date;
-BEGIN
-    WHILE current_date <= end_date LOOP
+RETURNS INTEGER AS $$
+    WITH days AS (
+        SELECT d::DATE AS full_date
+        FROM generate_series(start_date, end_date, INTERVAL '1 day') AS d
+    ),
+    fixed_holidays (month_number, day_of_month, holiday_name) AS (
+        VALUES
+            (1, 1, 'Новогодние каникулы'),
+            (1, 2, 'Новогодние каникулы'),
+            (1, 3, 'Новогодние каникулы'),
+            (1, 4, 'Новогодние каникулы'),
+            (1, 5, 'Новогодние каникулы'),
+            (1, 6, 'Новогодние каникулы'),
+            (1, 7, 'Рождество Христово'),
+            (1, 8, 'Новогодние каникулы'),
+            (2, 23, 'День защитника Отечества'),
+            (3, 8, 'Международный женский день'),
+            (5, 1, 'Праздник Весны и Труда'),
+            (5, 9, 'День Победы'),
+            (6, 12, 'День России'),
+            (11, 4, 'День народного единства')
+    ),
+    upserted AS (
         INSERT INTO dim_date (
             date_key,
             full_date,
@@ -217,50 +333,48 @@ BEGIN
             month_name,
             quarter,
             year,
-            is_weekend
-        ) VALUES (
-            EXTRACT(YEAR FROM current_date) * 10000 + 
-            EXTRACT(MONTH FROM current_date) * 100 + 
-            EXTRACT(DAY FROM current_date),
-            current_date,
-            EXTRACT(DAY FROM current_date),
-            EXTRACT(ISODOW FROM current_date),
-            TO_CHAR(current_date, 'Day'),
-            EXTRACT(WEEK FROM current_date),
-            EXTRACT(MONTH FROM current_date),
-            TO_CHAR(current_date, 'Month'),
-            EXTRACT(QUARTER FROM current_date),
-            EXTRACT(YEAR FROM current_date),
-            EXTRACT(ISODOW FROM current_date) IN (6, 7)
-        ) ON CONFLICT (date_key) DO NOTHING;
-        
-        current_date := current_date + INTERVAL '1 day';
-    END LOOP;
-END;
-$$ LANGUAGE plpgsql;
+            is_weekend,
+            is_holiday,
+            holiday_name
+        )
+        SELECT
+            TO_CHAR(d.full_date, 'YYYYMMDD')::INTEGER,
+            d.full_date,
+            EXTRACT(DAY FROM d.full_date),
+            EXTRACT(ISODOW FROM d.full_date),
+            TRIM(TO_CHAR(d.full_date, 'Day')),
+            EXTRACT(WEEK FROM d.full_date),
+            EXTRACT(MONTH FROM d.full_date),
+            TRIM(TO_CHAR(d.full_date, 'Month')),
+            EXTRACT(QUARTER FROM d.full_date),
+            EXTRACT(YEAR FROM d.full_date),
+            EXTRACT(ISODOW FROM d.full_date) IN (6, 7),
+            COALESCE(c.holiday_name, f.holiday_name) IS NOT NULL,
+            COALESCE(c.holiday_name, f.holiday_name)
+        FROM days d
+        LEFT JOIN dim_holiday_calendar c ON c.holiday_date = d.full_date
+        LEFT JOIN fixed_holidays f
+            ON f.month_number = EXTRACT(MONTH FROM d.full_date)
+           AND f.day_of_month = EXTRACT(DAY FROM d.full_date)
+        ON CONFLICT (date_key) DO UPDATE SET
+            is_holiday = EXCLUDED.is_holiday,
+            holiday_name = EXCLUDED.holiday_name
+        WHERE dim_date.is_holiday IS DISTINCT FROM EXCLUDED.is_holiday
+           OR dim_date.holiday_name IS DISTINCT FROM EXCLUDED.holiday_name
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM upserted;
+$$ LANGUAGE sql;
 
--- Функция для заполнения dim_time
+-- Функция для заполнения dim_time: все 86 400 секунд суток одним INSERT ... SELECT
+DROP FUNCTION IF EXISTS populate_dim_time();
 CREATE OR REPLACE FUNCTION populate_dim_time()
-RETURNS VOID AS $$
-DECLARE
-    current_time TIME := '00:00:00';
-    time_key_val INTEGER;
-    time_of_day_val VARCHAR(20);
-BEGIN
-    FOR i IN 0..86399 LOOP
-        time_key_val := 
-            EXTRACT(HOUR FROM current_time) * 10000 + 
-            EXTRACT(MINUTE FROM current_time) * 100 + 
-            EXTRACT(SECOND FROM current_time);
-        
-        -- Определение времени суток
-        CASE 
-            WHEN EXTRACT(HOUR FROM current_time) BETWEEN 6 AND 11 THEN time_of_day_val := 'Утро';
-            WHEN EXTRACT(HOUR FROM current_time) BETWEEN 12 AND 17 THEN time_of_day_val := 'День';
-            WHEN EXTRACT(HOUR FROM current_time) BETWEEN 18 AND 23 THEN time_of_day_val := 'Вечер';
-            ELSE time_of_day_val := 'Ночь';
-        END CASE;
-        
+RETURNS INTEGER AS $$
+    WITH seconds AS (
+        SELECT TIME '00:00:00' + s * INTERVAL '1 second' AS full_time
+        FROM generate_series(0, 86399) AS s
+    ),
+    inserted AS (
         INSERT INTO dim_time (
             time_key,
             full_time,
@@ -270,27 +384,64 @@ BEGIN
             second,
             am_pm,
             time_of_day
-        ) VALUES (
-            time_key_val,
-            current_time,
-            EXTRACT(HOUR FROM current_time),
-            CASE WHEN EXTRACT(HOUR FROM current_time) > 12 
-                 THEN EXTRACT(HOUR FROM current_time) - 12 
-                 ELSE EXTRACT(HOUR FROM current_time) END,
-            EXTRACT(MINUTE FROM current_time),
-            EXTRACT(SECOND FROM current_time),
-            CASE WHEN EXTRACT(HOUR FROM current_time) >= 12 THEN 'PM' ELSE 'AM' END,
-            time_of_day_val
-        ) ON CONFLICT (time_key) DO NOTHING;
-        
-        current_time := current_time + INTERVAL '1 second';
+        )
+        SELECT
+            TO_CHAR(t.full_time, 'HH24MISS')::INTEGER,
+            t.full_time,
+            EXTRACT(HOUR FROM t.full_time),
+            CASE WHEN EXTRACT(HOUR FROM t.full_time) > 12
+                 THEN EXTRACT(HOUR FROM t.full_time) - 12
+                 ELSE EXTRACT(HOUR FROM t.full_time) END,
+            EXTRACT(MINUTE FROM t.full_time),
+            EXTRACT(SECOND FROM t.full_time),
+            CASE WHEN EXTRACT(HOUR FROM t.full_time) >= 12 THEN 'PM' ELSE 'AM' END,
+            CASE
+                WHEN EXTRACT(HOUR FROM t.full_time) BETWEEN 6 AND 11 THEN 'Утро'
+                WHEN EXTRACT(HOUR FROM t.full_time) BETWEEN 12 AND 17 THEN 'День'
+                WHEN EXTRACT(HOUR FROM t.full_time) BETWEEN 18 AND 23 THEN 'Вечер'
+                ELSE 'Ночь'
+            END
+        FROM seconds t
+        ON CONFLICT (time_key) DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM inserted;
+$$ LANGUAGE sql;
+
+-- Вызов функций заполнения (при первом запуске; set-based - секунды)
+SELECT populate_dim_date('2023-01-01', '2030-12-31');
+SELECT populate_dim_time();
+
+-- Месячные секции таблицы фактов (границы - date_key YYYYMMDD) на диапазон
+-- дат; существующие секции пропускаются. Возвращает число созданных секций
+CREATE OR REPLACE FUNCTION create_monthly_partitions(p_table TEXT, p_from DATE, p_to DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    v_month DATE;
+    v_name TEXT;
+    v_created INTEGER := 0;
+BEGIN
+    FOR v_month IN
+        SELECT generate_series(date_trunc('month', p_from), date_trunc('month', p_to), INTERVAL '1 month')::DATE
+    LOOP
+        v_name := p_table || '_y' || to_char(v_month, 'YYYY') || 'm' || to_char(v_month, 'MM');
+        IF to_regclass(v_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+                v_name, p_table,
+                to_char(v_month, 'YYYYMMDD'),
+                to_char(v_month + INTERVAL '1 month', 'YYYYMMDD')
+            );
+            v_created := v_created + 1;
+        END IF;
     END LOOP;
+    RETURN v_created;
 END;
 $$ LANGUAGE plpgsql;
 
--- Вызов функций заполнения (при первом запуске)
--- SELECT populate_dim_date('2023-01-01', '2026-12-31');
--- SELECT populate_dim_time();
+-- Секции фактов с начала календаря и на квартал вперед (дальше - PartitionManager)
+SELECT create_monthly_partitions('fact_orders', DATE '2023-01-01', (CURRENT_DATE + INTERVAL '3 months')::DATE);
+SELECT create_monthly_partitions('fact_payments', DATE '2023-01-01', (CURRENT_DATE + INTERVAL '3 months')::DATE);
 
 -- ========== ПРЕДСТАВЛЕНИЯ ДЛЯ АНАЛИТИКИ ==========
 
@@ -326,20 +477,20 @@ SELECT
         WHEN is_current = TRUE THEN 'Текущая'
         ELSE 'Историческая'
     END as version_status,
-    DATEDIFF(DAY, effective_date, expiration_date) as days_active
+    -- Для текущей версии (expiration_date = '9999-12-31') - дни по сегодня
+    LEAST(expiration_date, CURRENT_DATE) - effective_date as days_active
 FROM dim_customers
 ORDER BY customer_id, effective_date;
 
--- Представление для ежедневных продаж
-CREATE OR REPLACE VIEW v_daily_sales AS
+-- Представление для ежедневных продаж (читает материализованный агрегат)
+DROP VIEW IF EXISTS v_daily_sales;
+CREATE VIEW v_daily_sales AS
 SELECT 
-    d.full_date,
-    COUNT(DISTINCT fo.order_id) as total_orders,
-    COUNT(DISTINCT fo.customer_id) as unique_customers,
-    SUM(fo.quantity) as total_items,
-    SUM(fo.total_amount) as total_revenue,
-    AVG(fo.total_amount) as avg_order_value
-FROM fact_orders fo
-JOIN dim_date d ON fo.date_key = d.date_key
-GROUP BY d.full_date
-ORDER BY d.full_date DESC;
+    full_date,
+    total_orders,
+    unique_customers,
+    total_items,
+    total_revenue,
+    ROUND(total_revenue / NULLIF(total_orders, 0), 2) as avg_order_value
+FROM agg_daily_sales
+ORDER BY full_date DESC;
@@ -6,8 +6,33 @@ import os
 from datetime import datetime
 import logging
 
+from monitoring.stage_metrics import report
+
 logger = logging.getLogger(__name__)
 
+# Размер порции при потоковом чтении CSV
+DEFAULT_CHUNKSIZE = 100000
+
+# Типы колонок фида продуктов поставщиков; низкокардинальные колонки -
+# category (в порции хранятся коды и небольшой словарь вместо строк)
+PRODUCT_FEED_DTYPES = {
+    'product_id': 'int64',
+    'product_name': 'string',
+    'category': 'category',
+    'subcategory': 'string',
+    'unit_price': 'float64',
+    'stock_quantity': 'Int64',
+    'supplier': 'category',
+    'country_of_origin': 'category',
+    'weight_kg': 'float64',
+    'dimensions': 'string',
+}
+PRODUCT_FEED_DATE_COLUMNS = ['created_at', 'updated_at']
+
+# Движки разбора CSV: 'c' - парсер pandas, 'pyarrow' - многопоточный
+# парсер pyarrow, колонки DataFrame хранятся в Arrow (dtype_backend='pyarrow')
+CSV_ENGINES = ('c', 'pyarrow')
+
 class CSVExtractor:
     """Извлечение данных из CSV файлов"""
     
@@ -21,6 +46,7 @@ class CSVExtractor:
         """
         self.file_path = file_path
         self.conn_id = conn_id
+        self.stream_stats = None
         
     def __enter__(self):
         return self
@@ -28,12 +54,13 @@ class CSVExtractor:
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass  # CSV не требует закрытия соединения
     
-    def extract_csv(self, file_path=None, **kwargs):
+    def extract_csv(self, file_path=None, engine='c', **kwargs):
         """
         Извлечение данных из CSV файла
         
         Args:
             file_path: Путь к CSV файлу (если не передан, используется self.file_path)
+            engine: Движок разбора из CSV_ENGINES
             **kwargs: Дополнительные параметры для pandas.read_csv
             
         Returns:
@@ -60,6 +87,11 @@ class CSVExtractor:
                 'low_memory': False,
             }
             
+            if engine == 'pyarrow':
+                read_csv_kwargs = _pyarrow_read_csv_kwargs(read_csv_kwargs)
+            elif engine != 'c':
+                raise ValueError(f"Неизвестный движок CSV: {engine}")
+            
             # Обновляем параметры из kwargs
             read_csv_kwargs.update(kwargs)
             
@@ -80,6 +112,90 @@ class CSVExtractor:
             logger.warning("⚠ Возвращаем тестовые данные")
             return self._create_test_data()
     
+    def extract_csv_chunks(self, file_path=None, chunksize=DEFAULT_CHUNKSIZE, dtype=None,
+                           usecols=None, parse_dates=None, required_columns=None,
+                           engine='c', **kwargs):
+        """
+        Потоковое извлечение CSV типизированными порциями
+        
+        В отличие от extract_csv ошибки не подменяются тестовыми данными:
+        отсутствующий файл, колонки или некорректные строки прерывают чтение.
+        Пиковая память определяется размером порции, а не файла.
+        
+        Args:
+            file_path: Путь к CSV файлу (если не передан, используется self.file_path)
+            chunksize: Число строк в порции
+            dtype: Словарь типов колонок (например, PRODUCT_FEED_DTYPES)
+            usecols: Читаемые колонки (по умолчанию - колонки dtype и parse_dates)
+            parse_dates: Колонки с датами
+            required_columns: Обязательные колонки заголовка
+            engine: Движок разбора из CSV_ENGINES; для 'pyarrow' порции читаются
+                    потоковым читателем pyarrow (размер блока - по chunksize) и
+                    нарезаются ровно по chunksize строк, колонки - Arrow
+            **kwargs: Дополнительные параметры для pandas.read_csv (только движок 'c')
+            
+        Yields:
+            pandas.DataFrame с очередной порцией строк
+        """
+        path_to_use = file_path or self.file_path
+        if not path_to_use:
+            raise ValueError("Не указан путь к CSV файлу")
+        if not os.path.exists(path_to_use):
+            raise FileNotFoundError(f"CSV файл не найден: {path_to_use}")
+        if engine not in CSV_ENGINES:
+            raise ValueError(f"Неизвестный движок CSV: {engine}")
+        
+        read_csv_kwargs = {
+            'encoding': 'utf-8',
+            'sep': ',',
+            'quotechar': '"',
+            'on_bad_lines': 'error',
+        }
+        read_csv_kwargs.update(kwargs)
+        
+        # Заголовок проверяется до чтения данных
+        header = list(pd.read_csv(path_to_use, nrows=0, encoding=read_csv_kwargs['encoding'],
+                                  sep=read_csv_kwargs['sep'],
+                                  quotechar=read_csv_kwargs['quotechar']).columns)
+        if usecols is None and dtype:
+            usecols = list(dtype) + [col for col in (parse_dates or []) if col not in dtype]
+        expected = set(required_columns or []) | set(usecols or [])
+        missing_columns = [col for col in expected if col not in header]
+        if missing_columns:
+            raise ValueError(f"В CSV {path_to_use} отсутствуют колонки: {sorted(missing_columns)}")
+        
+        logger.info(f"📥 Потоковое извлечение CSV: {path_to_use} (порции по {chunksize})")
+        
+        self.stream_stats = {
+            'total_rows': 0,
+            'total_columns': len(usecols or header),
+            'missing_values': 0,
+            'chunks': 0,
+        }
+        if engine == 'pyarrow':
+            reader = _ArrowCSVChunks(path_to_use, chunksize, dtype, usecols, parse_dates,
+                                     read_csv_kwargs['encoding'], read_csv_kwargs['sep'],
+                                     read_csv_kwargs['quotechar'])
+        else:
+            reader = pd.read_csv(
+                path_to_use,
+                chunksize=chunksize,
+                dtype=dtype,
+                usecols=usecols,
+                parse_dates=parse_dates,
+                **read_csv_kwargs
+            )
+        with reader:
+            for chunk in reader:
+                self.stream_stats['total_rows'] += len(chunk)
+                self.stream_stats['missing_values'] += int(chunk.isnull().sum().sum())
+                self.stream_stats['chunks'] += 1
+                report(rows_in=len(chunk), bytes_moved=chunk.memory_usage(index=False).sum())
+                yield chunk
+        
+        logger.info(f"✅ Извлечено {self.stream_stats['total_rows']} записей из CSV "
+                    f"({self.stream_stats['chunks']} порций)")
+    
     def _create_test_data(self):
         """Создание тестовых данных если файл не найден"""
         logger.info("📋 Создание тестовых данных о продуктах из CSV")
@@ -148,4 +264,84 @@ class CSVExtractor:
         
         logger.info(f"✅ Валидация CSV: {validation_result['stats']}")
         return validation_result
-    
\ No newline at end of file
+    
+
+
+# Типы pandas из карт dtype -> типы колонок pyarrow.csv
+ARROW_CSV_TYPE_NAMES = {
+    'int64': 'int64',
+    'Int64': 'int64',
+    'float64': 'float64',
+    'string': 'string',
+    'object': 'string',
+}
+
+
+def _pyarrow_read_csv_kwargs(read_csv_kwargs):
+    """Параметры pandas.read_csv для движка pyarrow (low_memory и on_bad_lines им не поддерживаются)"""
+    arrow_kwargs = {key: value for key, value in read_csv_kwargs.items()
+                    if key not in ('low_memory', 'on_bad_lines')}
+    arrow_kwargs.update(engine='pyarrow', dtype_backend='pyarrow')
+    return arrow_kwargs
+
+
+def _block_size_for_rows(path, rows, sample_bytes=1 << 20):
+    """Размер блока pyarrow (байты) для порций около rows строк - по средней длине строки в начале файла"""
+    with open(path, 'rb') as f:
+        sample = f.read(sample_bytes)
+    lines = max(sample.count(b'\n'), 1)
+    return max(int(len(sample) / lines * rows), 1 << 16)
+
+
+class _ArrowCSVChunks:
+    """
+    Потоковое чтение CSV через pyarrow.csv.open_csv в порции DataFrame с Arrow-колонками
+
+    Блоки читателя соответствуют примерно chunksize строкам, пакеты
+    перенарезаются ровно по chunksize строк (последняя порция - остаток).
+    """
+    
+    def __init__(self, path, chunksize, dtype, usecols, parse_dates, encoding, sep, quotechar):
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        
+        self.pa = pa
+        self.chunksize = chunksize
+        column_types = {}
+        for col, col_dtype in (dtype or {}).items():
+            if str(col_dtype) == 'category':
+                column_types[col] = pa.dictionary(pa.int32(), pa.string())
+            elif str(col_dtype) in ARROW_CSV_TYPE_NAMES:
+                column_types[col] = pa.type_for_alias(ARROW_CSV_TYPE_NAMES[str(col_dtype)])
+        for col in parse_dates or []:
+            column_types[col] = pa.timestamp('ns')
+        
+        self.reader = pa_csv.open_csv(
+            path,
+            read_options=pa_csv.ReadOptions(encoding=encoding,
+                                             block_size=_block_size_for_rows(path, chunksize)),
+            parse_options=pa_csv.ParseOptions(delimiter=sep, quote_char=quotechar),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=column_types,
+                include_columns=list(usecols) if usecols else None
+            )
+        )
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.reader.close()
+    
+    def __iter__(self):
+        pending, pending_rows = [], 0
+        for batch in self.reader:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            while pending_rows >= self.chunksize:
+                table = self.pa.Table.from_batches(pending)
+                yield table.slice(0, self.chunksize).to_pandas(types_mapper=pd.ArrowDtype)
+                rest = table.slice(self.chunksize)
+                pending, pending_rows = rest.to_batches(), rest.num_rows
+        if pending_rows:
+            yield self.pa.Table.from_batches(pending).to_pandas(types_mapper=pd.ArrowDtype)
@@ -0,0 +1,146 @@
+"""
+Extract Spec - структурированное описание запроса извлечения
+
+Спецификация компилируется в параметризованный psycopg2.sql: идентификаторы
+экранируются, значения передаются параметрами, текст запроса не зависит от
+значений (одинаков для всех порций и диапазонов).
+"""
+import copy
+import re
+from psycopg2 import sql
+
+# Поддерживаемые операторы предикатов
+COMPARISON_OPERATORS = ('=', '<>', '<', '<=', '>', '>=')
+UNARY_OPERATORS = ('IS NULL', 'IS NOT NULL')
+LIST_OPERATORS = ('IN', 'NOT IN')
+
+# Завершающий LIMIT n в устаревшем строковом where_clause
+TRAILING_LIMIT = re.compile(r'^(.*?)\s*\bLIMIT\s+(\d+)\s*;?\s*$', re.IGNORECASE | re.DOTALL)
+# Части запроса, которые нельзя обернуть в условие WHERE (...)
+UNSUPPORTED_CLAUSE = re.compile(r'\b(ORDER\s+BY|OFFSET|LIMIT)\b', re.IGNORECASE)
+
+
+class ExtractSpec:
+    """Описание извлечения: колонки, типизированные предикаты, порядок, лимит, инкремент"""
+
+    def __init__(self, table_name, columns=None, predicates=None, order_by=None, limit=None,
+                 incremental_column=None, incremental_value=None, where_sql=None):
+        """
+        Args:
+            table_name: Таблица источника
+            columns: Список колонок (None - все колонки)
+            predicates: Список (колонка, оператор, значение), объединяются через AND
+            order_by: Список колонок сортировки ('-col' - по убыванию)
+            limit: Ограничение числа строк
+            incremental_column: Колонка инкремента (строки с значением > incremental_value)
+            incremental_value: Нижняя граница инкремента (None - полная выборка)
+            where_sql: Произвольное условие SQL для обратной совместимости
+                       со строковым where_clause (не параметризуется, '%' экранируется;
+                       завершающий LIMIT n переносится в limit)
+        """
+        self.table_name = table_name
+        self.columns = list(columns) if columns and columns != '*' else None
+        self.predicates = []
+        self.order_by = list(order_by or [])
+        self.limit = limit
+        self.incremental_column = incremental_column
+        self.incremental_value = incremental_value
+        self.where_sql = where_sql or None
+
+        if self.where_sql:
+            match = TRAILING_LIMIT.match(self.where_sql)
+            if match:
+                self.where_sql = match.group(1).strip() or None
+                legacy_limit = int(match.group(2))
+                self.limit = legacy_limit if limit is None else min(int(limit), legacy_limit)
+            if UNSUPPORTED_CLAUSE.search(self.where_sql or ''):
+                raise ValueError(f"where_clause поддерживает только условие и завершающий LIMIT: {where_sql}")
+
+        for column, operator, *value in predicates or []:
+            self.where(column, operator, *value)
+
+    def where(self, column, operator, value=None):
+        """Добавление предиката (возвращает self для цепочки вызовов)"""
+        operator = operator.upper()
+        if operator not in COMPARISON_OPERATORS + UNARY_OPERATORS + LIST_OPERATORS:
+            raise ValueError(f"Неподдерживаемый оператор: {operator}")
+        self.predicates.append((column, operator, value))
+        return self
+
+    def with_predicates(self, *predicates):
+        """Копия спецификации с дополнительными предикатами (например, диапазон секции)"""
+        spec = copy.deepcopy(self)
+        for column, operator, *value in predicates:
+            spec.where(column, operator, *value)
+        return spec
+
+    def compile(self):
+        """
+        Компиляция в параметризованный запрос
+
+        Returns:
+            tuple (sql.Composed, список параметров)
+        """
+        select = (
+            sql.SQL(', ').join(map(sql.Identifier, self.columns))
+            if self.columns else sql.SQL('*')
+        )
+
+        query = [sql.SQL('SELECT '), select, sql.SQL(' FROM '), sql.Identifier(self.table_name)]
+        conditions, params = self.compile_where()
+        if conditions is not None:
+            query += [sql.SQL(' WHERE '), conditions]
+
+        if self.order_by:
+            query += [sql.SQL(' ORDER BY '), sql.SQL(', ').join(
+                sql.SQL('{} DESC').format(sql.Identifier(col[1:])) if col.startswith('-')
+                else sql.Identifier(col)
+                for col in self.order_by
+            )]
+
+        if self.limit is not None:
+            query.append(sql.SQL(' LIMIT %s'))
+            params.append(int(self.limit))
+
+        return sql.Composed(query), params
+
+    def compile_where(self):
+        """
+        Условие WHERE спецификации
+
+        Returns:
+            tuple (sql.Composed или None, список параметров)
+        """
+        conditions = []
+        params = []
+
+        if self.where_sql:
+            # Параметры передаются всегда, поэтому литеральный '%' (LIKE 'abc%')
+            # экранируется, чтобы psycopg2 не принял его за плейсхолдер
+            conditions.append(sql.SQL('({})').format(sql.SQL(self.where_sql.replace('%', '%%'))))
+
+        if self.incremental_column and self.incremental_value is not None:
+            conditions.append(sql.SQL('{} > %s').format(sql.Identifier(self.incremental_column)))
+            params.append(self.incremental_value)
+
+        for column, operator, value in self.predicates:
+            identifier = sql.Identifier(column)
+            if operator in UNARY_OPERATORS:
+                conditions.append(sql.SQL('{} ' + operator).format(identifier))
+            elif operator == 'IN':
+                conditions.append(sql.SQL('{} = ANY(%s)').format(identifier))
+                params.append(list(value))
+            elif operator == 'NOT IN':
+                conditions.append(sql.SQL('NOT ({} = ANY(%s))').format(identifier))
+                params.append(list(value))
+            else:
+                conditions.append(sql.SQL('{} ' + operator + ' %s').format(identifier))
+                params.append(value)
+
+        if not conditions:
+            return None, params
+        return sql.SQL(' AND ').join(conditions), params
+
+    def __repr__(self):
+        return (f"ExtractSpec({self.table_name}, predicates={len(self.predicates)}, "
+                f"incremental={self.incremental_column}, limit={self.limit})")
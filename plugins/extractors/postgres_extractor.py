@@ -1,8 +1,51 @@
 """
 PostgreSQL Extractor - исправленная версия
 """
+import json
+import queue
+import threading
+import uuid
+from contextlib import closing
+from datetime import date, datetime, timedelta
 import pandas as pd
 from airflow.providers.postgres.hooks.postgres import PostgresHook
+from psycopg2 import sql
+
+from extractors.extract_spec import ExtractSpec
+from monitoring.stage_metrics import report, counting_connection, in_current_stages
+
+# Размер порции для потокового извлечения
+DEFAULT_CHUNKSIZE = 50000
+
+# Число диапазонов (и параллельных соединений) при секционированном извлечении
+DEFAULT_PARTITIONS = 4
+
+# Типы колонок, применяемые к каждой порции (Decimal -> float, nullable int)
+SOURCE_DTYPES = {
+    'customers': {
+        'customer_id': 'int64',
+    },
+    'products': {
+        'product_id': 'int64',
+        'unit_price': 'float64',
+        'cost_price': 'float64',
+        'stock_quantity': 'Int64',
+        'supplier_id': 'Int64',
+    },
+    'orders': {
+        'order_id': 'int64',
+        'customer_id': 'Int64',
+        'total_amount': 'float64',
+    },
+    'order_items': {
+        'order_item_id': 'int64',
+        'order_id': 'Int64',
+        'product_id': 'Int64',
+        'quantity': 'int64',
+        'unit_price': 'float64',
+        'total_price': 'float64',
+    },
+}
 
 class PostgresExtractor:
     """Извлечение данных из PostgreSQL"""
@@ -17,16 +60,237 @@ class PostgresExtractor:
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.connection:
             self.connection.close()
+            self.connection = None
+    
+    def connect(self):
+        """Соединение с источником (открывается один раз на экстрактор)"""
+        if self.connection is None:
+            hook = PostgresHook(postgres_conn_id=self.conn_id)
+            self.connection = counting_connection(hook.get_conn())
+        return self.connection
             
     def extract_table(self, table_name, columns='*', where_clause=''):
-        """Извлечение данных из таблицы"""
-        hook = PostgresHook(postgres_conn_id=self.conn_id)
-        query = f"SELECT {columns} FROM {table_name}"
-        if where_clause:
-            query += f" WHERE {where_clause}"
-            
-        print(f"📥 Извлечение из {table_name}")
-        df = hook.get_pandas_df(query)
-        print(f"✅ Извлечено {len(df)} записей из {table_name}")
+        """
+        Извлечение данных из таблицы
+        
+        Args:
+            table_name: Имя таблицы или ExtractSpec
+            columns: Список колонок (если table_name - имя таблицы)
+            where_clause: Условие WHERE строкой (устаревший вариант, лучше ExtractSpec)
+        """
+        spec = self._as_spec(table_name, columns, where_clause)
+        query, params = spec.compile()
+        
+        print(f"📥 Извлечение из {spec.table_name}")
+        with closing(counting_connection(PostgresHook(postgres_conn_id=self.conn_id).get_conn())) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                df = pd.DataFrame.from_records(cursor.fetchall(), columns=[desc[0] for desc in cursor.description])
+        print(f"✅ Извлечено {len(df)} записей из {spec.table_name}")
         return df
-    
\ No newline at end of file
+    
+    def extract_table_chunks(self, table_name, columns='*', where_clause='',
+                             chunksize=DEFAULT_CHUNKSIZE, dtypes=None):
+        """
+        Потоковое извлечение таблицы порциями через серверный (именованный) курсор
+        
+        Args:
+            table_name: Имя таблицы или ExtractSpec
+            columns: Список колонок для SELECT
+            where_clause: Условие WHERE строкой (устаревший вариант, лучше ExtractSpec)
+            chunksize: Число строк в порции
+            dtypes: Типы колонок для каждой порции (по умолчанию SOURCE_DTYPES)
+            
+        Yields:
+            pandas.DataFrame с очередной порцией строк
+        """
+        spec = self._as_spec(table_name, columns, where_clause)
+        query, params = spec.compile()
+        if dtypes is None:
+            dtypes = SOURCE_DTYPES.get(spec.table_name, {})
+        
+        conn = self.connect()
+        cursor = conn.cursor(name=f"extract_{spec.table_name}_{uuid.uuid4().hex[:8]}")
+        cursor.itersize = chunksize
+        
+        print(f"📥 Потоковое извлечение из {spec.table_name} (порции по {chunksize})")
+        total = 0
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                
+                chunk = pd.DataFrame.from_records(rows, columns=[desc[0] for desc in cursor.description])
+                chunk_dtypes = {col: dtype for col, dtype in dtypes.items() if col in chunk.columns}
+                if chunk_dtypes:
+                    chunk = chunk.astype(chunk_dtypes)
+                
+                total += len(chunk)
+                report(rows_in=len(chunk), bytes_moved=chunk.memory_usage(index=False).sum())
+                yield chunk
+        finally:
+            cursor.close()
+            # Завершаем транзакцию чтения, в которой жил серверный курсор
+            conn.rollback()
+        
+        print(f"✅ Извлечено {total} записей из {spec.table_name}")
+    
+    def explain(self, spec, analyze=False):
+        """
+        План запроса спецификации (EXPLAIN FORMAT JSON) с выводом стоимости
+        
+        Args:
+            spec: ExtractSpec
+            analyze: Выполнить запрос (EXPLAIN ANALYZE) и получить фактическое время
+            
+        Returns:
+            dict с корневым узлом плана
+        """
+        query, params = spec.compile()
+        options = sql.SQL('ANALYZE, FORMAT JSON' if analyze else 'FORMAT JSON')
+        
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL('EXPLAIN ({}) ').format(options) + query, params)
+                result = cursor.fetchone()[0]
+        finally:
+            conn.rollback()
+        
+        plan = (json.loads(result) if isinstance(result, str) else result)[0]['Plan']
+        line = (f"🔍 План {spec.table_name}: {plan['Node Type']}"
+                f"{' по ' + plan['Index Name'] if plan.get('Index Name') else ''}, "
+                f"стоимость {plan['Startup Cost']}..{plan['Total Cost']}, строк ~{plan['Plan Rows']}")
+        if analyze:
+            line += f", фактически {plan.get('Actual Rows')} строк за {plan.get('Actual Total Time')} мс"
+        print(line)
+        return plan
+    
+    def partition_bounds(self, table_name, partition_column, partitions=DEFAULT_PARTITIONS, where_clause=''):
+        """
+        Разбиение таблицы на диапазоны значений колонки (первичный ключ или
+        индексированная дата) по MIN/MAX с учетом условий спецификации
+        
+        Returns:
+            Список ExtractSpec по диапазонам (пустой, если строк нет); текст
+            запроса у всех диапазонов одинаков, различаются только параметры
+        """
+        spec = self._as_spec(table_name, '*', where_clause)
+        # Границы - по условиям спецификации без ORDER BY и LIMIT (они относятся
+        # к строкам выборки, а не к агрегату MIN/MAX)
+        query = sql.SQL('SELECT MIN({col}), MAX({col}) FROM {table}').format(
+            col=sql.Identifier(partition_column), table=sql.Identifier(spec.table_name)
+        )
+        conditions, params = spec.compile_where()
+        if conditions is not None:
+            query = sql.SQL('{} WHERE {}').format(query, conditions)
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                low, high = cursor.fetchone()
+        finally:
+            conn.rollback()
+        if low is None:
+            return []
+        
+        step = (high - low) / partitions
+        if isinstance(low, int):
+            step = max(int(step), 1)
+        elif isinstance(low, date) and not isinstance(low, datetime):
+            step = timedelta(days=max(step.days, 1))
+        
+        bounds = []
+        lower = low
+        while len(bounds) < partitions - 1 and lower + step <= high:
+            bounds.append(lower + step)
+            lower = lower + step
+        
+        # Каждый диапазон - [нижняя граница, верхняя граница); крайние открыты
+        edges = [None] + bounds + [None]
+        return [
+            spec.with_predicates(
+                *([(partition_column, '>=', lower)] if lower is not None else []),
+                *([(partition_column, '<', upper)] if upper is not None else [])
+            )
+            for lower, upper in zip(edges, edges[1:])
+        ]
+    
+    def extract_table_partitioned(self, table_name, partition_column, partitions=DEFAULT_PARTITIONS,
+                                  columns='*', where_clause='', chunksize=DEFAULT_CHUNKSIZE, dtypes=None):
+        """
+        Параллельное извлечение таблицы по диапазонам partition_column
+        
+        Каждый диапазон читается серверным курсором в своем потоке и на своем
+        соединении; порции всех диапазонов отдаются одним потоком по мере
+        готовности (порядок строк между диапазонами не гарантируется).
+        Очередь ограничена, поэтому в памяти не больше 2 * partitions порций.
+        
+        Yields:
+            pandas.DataFrame с очередной порцией строк
+        """
+        spec = self._as_spec(table_name, columns, where_clause)
+        partition_specs = self.partition_bounds(spec, partition_column, partitions)
+        if not partition_specs:
+            print(f"📥 {spec.table_name}: нет строк для извлечения")
+            return
+        
+        print(f"📥 Секционированное извлечение {spec.table_name} по {partition_column}: "
+              f"{len(partition_specs)} диапазонов")
+        
+        chunks = queue.Queue(maxsize=2 * len(partition_specs))
+        stop = threading.Event()
+        done = object()
+        
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def read_partition(partition_spec):
+            try:
+                with PostgresExtractor(conn_id=self.conn_id) as extractor:
+                    for chunk in extractor.extract_table_chunks(partition_spec, chunksize=chunksize, dtypes=dtypes):
+                        if not put(chunk):
+                            break
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+        
+        workers = [
+            threading.Thread(target=in_current_stages(read_partition), args=(partition_spec,),
+                             name=f"extract_{spec.table_name}_{i}", daemon=True)
+            for i, partition_spec in enumerate(partition_specs)
+        ]
+        for worker in workers:
+            worker.start()
+        
+        try:
+            remaining = len(workers)
+            while remaining:
+                item = chunks.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+    
+    def _as_spec(self, table_name, columns, where_clause):
+        """ExtractSpec из спецификации или из устаревших строковых аргументов"""
+        if isinstance(table_name, ExtractSpec):
+            return table_name
+        if isinstance(columns, str) and columns != '*':
+            columns = [col.strip() for col in columns.split(',')]
+        return ExtractSpec(table_name, columns=columns, where_sql=where_clause)
@@ -0,0 +1,206 @@
+"""
+Aggregate Refresher - материализованные агрегаты DWH с инкрементальным обновлением
+
+Агрегат хранится таблицей с ключом date_key. При обновлении пересчитываются
+только дни, в которые попали строки фактов, загруженные (load_date) после
+предыдущего обновления; дни удаляются и вставляются заново в одной
+транзакции вместе с отметкой обновления.
+
+Таблицы агрегатов и отметок создаются в init_dwh.sql. Агрегаты продаж
+собираются из строк 'day' / 'category' agg_daily_partials: частичные агрегаты
+фиксируются в транзакции загрузки фактов, поэтому к моменту обновления
+они уже содержат затронутые дни, а число заказов и клиентов берется из
+мощностей их множеств идентификаторов без COUNT(DISTINCT) по фактам. Частичные
+агрегаты нужны для сверток периодов (объединение множеств идентификаторов),
+агрегаты продаж - для чтения из SQL (v_daily_sales).
+"""
+from datetime import timedelta
+
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+from loaders.db_utils import as_date, date_key
+from monitoring.stage_metrics import counting_connection
+
+REFRESH_TABLE = 'etl_aggregate_refresh'
+
+
+class AggregateSpec:
+    """Описание материализованного агрегата"""
+
+    def __init__(self, table_name, source_table, columns, select_sql):
+        """
+        Args:
+            table_name: Таблица агрегата (init_dwh.sql)
+            source_table: Таблица фактов (с колонками date_key и load_date) -
+                          по ней определяются пересчитываемые дни
+            columns: Колонки агрегата в порядке select_sql
+            select_sql: SELECT агрегата с условием по %(date_keys)s
+        """
+        self.table_name = table_name
+        self.source_table = source_table
+        self.columns = list(columns)
+        self.select_sql = select_sql
+
+    def __repr__(self):
+        return f"AggregateSpec({self.table_name} <- {self.source_table})"
+
+
+AGGREGATE_SPECS = {
+    'agg_daily_sales': AggregateSpec(
+        'agg_daily_sales', 'fact_orders',
+        ['date_key', 'full_date', 'total_orders', 'unique_customers', 'total_items',
+         'line_count', 'total_revenue', 'total_cost', 'total_profit'],
+        """
+        SELECT p.date_key, d.full_date,
+               p.orders_count, p.customers_count,
+               p.quantity, p.line_count,
+               p.total_amount, p.cost_amount, p.profit_amount
+        FROM agg_daily_partials p
+        JOIN dim_date d ON d.date_key = p.date_key
+        WHERE p.grain = 'day' AND p.date_key = ANY(%(date_keys)s)
+        """
+    ),
+    'agg_daily_category_sales': AggregateSpec(
+        'agg_daily_category_sales', 'fact_orders',
+        ['date_key', 'category', 'total_orders', 'total_items', 'total_revenue', 'total_profit'],
+        """
+        SELECT p.date_key, p.grain_value,
+               p.orders_count, p.quantity,
+               p.total_amount, p.profit_amount
+        FROM agg_daily_partials p
+        WHERE p.grain = 'category' AND p.date_key = ANY(%(date_keys)s)
+        """
+    ),
+    'agg_daily_payments': AggregateSpec(
+        'agg_daily_payments', 'fact_payments',
+        ['date_key', 'payment_method', 'payments_count', 'orders_count', 'payment_amount'],
+        """
+        SELECT fp.date_key, COALESCE(fp.payment_method, 'unknown'),
+               COUNT(*), COUNT(DISTINCT fp.order_id), SUM(fp.payment_amount)
+        FROM fact_payments fp
+        WHERE fp.date_key = ANY(%(date_keys)s)
+        GROUP BY fp.date_key, COALESCE(fp.payment_method, 'unknown')
+        """
+    ),
+}
+
+
+class AggregateRefresher:
+    """Инкрементальное обновление материализованных агрегатов по load_date фактов"""
+
+    def __init__(self, conn_id, specs=None):
+        self.conn_id = conn_id
+        self.specs = specs or AGGREGATE_SPECS
+        self.hook = PostgresHook(postgres_conn_id=self.conn_id)
+
+    def refresh(self, name, full=False):
+        """
+        Обновление одного агрегата
+
+        Args:
+            name: Имя агрегата (ключ AGGREGATE_SPECS)
+            full: Полный пересчет по всем дням фактов
+
+        Returns:
+            dict: число пересчитанных дней и строк агрегата
+        """
+        spec = self.specs[name]
+
+        conn = counting_connection(self.hook.get_conn())
+        cursor = conn.cursor()
+        try:
+            # Блокировка отметки сериализует параллельные обновления агрегата
+            cursor.execute(
+                f"INSERT INTO {REFRESH_TABLE} (aggregate_name) VALUES (%s) ON CONFLICT DO NOTHING",
+                (name,)
+            )
+            cursor.execute(
+                f"SELECT last_load_date FROM {REFRESH_TABLE} WHERE aggregate_name = %s FOR UPDATE",
+                (name,)
+            )
+            last_load_date = None if full else cursor.fetchone()[0]
+
+            # load_date - дата, поэтому день последнего обновления читается повторно
+            # (несколько загрузок в день); пересчет дня идемпотентен
+            touched_sql = f"""
+                SELECT date_key, MAX(load_date) FROM {spec.source_table}
+                WHERE date_key IS NOT NULL
+            """
+            params = ()
+            if last_load_date is not None:
+                touched_sql += " AND load_date >= %s"
+                params = (last_load_date,)
+            cursor.execute(touched_sql + " GROUP BY date_key", params)
+            touched = cursor.fetchall()
+
+            date_keys = sorted(row[0] for row in touched)
+            if full:
+                cursor.execute(f"TRUNCATE TABLE {spec.table_name}")
+            elif date_keys:
+                cursor.execute(f"DELETE FROM {spec.table_name} WHERE date_key = ANY(%s)", (date_keys,))
+
+            rows = 0
+            if date_keys:
+                cursor.execute(
+                    f"INSERT INTO {spec.table_name} ({', '.join(spec.columns)}) {spec.select_sql}",
+                    {'date_keys': date_keys}
+                )
+                rows = cursor.rowcount
+
+            new_load_date = max((row[1] for row in touched), default=last_load_date)
+            cursor.execute(f"""
+                UPDATE {REFRESH_TABLE}
+                SET last_load_date = %s, days_refreshed = %s, refreshed_at = CURRENT_TIMESTAMP
+                WHERE aggregate_name = %s
+            """, (new_load_date, len(date_keys), name))
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        print(f"🧱 {spec.table_name}: пересчитано дней {len(date_keys)}, строк {rows}")
+        return {'days_refreshed': len(date_keys), 'rows': rows, 'last_load_date': str(new_load_date)}
+
+    def refresh_range(self, cursor, start_date, end_date, source_table='fact_orders'):
+        """
+        Пересчет агрегатов по source_table за диапазон дат в транзакции
+        вызывающего (бэкфилл секции)
+
+        Пересобранные строки фактов получают load_date дня бэкфилла, а не дня
+        исходной загрузки, поэтому дни диапазона пересчитываются явно. Отметка
+        обновления не меняется: следующий refresh пересчитает эти дни еще раз
+        (идемпотентно).
+
+        Args:
+            cursor: Курсор открытой транзакции
+            start_date: Первая дата диапазона
+            end_date: Последняя дата диапазона (включительно)
+            source_table: Таблица фактов, агрегаты которой пересчитываются
+
+        Returns:
+            dict {агрегат: число строк}
+        """
+        start_date, end_date = as_date(start_date), as_date(end_date)
+        date_keys = [date_key(start_date + timedelta(days=offset))
+                     for offset in range((end_date - start_date).days + 1)]
+
+        results = {}
+        for name, spec in self.specs.items():
+            if spec.source_table != source_table:
+                continue
+            cursor.execute(f"DELETE FROM {spec.table_name} WHERE date_key = ANY(%s)", (date_keys,))
+            cursor.execute(
+                f"INSERT INTO {spec.table_name} ({', '.join(spec.columns)}) {spec.select_sql}",
+                {'date_keys': date_keys}
+            )
+            results[name] = cursor.rowcount
+            print(f"🧱 {spec.table_name}: пересчитано дней {len(date_keys)}, строк {cursor.rowcount}")
+        return results
+
+    def refresh_all(self, full=False):
+        """Обновление всех агрегатов"""
+        return {name: self.refresh(name, full=full) for name in self.specs}
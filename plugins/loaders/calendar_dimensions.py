@@ -0,0 +1,79 @@
+"""
+Calendar Dimensions - заполнение dim_date и dim_time набором SQL (generate_series)
+"""
+
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+from loaders.db_utils import as_date, fetch_scalar
+
+# Число строк полного dim_time (секунды суток)
+SECONDS_PER_DAY = 86400
+
+
+class CalendarDimensions:
+    """Поддержание календарных измерений DWH через populate_dim_date / populate_dim_time"""
+
+    def __init__(self, conn_id):
+        self.conn_id = conn_id
+        self.hook = PostgresHook(postgres_conn_id=self.conn_id)
+
+    def ensure_dates(self, start_date, end_date):
+        """
+        Заполнение dim_date на диапазон, если в нем есть пропущенные даты
+
+        Returns:
+            Число вставленных или обновленных строк
+        """
+        start_date, end_date = as_date(start_date), as_date(end_date)
+        expected = (end_date - start_date).days + 1
+
+        existing = self.hook.get_first(
+            "SELECT COUNT(*) FROM dim_date WHERE full_date BETWEEN %s AND %s",
+            parameters=(start_date, end_date)
+        )[0]
+        if existing >= expected:
+            return 0
+
+        return self.populate_dates(start_date, end_date)
+
+    def populate_dates(self, start_date, end_date):
+        """Генерация (или перегенерация признаков праздников) dim_date на диапазон"""
+        rows = self.hook.run(
+            "SELECT populate_dim_date(%s, %s)",
+            parameters=(as_date(start_date), as_date(end_date)),
+            handler=fetch_scalar
+        )
+        print(f"📅 dim_date {start_date}..{end_date}: {rows} строк")
+        return rows
+
+    def ensure_times(self):
+        """Заполнение dim_time, если таблица заполнена не полностью"""
+        existing = self.hook.get_first("SELECT COUNT(*) FROM dim_time")[0]
+        if existing >= SECONDS_PER_DAY:
+            return 0
+
+        rows = self.hook.run("SELECT populate_dim_time()", handler=fetch_scalar)
+        print(f"🕒 dim_time: {rows} строк")
+        return rows
+
+    def set_holidays(self, holidays):
+        """
+        Добавление праздников и перенесенных выходных с перегенерацией
+        только затронутых дат dim_date
+
+        Args:
+            holidays: dict {дата: название праздника}
+        """
+        if not holidays:
+            return 0
+
+        dates = sorted(as_date(day) for day in holidays)
+        self.hook.insert_rows(
+            'dim_holiday_calendar',
+            [(as_date(day), name) for day, name in holidays.items()],
+            target_fields=['holiday_date', 'holiday_name'],
+            replace=True,
+            replace_index='holiday_date'
+        )
+        return self.populate_dates(dates[0], dates[-1])
+
@@ -0,0 +1,28 @@
+"""
+DB Utils - общие помощники загрузчиков DWH: даты, ключи dim_date, обработчики hook.run
+"""
+from datetime import date, datetime
+
+
+def fetch_scalar(cursor):
+    """Обработчик hook.run: первое значение результата (run фиксирует транзакцию)"""
+    return cursor.fetchone()[0]
+
+
+def as_date(value):
+    """Дата из date / datetime / pandas.Timestamp / строки ISO"""
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    if hasattr(value, 'date') and callable(value.date):
+        return value.date()
+    return value
+
+
+def date_key(value):
+    """Ключ dim_date (YYYYMMDD) для даты"""
+    return int(as_date(value).strftime('%Y%m%d'))
+
+
+def from_date_key(key):
+    """Дата по ключу dim_date (YYYYMMDD)"""
+    return datetime.strptime(str(key), '%Y%m%d').date()
@@ -0,0 +1,58 @@
+"""
+Dimension Specs - описание SCD Type 2 измерений DWH
+"""
+
+
+class DimensionSpec:
+    """Описание измерения для SCDType2Handler"""
+
+    def __init__(self, table_name, natural_key, tracked_columns,
+                 type1_columns=None, column_kinds=None, source_system='postgres_source'):
+        """
+        Args:
+            table_name: Таблица измерения в DWH
+            natural_key: Натуральный ключ (из source системы)
+            tracked_columns: Атрибуты SCD Type 2 - изменение создает новую версию
+            type1_columns: Атрибуты SCD Type 1 - перезаписываются в текущей версии
+            column_kinds: Виды нестроковых колонок ('integer', 'numeric', 'date', ...)
+                          по типам таблицы; определяют нормализацию для хэша
+            source_system: Значение source_system для новых версий
+        """
+        self.table_name = table_name
+        self.natural_key = natural_key
+        self.tracked_columns = list(tracked_columns)
+        self.type1_columns = list(type1_columns or [])
+        self.source_system = source_system
+        self.column_kinds = {col: 'string' for col in self.columns}
+        self.column_kinds.update(column_kinds or {})
+
+    @property
+    def columns(self):
+        """Все загружаемые колонки измерения"""
+        return [self.natural_key] + self.tracked_columns + self.type1_columns
+
+    def __repr__(self):
+        return f"DimensionSpec({self.table_name}, key={self.natural_key})"
+
+
+CUSTOMERS_SPEC = DimensionSpec(
+    table_name='dim_customers',
+    natural_key='customer_id',
+    tracked_columns=['first_name', 'last_name', 'email', 'city'],
+    type1_columns=['phone', 'country', 'customer_segment', 'registration_date'],
+    column_kinds={'customer_id': 'integer', 'registration_date': 'date'},
+)
+
+PRODUCTS_SPEC = DimensionSpec(
+    table_name='dim_products',
+    natural_key='product_id',
+    tracked_columns=['product_name', 'category', 'subcategory', 'brand', 'unit_price', 'cost_price'],
+    type1_columns=['stock_quantity'],
+    column_kinds={'product_id': 'integer', 'unit_price': 'numeric', 'cost_price': 'numeric',
+                  'stock_quantity': 'integer'},
+)
+
+# Реестр измерений по имени таблицы
+DIMENSION_SPECS = {
+    spec.table_name: spec for spec in (CUSTOMERS_SPEC, PRODUCTS_SPEC)
+}
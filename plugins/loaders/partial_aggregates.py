@@ -0,0 +1,476 @@
+"""
+Partial Aggregates - сливаемые частичные агрегаты фактов заказов по дням
+
+Для каждого дня хранятся суммы и счетчики в разрезах (день целиком, город,
+категория, продукт) и множества идентификаторов заказов и клиентов - только
+в тех разрезах, где читается точное число уникальных (GRAIN_ID_SETS).
+Суммы складываются, множества объединяются, поэтому:
+- опоздавшие заказы добавляют дельту только в затронутые дни;
+- недельные и месячные итоги собираются из дневных частичных агрегатов,
+  включая точное число уникальных клиентов за период;
+- бэкфилл не требует повторного сканирования фактов за весь период.
+"""
+import zlib
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from psycopg2 import Binary
+from psycopg2.extras import execute_values
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+from loaders.aggregate_refresher import REFRESH_TABLE
+from loaders.db_utils import as_date, date_key, from_date_key
+from monitoring.stage_metrics import counting_connection
+
+PARTIALS_TABLE = 'agg_daily_partials'
+
+# Разрезы частичных агрегатов ('day' - весь день, значение разреза пустое)
+GRAINS = ('day', 'city', 'category', 'product')
+
+SUM_COLUMNS = ('line_count', 'quantity', 'total_amount', 'cost_amount', 'profit_amount')
+ID_SET_COLUMNS = ('order_ids', 'customer_ids', 'new_order_ids', 'cancelled_order_ids')
+# Мощности множеств заказов и клиентов (для агрегатов, читаемых из SQL)
+COUNT_COLUMNS = ('orders_count', 'customers_count')
+
+# Множества идентификаторов по разрезам: день - все (метрики дня и свертки
+# периодов), город и категория - заказы (заказы по городам, agg_daily_category_sales),
+# продукт - только суммы
+GRAIN_ID_SETS = {
+    'day': ID_SET_COLUMNS,
+    'city': ('order_ids',),
+    'category': ('order_ids',),
+    'product': (),
+}
+
+# Статусы заказа (dim_order_status.status_code) для отдельных счетчиков
+NEW_ORDER_STATUSES = ('PENDING',)
+CANCELLED_ORDER_STATUSES = ('CANCELLED',)
+
+UNKNOWN_CITY = 'Не указан'
+UNKNOWN_CATEGORY = 'Без категории'
+
+# Частичные агрегаты строк фактов source (fact_orders или временная таблица
+# той же структуры) за один проход: GROUPING SETS по всем разрезам,
+# идентификаторы заказов и клиентов - массивами только для разрезов GRAIN_ID_SETS
+PARTIALS_SQL = """
+SELECT date_key,
+       CASE WHEN GROUPING(city) = 0 THEN 'city'
+            WHEN GROUPING(category) = 0 THEN 'category'
+            WHEN GROUPING(product_id) = 0 THEN 'product'
+            ELSE 'day' END AS grain,
+       COALESCE(city, category, product_id::text, '') AS grain_value,
+       COUNT(*) AS line_count,
+       SUM(quantity) AS quantity,
+       SUM(total_amount) AS total_amount,
+       COALESCE(SUM(cost_amount), 0) AS cost_amount,
+       COALESCE(SUM(profit_amount), 0) AS profit_amount,
+       CASE WHEN GROUPING(product_id) = 1 THEN array_agg(DISTINCT order_id) END AS orders,
+       CASE WHEN GROUPING(city) + GROUPING(category) + GROUPING(product_id) = 3
+            THEN array_agg(DISTINCT customer_id) END AS customers,
+       CASE WHEN GROUPING(city) + GROUPING(category) + GROUPING(product_id) = 3
+            THEN array_agg(DISTINCT order_id) FILTER (WHERE order_status = ANY(%(new_statuses)s)) END AS new_orders,
+       CASE WHEN GROUPING(city) + GROUPING(category) + GROUPING(product_id) = 3
+            THEN array_agg(DISTINCT order_id) FILTER (WHERE order_status = ANY(%(cancelled_statuses)s)) END AS cancelled_orders
+FROM (
+    SELECT f.date_key, f.order_id, f.customer_id, f.product_id,
+           UPPER(f.order_status) AS order_status,
+           COALESCE(f.shipping_city, %(unknown_city)s) AS city,
+           COALESCE(p.category, %(unknown_category)s) AS category,
+           f.quantity, f.total_amount, f.cost_amount, f.profit_amount
+    FROM {source} f
+    LEFT JOIN dim_products p ON p.product_key = f.product_key
+    WHERE f.date_key IS NOT NULL {condition}
+) lines
+GROUP BY GROUPING SETS ((date_key), (date_key, city), (date_key, category), (date_key, product_id))
+"""
+
+
+class IdSet:
+    """
+    Точное множество целых идентификаторов: отсортированный массив уникальных
+    значений (размер - число элементов, а не диапазон идентификаторов)
+
+    Сериализуется в BYTEA: разности соседних значений (int64), сжатые zlib.
+    """
+
+    def __init__(self, ids=None):
+        self.ids = np.zeros(0, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+
+    @classmethod
+    def from_ids(cls, ids):
+        return cls(np.unique(np.asarray([i for i in (ids or []) if i is not None], dtype=np.int64)))
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls()
+        deltas = np.frombuffer(zlib.decompress(bytes(data)), dtype=np.int64)
+        return cls(np.cumsum(deltas))
+
+    def to_bytes(self):
+        return zlib.compress(np.diff(self.ids, prepend=0).tobytes())
+
+    def __or__(self, other):
+        return IdSet(np.union1d(self.ids, other.ids))
+
+    def __sub__(self, other):
+        return IdSet(np.setdiff1d(self.ids, other.ids, assume_unique=True))
+
+    def __len__(self):
+        return int(self.ids.size)
+
+
+class PartialAggregate:
+    """Суммы и множества идентификаторов одного разреза (день / город / категория / продукт)"""
+
+    def __init__(self, sums=None, id_sets=None):
+        self.sums = {col: (sums or {}).get(col) or 0 for col in SUM_COLUMNS}
+        self.id_sets = dict(id_sets or {})
+
+    def merge(self, other):
+        """Добавление другого частичного агрегата (дельта или соседний день)"""
+        for col in SUM_COLUMNS:
+            self.sums[col] += other.sums[col]
+        for col, ids in other.id_sets.items():
+            self.id_sets[col] = self.id_sets.get(col, IdSet()) | ids
+        return self
+
+    def retract(self, removed):
+        """
+        Вычитание агрегата замененных строк фактов
+
+        Заказы замененных строк снимаются с множеств заказов (строки тех же
+        заказов возвращаются дельтой вставки); клиенты не снимаются -
+        у клиента могут быть другие заказы в этот день.
+        """
+        for col in SUM_COLUMNS:
+            self.sums[col] -= removed.sums[col]
+        for col, ids in removed.id_sets.items():
+            if col != 'customer_ids' and col in self.id_sets:
+                self.id_sets[col] = self.id_sets[col] - ids
+        return self
+
+    def count(self, id_set_column):
+        """Число уникальных идентификаторов (None, если в разрезе множество не хранится)"""
+        ids = self.id_sets.get(id_set_column)
+        return len(ids) if ids is not None else None
+
+
+class PartialAggregateStore:
+    """Таблица частичных агрегатов в DWH: дельты при загрузке фактов, перестроение, чтение и свертки"""
+
+    def __init__(self, conn_id, table_name=PARTIALS_TABLE):
+        self.conn_id = conn_id
+        self.table_name = table_name
+        self.hook = PostgresHook(postgres_conn_id=self.conn_id)
+
+    def ensure_backfilled(self):
+        """
+        Однократное полное построение агрегатов по всему диапазону fact_orders
+
+        Дельты merge_delta верны только поверх полных агрегатов дня: без
+        бэкфилла день, факты которого загружены до появления таблицы
+        агрегатов, получил бы только дельту очередной загрузки. Выполнение
+        отмечается в etl_aggregate_refresh; блокировка отметки сериализует
+        параллельные запуски. Вызывается до транзакции загрузки фактов.
+
+        Returns:
+            Число строк агрегатов (0, если бэкфилл уже выполнен)
+        """
+        conn = counting_connection(self.hook.get_conn())
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"INSERT INTO {REFRESH_TABLE} (aggregate_name) VALUES (%s) ON CONFLICT DO NOTHING",
+                (self.table_name,)
+            )
+            cursor.execute(
+                f"SELECT last_load_date FROM {REFRESH_TABLE} WHERE aggregate_name = %s FOR UPDATE",
+                (self.table_name,)
+            )
+            if cursor.fetchone()[0] is not None:
+                conn.rollback()
+                return 0
+
+            cursor.execute("SELECT MIN(date_key), MAX(date_key) FROM fact_orders")
+            start_key, end_key = cursor.fetchone()
+            rows, days = 0, 0
+            cursor.execute(f"DELETE FROM {self.table_name}")
+            if start_key is not None:
+                rows, days = self._rebuild_range(cursor, start_key, end_key)
+
+            cursor.execute(f"""
+                UPDATE {REFRESH_TABLE}
+                SET last_load_date = CURRENT_DATE, days_refreshed = %s, refreshed_at = CURRENT_TIMESTAMP
+                WHERE aggregate_name = %s
+            """, (days, self.table_name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        print(f"🧮 Бэкфилл частичных агрегатов: {rows} строк за {days} дн. ({start_key}..{end_key})")
+        return rows
+
+    def merge_delta(self, cursor, added_source, removed_source=None):
+        """
+        Слияние дельты загрузки фактов с хранимыми агрегатами затронутых дней
+
+        Выполняется курсором транзакции загрузки фактов (before_commit),
+        поэтому агрегаты фиксируются вместе с фактами.
+
+        Args:
+            cursor: Курсор транзакции загрузки
+            added_source: Таблица вставленных строк фактов (например, stg_fact_orders)
+            removed_source: Таблица замененных (удаленных) строк фактов
+
+        Returns:
+            Число обновленных строк агрегатов
+        """
+        added = self._compute(cursor, added_source)
+        removed = self._compute(cursor, removed_source) if removed_source else {}
+        keys = set(added) | set(removed)
+        if not keys:
+            return 0
+
+        cursor.execute(
+            f"SELECT * FROM {self.table_name} WHERE date_key = ANY(%s) FOR UPDATE",
+            (sorted({key[0] for key in keys}),)
+        )
+        existing = self._rows_to_partials(cursor)
+
+        merged = {}
+        for key in keys:
+            partial = existing.get(key, PartialAggregate())
+            if key in removed:
+                partial.retract(removed[key])
+            if key in added:
+                partial.merge(added[key])
+            merged[key] = partial
+
+        self._write(cursor, merged)
+        print(f"🧮 Частичные агрегаты: {len(merged)} строк за {len({key[0] for key in keys})} дн.")
+        return len(merged)
+
+    def rebuild(self, start_date, end_date, before_commit=None):
+        """
+        Перестроение агрегатов диапазона дат по fact_orders (бэкфилл)
+
+        Args:
+            start_date: Первая дата диапазона
+            end_date: Последняя дата диапазона (включительно)
+            before_commit: Функция от курсора, выполняемая в той же транзакции
+                           после перестроения (например, пересчет агрегатов продаж)
+
+        Returns:
+            Число строк агрегатов
+        """
+        start_key, end_key = date_key(start_date), date_key(end_date)
+
+        conn = counting_connection(self.hook.get_conn())
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"DELETE FROM {self.table_name} WHERE date_key BETWEEN %s AND %s",
+                (start_key, end_key)
+            )
+            rows, _ = self._rebuild_range(cursor, start_key, end_key)
+            if before_commit is not None:
+                before_commit(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        print(f"🧮 Агрегаты {start_key}..{end_key} перестроены: {rows} строк")
+        return rows
+
+    def _rebuild_range(self, cursor, start_key, end_key):
+        """
+        Агрегаты fact_orders диапазона date_key помесячно (память ограничена
+        одним месяцем); старые строки диапазона удаляет вызывающий
+
+        Returns:
+            (число строк агрегатов, число дней)
+        """
+        rows, days = 0, set()
+        month = from_date_key(start_key).replace(day=1)
+        while date_key(month) <= end_key:
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            partials = self._compute(
+                cursor, 'fact_orders', 'AND f.date_key BETWEEN %(start_key)s AND %(end_key)s',
+                {'start_key': max(start_key, date_key(month)),
+                 'end_key': min(end_key, date_key(next_month - timedelta(days=1)))}
+            )
+            self._write(cursor, partials)
+            rows += len(partials)
+            days.update(key[0] for key in partials)
+            month = next_month
+        return rows, len(days)
+
+    def read(self, start_date, end_date):
+        """
+        Частичные агрегаты диапазона дат
+
+        Returns:
+            dict {(date_key, grain, grain_value): PartialAggregate}
+        """
+        conn = counting_connection(self.hook.get_conn())
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT * FROM {self.table_name} WHERE date_key BETWEEN %s AND %s",
+                    (date_key(start_date), date_key(end_date))
+                )
+                return self._rows_to_partials(cursor)
+        finally:
+            conn.close()
+
+    def daily(self, dates, rebuild_missing=True):
+        """
+        Агрегаты по дням
+
+        Args:
+            dates: Даты
+            rebuild_missing: Дни без агрегатов перестраиваются по fact_orders
+                             (полноту дней с агрегатами обеспечивает
+                             ensure_backfilled до первой дельты)
+
+        Returns:
+            dict {дата: {grain: {grain_value: PartialAggregate}}}
+        """
+        days = sorted({as_date(day) for day in dates})
+        if not days:
+            return {}
+
+        partials = self.read(days[0], days[-1])
+        present = {key[0] for key in partials}
+        missing = [day for day in days if date_key(day) not in present]
+        if rebuild_missing and missing:
+            for day in missing:
+                self.rebuild(day, day)
+            partials = self.read(days[0], days[-1])
+
+        result = {}
+        for day in days:
+            grains = self._group(partials, lambda key, day_key=date_key(day): key == day_key)
+            if grains:
+                result[day] = grains
+        return result
+
+    def rollup(self, start_date, end_date, period='month'):
+        """
+        Свертка дневных агрегатов в недельные или месячные
+
+        Returns:
+            dict {начало периода: {grain: {grain_value: PartialAggregate}}}
+        """
+        if period not in ('week', 'month'):
+            raise ValueError(f"Неизвестный период свертки: {period}")
+
+        partials = self.read(start_date, end_date)
+        periods = {period_start(from_date_key(key[0]), period) for key in partials}
+        return {
+            start: self._group(partials, lambda key, start=start: period_start(from_date_key(key), period) == start)
+            for start in sorted(periods)
+        }
+
+    def product_names(self, product_ids):
+        """Названия текущих версий продуктов"""
+        ids = [int(product_id) for product_id in product_ids if product_id is not None]
+        if not ids:
+            return {}
+        rows = self.hook.get_records(
+            "SELECT product_id, product_name FROM dim_products WHERE is_current = TRUE AND product_id = ANY(%s)",
+            parameters=(ids,)
+        )
+        return dict(rows)
+
+    def _compute(self, cursor, source, condition='', params=None):
+        """Частичные агрегаты строк таблицы source"""
+        cursor.execute(PARTIALS_SQL.format(source=source, condition=condition), {
+            'new_statuses': list(NEW_ORDER_STATUSES),
+            'cancelled_statuses': list(CANCELLED_ORDER_STATUSES),
+            'unknown_city': UNKNOWN_CITY,
+            'unknown_category': UNKNOWN_CATEGORY,
+            **(params or {}),
+        })
+
+        partials = {}
+        for row in cursor.fetchall():
+            key = (row[0], row[1], row[2])
+            id_arrays = dict(zip(ID_SET_COLUMNS, row[8:12]))
+            partials[key] = PartialAggregate(
+                sums=dict(zip(SUM_COLUMNS, row[3:8])),
+                id_sets={col: IdSet.from_ids(id_arrays[col]) for col in GRAIN_ID_SETS[row[1]]}
+            )
+        return partials
+
+    def _rows_to_partials(self, cursor):
+        """Строки таблицы агрегатов (SELECT *) -> dict ключ -> PartialAggregate"""
+        columns = [desc[0] for desc in cursor.description]
+        partials = {}
+        for values in cursor.fetchall():
+            row = dict(zip(columns, values))
+            partials[(row['date_key'], row['grain'], row['grain_value'])] = PartialAggregate(
+                sums={col: row[col] for col in SUM_COLUMNS},
+                id_sets={col: IdSet.from_bytes(row[col]) for col in GRAIN_ID_SETS[row['grain']]}
+            )
+        return partials
+
+    def _write(self, cursor, partials):
+        """Upsert агрегатов; разрезы без строк фактов удаляются"""
+        empty = [key for key, partial in partials.items() if partial.sums['line_count'] <= 0]
+        if empty:
+            execute_values(cursor, f"""
+                DELETE FROM {self.table_name} t
+                USING (VALUES %s) AS e(date_key, grain, grain_value)
+                WHERE t.date_key = e.date_key AND t.grain = e.grain AND t.grain_value = e.grain_value
+            """, empty)
+
+        rows = [
+            key + tuple(partial.sums[col] for col in SUM_COLUMNS)
+            + (partial.count('order_ids'), partial.count('customer_ids'))
+            + tuple(Binary(partial.id_sets[col].to_bytes()) if col in partial.id_sets else None
+                    for col in ID_SET_COLUMNS)
+            for key, partial in partials.items() if partial.sums['line_count'] > 0
+        ]
+        if not rows:
+            return
+
+        value_columns = SUM_COLUMNS + COUNT_COLUMNS + ID_SET_COLUMNS
+        columns = ('date_key', 'grain', 'grain_value') + value_columns
+        updates = ', '.join(f"{col} = EXCLUDED.{col}" for col in value_columns)
+        execute_values(cursor, f"""
+            INSERT INTO {self.table_name} ({', '.join(columns)})
+            VALUES %s
+            ON CONFLICT (date_key, grain, grain_value) DO UPDATE SET
+                {updates},
+                updated_at = CURRENT_TIMESTAMP
+        """, rows)
+
+    @staticmethod
+    def _group(partials, match_date_key):
+        """Объединение агрегатов подходящих дней по разрезам"""
+        grains = defaultdict(dict)
+        for (key, grain, value), partial in partials.items():
+            if not match_date_key(key):
+                continue
+            target = grains[grain].setdefault(value, PartialAggregate())
+            target.merge(partial)
+        return dict(grains)
+
+
+def period_start(day, period):
+    """Первый день недели (понедельник) или месяца"""
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
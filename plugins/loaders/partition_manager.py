@@ -0,0 +1,183 @@
+"""
+Partition Manager - месячные секции таблиц фактов по date_key
+
+Секции создаются функцией create_monthly_partitions (init_dwh.sql) и
+называются {таблица}_yYYYYmMM. Загрузка пишет строки прямо в секции их
+месяцев, бэкфилл месяца собирается в отдельной таблице и подменяет секцию
+через DETACH / ATTACH PARTITION.
+"""
+from datetime import date
+
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+from loaders.db_utils import as_date, date_key, fetch_scalar
+from monitoring.stage_metrics import counting_connection
+
+# Таблицы фактов, секционированные по месяцам date_key
+PARTITIONED_FACTS = ('fact_orders', 'fact_payments')
+
+# На сколько месяцев вперед держать пустые секции
+DEFAULT_MONTHS_AHEAD = 3
+
+
+class PartitionManager:
+    """Секции одной таблицы фактов: создание, запись по секциям, подмена секции"""
+
+    def __init__(self, conn_id, table_name):
+        self.conn_id = conn_id
+        self.table_name = table_name
+        self.hook = PostgresHook(postgres_conn_id=self.conn_id)
+
+    def partition_name(self, month):
+        """Имя секции месяца"""
+        month = month_start(month)
+        return f"{self.table_name}_y{month:%Y}m{month:%m}"
+
+    def ensure_partitions(self, start_date, end_date):
+        """
+        Создание недостающих секций на диапазон дат
+
+        Returns:
+            Число созданных секций
+        """
+        created = self.hook.run(
+            "SELECT create_monthly_partitions(%s, %s, %s)",
+            parameters=(self.table_name, as_date(start_date), as_date(end_date)),
+            handler=fetch_scalar
+        )
+        if created:
+            print(f"🗂 {self.table_name}: создано секций {created} ({start_date}..{end_date})")
+        return created
+
+    def ensure_future(self, months_ahead=DEFAULT_MONTHS_AHEAD):
+        """Секции от текущего месяца на months_ahead месяцев вперед"""
+        today = date.today()
+        return self.ensure_partitions(today, add_months(month_start(today), months_ahead))
+
+    def ensure_for_keys(self, date_keys):
+        """Секции для всех месяцев набора date_key"""
+        months = months_for_keys(date_keys)
+        if not months:
+            return 0
+        return self.ensure_partitions(months[0], months[-1])
+
+    def insert_by_partition_sql(self, source, columns, date_keys):
+        """
+        SQL переноса строк source прямо в секции их месяцев (без маршрутизации
+        через родительскую таблицу)
+
+        Args:
+            source: Таблица-источник (например, stg_fact_orders)
+            columns: Переносимые колонки
+            date_keys: date_key строк source - определяют затрагиваемые секции
+        """
+        column_list = ', '.join(columns)
+        statements = []
+        for month in months_for_keys(date_keys):
+            lower, upper = month_bounds(month)
+            statements.append(
+                f"INSERT INTO {self.partition_name(month)} ({column_list}) "
+                f"SELECT {column_list} FROM {source} "
+                f"WHERE date_key >= {lower} AND date_key < {upper};"
+            )
+        return '\n'.join(statements)
+
+    def swap_partition(self, month, fill, keep_old=False):
+        """
+        Подмена секции месяца пересобранной таблицей (бэкфилл)
+
+        Новая таблица создается как копия родительской (INCLUDING ALL:
+        умолчания, CHECK, первичный ключ и индексы) с CHECK по границам
+        секции до заполнения; после заполнения на нее добавляются внешние
+        ключи родительской таблицы. Поэтому ATTACH не сканирует таблицу
+        и не строит индексы - подмена (DETACH старой, ATTACH новой) остается
+        короткой транзакцией, читатели видят либо старую, либо новую секцию.
+
+        Args:
+            month: Любая дата месяца секции
+            fill: Функция (имя новой таблицы) -> число строк; заполняет таблицу
+                  своим соединением (например, PostgresCopyLoader.load в режиме 'append')
+            keep_old: Сохранить старую секцию как {секция}_old вместо удаления
+
+        Returns:
+            Число строк в новой секции
+        """
+        name = self.partition_name(month)
+        staged, old = f"{name}_new", f"{name}_old"
+        lower, upper = month_bounds(month)
+
+        self.hook.run([
+            f"DROP TABLE IF EXISTS {staged}",
+            f"CREATE TABLE {staged} (LIKE {self.table_name} INCLUDING ALL)",
+            # CHECK по границам секции: строки вне месяца отклоняются при заполнении,
+            # ATTACH не сканирует таблицу для проверки
+            f"ALTER TABLE {staged} ADD CONSTRAINT {staged}_bounds "
+            f"CHECK (date_key >= {lower} AND date_key < {upper})",
+        ])
+        try:
+            rows = fill(staged)
+            foreign_keys = self.hook.get_records("""
+                SELECT conname, pg_get_constraintdef(oid)
+                FROM pg_constraint
+                WHERE conrelid = %s::regclass AND contype = 'f'
+            """, parameters=(self.table_name,))
+            # Внешние ключи проверяются здесь, а не под блокировкой ATTACH
+            self.hook.run(
+                [f"ALTER TABLE {staged} ADD CONSTRAINT {staged}_{conname} {definition}"
+                 for conname, definition in foreign_keys]
+                + [f"ANALYZE {staged}"]
+            )
+        except Exception:
+            self.hook.run(f"DROP TABLE IF EXISTS {staged}")
+            raise
+
+        conn = counting_connection(self.hook.get_conn())
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SET LOCAL lock_timeout = '10s'")
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+            if cursor.fetchone()[0]:
+                cursor.execute(f"ALTER TABLE {self.table_name} DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE IF EXISTS {old}")
+                cursor.execute(f"ALTER TABLE {name} RENAME TO {old}")
+            cursor.execute(f"ALTER TABLE {staged} RENAME TO {name}")
+            cursor.execute(
+                f"ALTER TABLE {self.table_name} ATTACH PARTITION {name} FOR VALUES FROM ({lower}) TO ({upper})"
+            )
+            cursor.execute(f"ALTER TABLE {name} DROP CONSTRAINT {staged}_bounds")
+            if not keep_old:
+                cursor.execute(f"DROP TABLE IF EXISTS {old}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        print(f"🔁 Секция {name} подменена: {rows} строк")
+        return rows
+
+
+def months_for_keys(date_keys):
+    """Первые дни месяцев набора date_key (YYYYMMDD), по возрастанию"""
+    return sorted({
+        date(int(key) // 10000, int(key) // 100 % 100, 1)
+        for key in date_keys if key is not None
+    })
+
+
+def month_bounds(month):
+    """Границы секции месяца в date_key: [первый день, первый день следующего)"""
+    start = month_start(month)
+    return date_key(start), date_key(add_months(start, 1))
+
+
+def month_start(value):
+    return as_date(value).replace(day=1)
+
+
+def add_months(month, months):
+    total = month.year * 12 + month.month - 1 + months
+    return date(total // 12, total % 12 + 1, 1)
+
@@ -0,0 +1,317 @@
+"""
+PostgreSQL COPY Loader - массовая загрузка DataFrame через COPY FROM STDIN
+"""
+import io
+import pandas as pd
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+from loaders.base_loader import BaseLoader
+from transformers.row_hasher import compute_row_hash
+from transformers.column_coercer import parse_column_type
+from monitoring.stage_metrics import report, counting_connection
+
+# Маркер NULL в CSV-потоке COPY (пустая строка остается пустой строкой)
+COPY_NULL = '\\N'
+
+LOAD_MODES = ('append', 'truncate', 'staging', 'merge')
+
+# Колонка с дайджестом строки для режима 'merge'
+DIGEST_COLUMN = 'row_digest'
+
+
+class PostgresCopyLoader(BaseLoader):
+    """Загрузка данных в PostgreSQL через COPY из буфера в памяти"""
+
+    def __init__(self, conn_id=None, table_name=None, mode='append'):
+        """
+        Args:
+            conn_id: ID подключения Airflow
+            table_name: Целевая таблица по умолчанию
+            mode: 'append' - дозапись в таблицу;
+                  'truncate' - TRUNCATE и загрузка в одной транзакции;
+                  'staging' - загрузка во временную таблицу LIKE целевой
+                  (соединение остается открытым, таблица живет до close());
+                  'merge' - загрузка полного снимка во временную таблицу и
+                  применение к целевой только вставок, изменившихся (по дайджесту
+                  строки) и удаленных ключей в одной транзакции
+        """
+        super().__init__(conn_id=conn_id)
+        self.table_name = table_name
+        self.mode = mode
+
+    def connect(self):
+        """Установка соединения с целевой БД"""
+        if self.connection is None:
+            self.connection = counting_connection(PostgresHook(postgres_conn_id=self.conn_id).get_conn())
+        return self.connection
+
+    def close(self):
+        """Закрытие соединения"""
+        super().close()
+        self.connection = None
+
+    def get_column_types(self, table_name=None, columns=None):
+        """
+        Типы колонок целевой таблицы из information_schema
+
+        Args:
+            table_name: Таблица (по умолчанию self.table_name)
+            columns: Нужные колонки в требуемом порядке (по умолчанию все колонки таблицы)
+
+        Returns:
+            dict {колонка: тип PostgreSQL}, например {'category': 'character varying(100)'}
+        """
+        table_name = table_name or self.table_name
+        rows = PostgresHook(postgres_conn_id=self.conn_id).get_records("""
+            SELECT column_name,
+                   data_type
+                   || CASE
+                        WHEN character_maximum_length IS NOT NULL
+                            THEN '(' || character_maximum_length || ')'
+                        WHEN data_type = 'numeric' AND numeric_precision IS NOT NULL
+                            THEN '(' || numeric_precision || ',' || numeric_scale || ')'
+                        ELSE ''
+                      END
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s
+            ORDER BY ordinal_position
+        """, parameters=(table_name,))
+        types = dict(rows)
+
+        if columns is None:
+            return types
+        missing = [col for col in columns if col not in types]
+        if missing:
+            raise ValueError(f"В таблице {table_name} нет колонок: {missing}")
+        return {col: types[col] for col in columns}
+
+    def get_column_kinds(self, table_name=None):
+        """
+        Виды колонок таблицы для нормализации перед хэшированием
+        ('integer', 'numeric', 'string', ...; неразобранные типы - 'string')
+        """
+        kinds = {}
+        for column, sql_type in self.get_column_types(table_name).items():
+            try:
+                kinds[column] = parse_column_type(sql_type)['kind']
+            except ValueError:
+                kinds[column] = 'string'
+        return kinds
+
+    def load(self, data, table_name=None, columns=None, mode=None,
+             staging_table=None, merge_sql=None, parameters=None, key_columns=None,
+             before_commit=None):
+        """
+        Загрузка DataFrame или итератора DataFrame-порций
+
+        Args:
+            data: DataFrame или итератор DataFrame
+            table_name: Целевая таблица (по умолчанию self.table_name)
+            columns: Загружаемые колонки (по умолчанию - колонки первой порции)
+            mode: Режим загрузки (по умолчанию self.mode)
+            staging_table: Имя временной таблицы для режима 'staging'
+            merge_sql: SQL, выполняемый после загрузки в той же транзакции
+                       (в режиме 'staging' - перенос из временной таблицы в целевую)
+            parameters: Параметры для merge_sql
+            key_columns: Ключ строки для режима 'merge'
+            before_commit: Функция cursor -> None, выполняемая перед COMMIT
+                           (например, сдвиг watermark в той же транзакции)
+
+        Returns:
+            dict со статистикой загрузки
+        """
+        table_name = table_name or self.table_name
+        mode = mode or self.mode
+        if not table_name:
+            raise ValueError("Не указана целевая таблица")
+        if mode not in LOAD_MODES:
+            raise ValueError(f"Неизвестный режим загрузки: {mode}")
+
+        if mode == 'merge' and not key_columns:
+            raise ValueError("Для режима merge нужны key_columns")
+
+        column_kinds = None
+        if mode == 'merge':
+            self.ensure_digest_column(table_name)
+            column_kinds = self.get_column_kinds(table_name)
+
+        chunks = [data] if isinstance(data, pd.DataFrame) else data
+        target = table_name
+        if mode in ('staging', 'merge'):
+            target = staging_table or f"stg_{table_name}"
+
+        owns_connection = self.connection is None
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        stats = {
+            'table': table_name,
+            'target': target,
+            'mode': mode,
+            'rows_loaded': 0,
+            'chunks': 0,
+            'merged_rows': None
+        }
+
+        print(f"📦 COPY в {target} (режим {mode})...")
+        try:
+            if mode == 'truncate':
+                cursor.execute(f"TRUNCATE TABLE {table_name} RESTART IDENTITY")
+            elif mode == 'staging':
+                cursor.execute(f"DROP TABLE IF EXISTS {target}")
+                cursor.execute(f"CREATE TEMP TABLE {target} (LIKE {table_name} INCLUDING DEFAULTS)")
+            elif mode == 'merge':
+                cursor.execute(f"DROP TABLE IF EXISTS {target}")
+                # Умолчания нужны для ключей SERIAL и колонок, которых нет в COPY (LIKE копирует NOT NULL)
+                cursor.execute(f"CREATE TEMP TABLE {target} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP")
+
+            merge_columns = None
+            for chunk in chunks:
+                if chunk is None or chunk.empty:
+                    continue
+                chunk_columns = list(columns or chunk.columns)
+                chunk = chunk[chunk_columns]
+                if mode == 'merge':
+                    merge_columns = chunk_columns
+                    chunk = chunk.assign(**{DIGEST_COLUMN: compute_row_hash(chunk, chunk_columns, column_kinds)})
+                    chunk_columns = chunk_columns + [DIGEST_COLUMN]
+                self._copy_chunk(cursor, target, chunk, chunk_columns)
+                stats['rows_loaded'] += len(chunk)
+                stats['chunks'] += 1
+
+            if mode == 'merge' and stats['rows_loaded'] == 0:
+                # Пустой снимок скорее означает сбой источника - таблицу не очищаем
+                print(f"⚠ Пустой снимок для {table_name}, merge пропущен")
+            elif mode == 'merge':
+                stats.update(self._merge_snapshot(
+                    cursor, table_name, target, merge_columns, list(key_columns)
+                ))
+                stats['merged_rows'] = stats['inserted'] + stats['updated'] + stats['deleted']
+
+            if merge_sql:
+                cursor.execute(merge_sql, parameters)
+                stats['merged_rows'] = cursor.rowcount
+
+            if before_commit is not None:
+                before_commit(cursor)
+
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Ошибка COPY в {target}: {e}")
+            raise
+        finally:
+            cursor.close()
+            if owns_connection and mode != 'staging':
+                self.close()
+
+        print(f"✅ COPY завершен: {stats['rows_loaded']} строк, порций: {stats['chunks']}")
+        return stats
+
+    def ensure_digest_column(self, table_name=None):
+        """
+        Колонка дайджеста для режима 'merge' (обычно создается вместе с таблицей)
+
+        Наличие проверяется по каталогу; ALTER TABLE выполняется только при
+        отсутствии колонки, отдельной короткой транзакцией до загрузки, чтобы
+        блокировка ACCESS EXCLUSIVE не держалась на время COPY и merge.
+        """
+        table_name = table_name or self.table_name
+        hook = PostgresHook(postgres_conn_id=self.conn_id)
+        exists = hook.get_first("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+        """, parameters=(table_name, DIGEST_COLUMN))
+        if exists:
+            return False
+
+        hook.run([
+            "SET lock_timeout = '5s'",
+            f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {DIGEST_COLUMN} BIGINT",
+        ])
+        print(f"🧩 В {table_name} добавлена колонка {DIGEST_COLUMN}")
+        return True
+
+    def _merge_snapshot(self, cursor, table_name, staging, columns, key_columns):
+        """
+        Применение снимка из временной таблицы к целевой: удаление
+        отсутствующих ключей, обновление строк с другим дайджестом и вставка
+        новых ключей; строки с совпадающим дайджестом не переписываются
+        """
+        # Дубликаты ключа в снимке: остается последняя загруженная строка
+        cursor.execute(f"""
+            DELETE FROM {staging} s
+            USING {staging} d
+            WHERE {' AND '.join(f's.{col} = d.{col}' for col in key_columns)}
+              AND s.ctid < d.ctid
+        """)
+
+        key_match = ' AND '.join(f't.{col} = s.{col}' for col in key_columns)
+        value_columns = [col for col in columns if col not in key_columns]
+
+        cursor.execute(f"""
+            DELETE FROM {table_name} t
+            WHERE NOT EXISTS (SELECT 1 FROM {staging} s WHERE {key_match})
+        """)
+        deleted = cursor.rowcount
+
+        updated = 0
+        if value_columns:
+            cursor.execute(f"""
+                UPDATE {table_name} t SET
+                    {', '.join(f'{col} = s.{col}' for col in value_columns + [DIGEST_COLUMN])}
+                FROM {staging} s
+                WHERE {key_match}
+                  AND t.{DIGEST_COLUMN} IS DISTINCT FROM s.{DIGEST_COLUMN}
+            """)
+            updated = cursor.rowcount
+
+        insert_columns = ', '.join(columns + [DIGEST_COLUMN])
+        cursor.execute(f"""
+            INSERT INTO {table_name} ({insert_columns})
+            SELECT {', '.join(f's.{col}' for col in columns + [DIGEST_COLUMN])}
+            FROM {staging} s
+            WHERE NOT EXISTS (SELECT 1 FROM {table_name} t WHERE {key_match})
+        """)
+        inserted = cursor.rowcount
+
+        cursor.execute(f"SELECT COUNT(*) FROM {staging}")
+        total = cursor.fetchone()[0]
+
+        print(f"🔀 Merge {table_name}: +{inserted} / ~{updated} / -{deleted}, "
+              f"без изменений {total - inserted - updated}")
+        return {
+            'inserted': inserted,
+            'updated': updated,
+            'deleted': deleted,
+            'unchanged': total - inserted - updated
+        }
+
+    def _copy_chunk(self, cursor, target, chunk, columns):
+        """COPY одной порции через CSV-буфер в памяти"""
+        buffer = io.StringIO()
+        _prepare_for_copy(chunk).to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+        size = buffer.tell()
+        buffer.seek(0)
+
+        cursor.copy_expert(
+            f"COPY {target} ({', '.join(columns)}) FROM STDIN "
+            f"WITH (FORMAT csv, NULL '{COPY_NULL}')",
+            buffer
+        )
+        report(rows_out=len(chunk), bytes_moved=size)
+
+
+def _prepare_for_copy(chunk):
+    """
+    Float-колонки с целыми значениями (целые с NaN после pandas) выводятся
+    без '.0', чтобы COPY принял их в INTEGER-колонки
+    """
+    prepared = chunk
+    for col in chunk.columns[chunk.dtypes.apply(pd.api.types.is_float_dtype)]:
+        values = chunk[col].dropna()
+        if not values.empty and (values == values.round()).all():
+            if prepared is chunk:
+                prepared = chunk.copy()
+            prepared[col] = chunk[col].astype('Int64')
+    return prepared
@@ -1,22 +1,66 @@
 """
-SCD Type 2 Handler - адаптирован под структуру таблицы dim_customers
+SCD Type 2 Handler - универсальная обработка измерений по DimensionSpec
 """
 import pandas as pd
+import numpy as np
 from datetime import date, datetime
+from psycopg2.extras import execute_values
 from airflow.providers.postgres.hooks.postgres import PostgresHook
 
+from transformers.row_hasher import compute_row_hash
+from monitoring.stage_metrics import counting_connection
+from loaders.dimension_specs import DIMENSION_SPECS
+
+# Колонка с хэшем атрибутов SCD Type 2
+HASH_COLUMN = 'attr_hash'
+
+# Колонка с хэшем атрибутов SCD Type 1
+TYPE1_HASH_COLUMN = 'type1_hash'
+
+# Размер страницы для пакетной вставки во временную таблицу
+STAGE_PAGE_SIZE = 10000
+
 class SCDType2Handler:
     """Обработчик SCD Type 2 для измерений"""
     
-    def __init__(self, conn_id, table_name, natural_key):
+    def __init__(self, conn_id, table_name=None, natural_key=None, spec=None):
+        """
+        Args:
+            conn_id: ID подключения Airflow к DWH
+            table_name: Таблица измерения (спецификация берется из DIMENSION_SPECS)
+            natural_key: Натуральный ключ (для проверки согласованности со спецификацией)
+            spec: DimensionSpec - явная спецификация измерения
+        """
+        if spec is None:
+            if table_name not in DIMENSION_SPECS:
+                raise ValueError(f"Нет спецификации измерения для таблицы {table_name}")
+            spec = DIMENSION_SPECS[table_name]
+        if natural_key and natural_key != spec.natural_key:
+            raise ValueError(f"Натуральный ключ {natural_key} не совпадает со спецификацией {spec}")
+        
         self.conn_id = conn_id
-        self.table_name = table_name
-        self.natural_key = natural_key
+        self.spec = spec
+        self.table_name = spec.table_name
+        self.natural_key = spec.natural_key
         self.hook = PostgresHook(postgres_conn_id=self.conn_id)
+        self._current_hashes = None
     
-    def process_dimension(self, new_data, effective_date=None):
+    def process_dimension(self, new_data, effective_date=None, before_commit=None):
         """
-        Обработка измерения dim_customers с учетом структуры таблицы
+        Set-based обработка измерения: пакет загружается во временную таблицу,
+        затем изменения применяются несколькими UPDATE ... FROM / INSERT ... SELECT
+        в одной транзакции.
+        
+        Изменения определяются сравнением хэшей атрибутов с хэшами текущей
+        версии; строки без изменений отбрасываются до любой записи в БД.
+        Изменение атрибутов SCD Type 2 закрывает текущую версию и открывает
+        новую, изменение атрибутов SCD Type 1 перезаписывает текущую версию.
+        
+        Args:
+            new_data: DataFrame с новыми данными измерения
+            effective_date: Дата начала действия новых версий
+            before_commit: Функция от курсора, выполняемая в той же транзакции
+                           перед фиксацией (например, сдвиг watermark)
         """
         if effective_date is None:
             effective_date = date.today()
@@ -26,99 +70,119 @@ class SCDType2Handler:
         results = {
             'new_records': 0,
             'updated_records': 0,
-            'unchanged_records': 0
+            'unchanged_records': 0,
+            'overwritten_records': 0
         }
         
-        conn = self.hook.get_conn()
+        batch = self._prepare_batch(new_data)
+        if batch.empty and before_commit is None:
+            print("⚠ Нет данных для обработки")
+            return results
+        
+        # Отбрасываем строки, хэши которых совпадают с текущей версией
+        current_hashes = self._get_current_hashes()
+        if current_hashes and not batch.empty:
+            known = pd.MultiIndex.from_tuples(
+                [(key,) + hashes for key, hashes in current_hashes.items()]
+            )
+            incoming = pd.MultiIndex.from_arrays([
+                batch[self.natural_key], batch[HASH_COLUMN], batch[TYPE1_HASH_COLUMN]
+            ])
+            unchanged_mask = incoming.isin(known)
+        else:
+            unchanged_mask = np.zeros(len(batch), dtype=bool)
+        unchanged_count = int(unchanged_mask.sum())
+        batch = batch[~unchanged_mask]
+        print(f"⏭ Без изменений по хэшу: {unchanged_count} записей")
+        
+        results['unchanged_records'] = unchanged_count
+        if batch.empty and before_commit is None:
+            print(f"📊 Обработка завершена: {results}")
+            return results
+        
+        nk = self.natural_key
+        tracked = self.spec.tracked_columns
+        columns = self.spec.columns + [HASH_COLUMN, TYPE1_HASH_COLUMN]
+        column_list = ', '.join(columns)
+        stage_table = f"stg_{self.table_name}"
+        
+        # Для версий, загруженных до появления хэшей, изменение определяется
+        # сравнением склеенных атрибутов без учета регистра и пробелов
+        existing_str = f"lower(trim(concat({', '.join('d.' + c for c in tracked)})))"
+        new_str = f"lower(trim(concat({', '.join('s.' + c for c in tracked)})))"
+        changed_condition = f"""d.{HASH_COLUMN} IS DISTINCT FROM s.{HASH_COLUMN}
+            AND (d.{HASH_COLUMN} IS NOT NULL OR {existing_str} <> {new_str})"""
+        overwrite_list = ', '.join(
+            f"{c} = s.{c}" for c in self.spec.type1_columns + [HASH_COLUMN, TYPE1_HASH_COLUMN]
+        )
+        
+        conn = counting_connection(self.hook.get_conn())
         cursor = conn.cursor()
         
         try:
-            for _, row in new_data.iterrows():
-                natural_key_value = row[self.natural_key]
-                
-                # Проверяем существует ли текущая запись
-                check_query = f"""
-                SELECT first_name, last_name, email, city, is_current
-                FROM {self.table_name} 
-                WHERE {self.natural_key} = %s 
-                AND is_current = TRUE
-                """
-                
-                cursor.execute(check_query, (natural_key_value,))
-                existing_record = cursor.fetchone()
-                
-                if existing_record:
-                    # Проверяем, изменились ли данные
-                    existing_first_name = existing_record[0] or ''
-                    existing_last_name = existing_record[1] or ''
-                    existing_email = existing_record[2] or ''
-                    existing_city = existing_record[3] or ''
-                    
-                    # Сравниваем с новыми данными
-                    new_first_name = row.get('first_name', '')
-                    new_last_name = row.get('last_name', '')
-                    new_email = row.get('email', '')
-                    new_city = row.get('city', '')
-                    
-                    # Приводим к строке и убираем пробелы для сравнения
-                    existing_str = f"{existing_first_name}{existing_last_name}{existing_email}{existing_city}".lower().strip()
-                    new_str = f"{new_first_name}{new_last_name}{new_email}{new_city}".lower().strip()
-                    
-                    if existing_str != new_str:
-                        # Закрываем старую версию
-                        update_query = f"""
-                        UPDATE {self.table_name}
-                        SET is_current = FALSE,
-                            expiration_date = %s,
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE {self.natural_key} = %s 
-                        AND is_current = TRUE
-                        """
-                        cursor.execute(update_query, (effective_date, natural_key_value))
-                        
-                        # Вставляем новую версию
-                        insert_query = f"""
-                        INSERT INTO {self.table_name} 
-                        (customer_id, first_name, last_name, email, city, 
-                         effective_date, expiration_date, is_current, source_system)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, TRUE, 'postgres_source')
-                        """
-                        cursor.execute(insert_query, (
-                            natural_key_value,
-                            new_first_name,
-                            new_last_name,
-                            new_email,
-                            new_city,
-                            effective_date,
-                            '9999-12-31'
-                        ))
-                        
-                        results['updated_records'] += 1
-                        print(f"📝 Обновлена запись для customer_id={natural_key_value}")
-                    else:
-                        results['unchanged_records'] += 1
-                        print(f"⏭ Запись без изменений customer_id={natural_key_value}")
-                else:
-                    # Новая запись - просто вставляем
-                    insert_query = f"""
-                    INSERT INTO {self.table_name} 
-                    (customer_id, first_name, last_name, email, city, 
-                     effective_date, expiration_date, is_current, source_system)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, TRUE, 'postgres_source')
-                    """
-                    
-                    cursor.execute(insert_query, (
-                        natural_key_value,
-                        row.get('first_name', ''),
-                        row.get('last_name', ''),
-                        row.get('email', ''),
-                        row.get('city', ''),
-                        effective_date,
-                        '9999-12-31'
-                    ))
-                    
-                    results['new_records'] += 1
-                    print(f"✅ Добавлена новая запись для customer_id={natural_key_value}")
+            if not batch.empty:
+                # Временная таблица с теми же типами колонок, что и измерение
+                cursor.execute(f"""
+                CREATE TEMP TABLE {stage_table} ON COMMIT DROP AS
+                SELECT {column_list} FROM {self.table_name} WITH NO DATA
+                """)
+            
+                execute_values(
+                    cursor,
+                    f"INSERT INTO {stage_table} ({column_list}) VALUES %s",
+                    batch[columns].astype(object).where(batch[columns].notna(), None).itertuples(index=False, name=None),
+                    page_size=STAGE_PAGE_SIZE
+                )
+                print(f"📥 Загружено во временную таблицу: {len(batch)} записей")
+            
+                # Закрываем текущие версии, атрибуты SCD Type 2 которых изменились
+                cursor.execute(f"""
+                UPDATE {self.table_name} d
+                SET is_current = FALSE,
+                    expiration_date = %s,
+                    updated_at = CURRENT_TIMESTAMP
+                FROM {stage_table} s
+                WHERE d.{nk} = s.{nk}
+                AND d.is_current = TRUE
+                AND {changed_condition}
+                """, (effective_date,))
+                results['updated_records'] = cursor.rowcount
+            
+                # Перезаписываем атрибуты SCD Type 1 (и хэши) в оставшихся текущих версиях
+                cursor.execute(f"""
+                UPDATE {self.table_name} d
+                SET {overwrite_list},
+                    updated_at = CURRENT_TIMESTAMP
+                FROM {stage_table} s
+                WHERE d.{nk} = s.{nk}
+                AND d.is_current = TRUE
+                AND (d.{HASH_COLUMN} IS NULL
+                     OR d.{TYPE1_HASH_COLUMN} IS DISTINCT FROM s.{TYPE1_HASH_COLUMN})
+                """)
+                results['overwritten_records'] = cursor.rowcount
+            
+                # Вставляем новые версии для новых и закрытых записей
+                cursor.execute(f"""
+                INSERT INTO {self.table_name}
+                ({column_list}, effective_date, expiration_date, is_current, source_system)
+                SELECT {', '.join('s.' + c for c in columns)}, %s, %s, TRUE, %s
+                FROM {stage_table} s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {self.table_name} d
+                    WHERE d.{nk} = s.{nk}
+                    AND d.is_current = TRUE
+                )
+                """, (effective_date, '9999-12-31', self.spec.source_system))
+                inserted = cursor.rowcount
+            
+                results['new_records'] = inserted - results['updated_records']
+                # Строки после отсева по хэшу, не получившие ни новой версии,
+                # ни перезаписи SCD Type 1 (например, разница только в регистре
+                # у версий без хэша)
+                results['unchanged_records'] += len(batch) - inserted - results['overwritten_records']
+            
+            if before_commit is not None:
+                before_commit(cursor)
             
             conn.commit()
             print(f"✅ Все изменения сохранены в БД")
@@ -131,6 +195,104 @@ class SCDType2Handler:
             cursor.close()
             conn.close()
         
+        # После фиксации хэши пакета становятся хэшами текущих версий
+        current_hashes.update(zip(batch[nk], zip(batch[HASH_COLUMN], batch[TYPE1_HASH_COLUMN])))
+        
         print(f"📊 Обработка завершена: {results}")
         return results
-    
\ No newline at end of file
+    
+    def _prepare_batch(self, new_data):
+        """Подготовка пакета: колонки спецификации, хэши, одна запись на натуральный ключ"""
+        batch = new_data.copy()
+        for column in self.spec.columns:
+            if column not in batch.columns:
+                batch[column] = None
+        
+        batch = batch.dropna(subset=[self.natural_key])
+        batch = batch.drop_duplicates(subset=[self.natural_key], keep='last')
+        if pd.api.types.is_numeric_dtype(batch[self.natural_key]):
+            batch[self.natural_key] = batch[self.natural_key].astype('int64')
+        
+        batch[HASH_COLUMN] = compute_row_hash(batch, self.spec.tracked_columns, self.spec.column_kinds)
+        batch[TYPE1_HASH_COLUMN] = compute_row_hash(batch, self.spec.type1_columns, self.spec.column_kinds)
+        return batch
+    
+    def _get_current_hashes(self):
+        """Кэш хэшей текущих версий: {натуральный ключ: (attr_hash, type1_hash)}"""
+        if self._current_hashes is None:
+            self.ensure_hash_columns()
+            rows = self.hook.get_records(f"""
+                SELECT {self.natural_key}, {HASH_COLUMN}, {TYPE1_HASH_COLUMN}
+                FROM {self.table_name}
+                WHERE is_current = TRUE
+                AND {HASH_COLUMN} IS NOT NULL
+                AND {TYPE1_HASH_COLUMN} IS NOT NULL
+            """)
+            self._current_hashes = {key: (attr, type1) for key, attr, type1 in rows}
+            print(f"🗂 Загружено хэшей текущих версий: {len(self._current_hashes)}")
+        return self._current_hashes
+    
+    def ensure_hash_columns(self):
+        """
+        Колонки хэшей в измерении, созданном до их появления (в init_dwh.sql
+        они объявлены только для новой установки)
+        
+        Наличие проверяется по каталогу; ALTER TABLE выполняется только при
+        отсутствии колонок, отдельной короткой транзакцией до загрузки.
+        Текущим версиям без хэшей хэши рассчитываются по их атрибутам один раз,
+        иначе такие строки не отсеивались бы по хэшу при каждой загрузке.
+        """
+        existing = {row[0] for row in self.hook.get_records("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name IN (%s, %s)
+        """, parameters=(self.table_name, HASH_COLUMN, TYPE1_HASH_COLUMN))}
+        missing = [column for column in (HASH_COLUMN, TYPE1_HASH_COLUMN) if column not in existing]
+        if missing:
+            self.hook.run(["SET lock_timeout = '5s'"] + [
+                f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS {column} BIGINT"
+                for column in missing
+            ])
+            print(f"🧩 В {self.table_name} добавлены колонки {', '.join(missing)}")
+        
+        return self._backfill_hashes()
+    
+    def _backfill_hashes(self):
+        """Расчет хэшей текущих версий, у которых их нет; возвращает число строк"""
+        nk = self.natural_key
+        columns = self.spec.columns
+        rows = self.hook.get_records(f"""
+            SELECT {', '.join(columns)} FROM {self.table_name}
+            WHERE is_current = TRUE
+            AND ({HASH_COLUMN} IS NULL OR {TYPE1_HASH_COLUMN} IS NULL)
+        """)
+        if not rows:
+            return 0
+        
+        current = pd.DataFrame.from_records(rows, columns=columns)
+        attr_hashes = compute_row_hash(current, self.spec.tracked_columns, self.spec.column_kinds)
+        type1_hashes = compute_row_hash(current, self.spec.type1_columns, self.spec.column_kinds)
+        
+        conn = counting_connection(self.hook.get_conn())
+        try:
+            with conn.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    f"""
+                    UPDATE {self.table_name} d
+                    SET {HASH_COLUMN} = v.attr_hash, {TYPE1_HASH_COLUMN} = v.type1_hash
+                    FROM (VALUES %s) AS v (nk, attr_hash, type1_hash)
+                    WHERE d.{nk} = v.nk
+                    AND d.is_current = TRUE
+                    """,
+                    zip(current[nk].tolist(), attr_hashes.tolist(), type1_hashes.tolist()),
+                    page_size=STAGE_PAGE_SIZE
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        print(f"🧮 Рассчитаны хэши текущих версий без хэшей: {len(current)}")
+        return len(current)
@@ -0,0 +1,247 @@
+"""
+Surrogate Key Lookup - кэш суррогатных ключей измерений для загрузки фактов
+"""
+import numpy as np
+import pandas as pd
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+
+class LookupSpec:
+    """Описание измерения для поиска суррогатного ключа"""
+
+    def __init__(self, table_name, natural_key, surrogate_key, key_type='int',
+                 current_flag=None, attributes=None):
+        """
+        Args:
+            table_name: Таблица измерения
+            natural_key: Колонка натурального ключа
+            surrogate_key: Колонка суррогатного ключа
+            key_type: Приведение натурального ключа: 'int', 'date', 'time', 'code'
+            current_flag: Флаг текущей версии (для SCD Type 2 измерений)
+            attributes: Атрибуты измерения, возвращаемые вместе с ключом
+        """
+        self.table_name = table_name
+        self.natural_key = natural_key
+        self.surrogate_key = surrogate_key
+        self.key_type = key_type
+        self.current_flag = current_flag
+        self.attributes = list(attributes or [])
+
+    def __repr__(self):
+        return f"LookupSpec({self.table_name}, {self.natural_key} -> {self.surrogate_key})"
+
+
+# Измерения, на которые ссылаются факты DWH
+LOOKUP_SPECS = {
+    'customer': LookupSpec('dim_customers', 'customer_id', 'customer_key', current_flag='is_current'),
+    'product': LookupSpec('dim_products', 'product_id', 'product_key', current_flag='is_current',
+                          attributes=['cost_price']),
+    'date': LookupSpec('dim_date', 'full_date', 'date_key', key_type='date'),
+    'time': LookupSpec('dim_time', 'full_time', 'time_key', key_type='time'),
+    'status': LookupSpec('dim_order_status', 'status_code', 'status_key', key_type='code'),
+}
+
+
+def normalize_keys(values, key_type):
+    """Приведение натуральных ключей к единому виду для сравнения"""
+    values = pd.Series(values)
+    if key_type == 'int':
+        return pd.to_numeric(values, errors='coerce').astype('Int64')
+    if key_type == 'date':
+        return pd.to_datetime(values, errors='coerce').dt.normalize()
+    if key_type == 'time':
+        # TIME приходит объектами datetime.time, берем HH:MM:SS
+        return values.astype('string').str.slice(0, 8)
+    return values.astype('string').str.strip().str.upper()
+
+
+class SurrogateKeyLookup:
+    """Карта натуральный ключ -> суррогатный ключ одного измерения в памяти"""
+
+    def __init__(self, conn_id, spec):
+        self.conn_id = conn_id
+        self.spec = spec
+        self.table = None
+
+    def load(self):
+        """Однократная загрузка карты ключей (текущие версии для SCD Type 2)"""
+        if self.table is not None:
+            return self
+
+        spec = self.spec
+        columns = [spec.natural_key, spec.surrogate_key] + spec.attributes
+        query = f"SELECT {', '.join(columns)} FROM {spec.table_name}"
+        if spec.current_flag:
+            query += f" WHERE {spec.current_flag} = TRUE"
+
+        rows = PostgresHook(postgres_conn_id=self.conn_id).get_records(query)
+        table = pd.DataFrame.from_records(rows, columns=columns)
+        table['_key'] = normalize_keys(table[spec.natural_key], spec.key_type).values
+
+        # При нескольких текущих версиях (нарушение SCD) берем последнюю созданную
+        table = table.sort_values(spec.surrogate_key).drop_duplicates('_key', keep='last')
+        self.table = table.set_index('_key')
+
+        print(f"🔑 Карта ключей {spec.table_name}: {len(self.table)} значений")
+        return self
+
+    def resolve(self, values):
+        """
+        Суррогатные ключи для массива натуральных ключей
+
+        Returns:
+            pandas.Series Int64 (NA для ненайденных ключей)
+        """
+        self.load()
+        keys = normalize_keys(values, self.spec.key_type)
+        positions = self.table.index.get_indexer(keys)
+        found = positions >= 0
+
+        surrogate = self.table[self.spec.surrogate_key].to_numpy()
+        result = np.zeros(len(keys), dtype='int64')
+        result[found] = surrogate[positions[found]]
+        return pd.Series(pd.arrays.IntegerArray(result, ~found), index=getattr(values, 'index', None))
+
+    def attribute(self, values, attribute):
+        """Атрибут измерения (например, cost_price) для массива натуральных ключей"""
+        self.load()
+        keys = normalize_keys(values, self.spec.key_type)
+        positions = self.table.index.get_indexer(keys)
+        found = positions >= 0
+
+        result = np.full(len(keys), None, dtype=object)
+        result[found] = self.table[attribute].to_numpy()[positions[found]]
+        return pd.Series(result, index=getattr(values, 'index', None))
+
+
+class AsOfKeyLookup:
+    """
+    Поиск версии SCD Type 2 измерения, действовавшей на дату события
+
+    Версии каждого натурального ключа упорядочены по effective_date; для
+    строки факта берется последняя версия с effective_date <= даты события
+    (pandas.merge_asof по ключу), затем проверяется, что дата события
+    раньше expiration_date этой версии.
+    """
+
+    def __init__(self, conn_id, spec, fallback_to_earliest=True):
+        """
+        Args:
+            conn_id: ID подключения Airflow к DWH
+            spec: LookupSpec SCD Type 2 измерения
+            fallback_to_earliest: События раньше первой версии (измерение начали
+                                  вести позже) связываются с самой ранней версией
+        """
+        self.conn_id = conn_id
+        self.spec = spec
+        self.fallback_to_earliest = fallback_to_earliest
+        self.versions = None
+
+    def load(self):
+        """Однократная загрузка всех версий измерения"""
+        if self.versions is not None:
+            return self
+
+        spec = self.spec
+        columns = [spec.natural_key, spec.surrogate_key, 'effective_date', 'expiration_date'] + spec.attributes
+        rows = PostgresHook(postgres_conn_id=self.conn_id).get_records(
+            f"SELECT {', '.join(columns)} FROM {spec.table_name}"
+        )
+        versions = pd.DataFrame.from_records(rows, columns=columns)
+
+        versions['_key'] = normalize_keys(versions[spec.natural_key], spec.key_type).values
+        versions['_effective'] = pd.to_datetime(versions['effective_date'], errors='coerce')
+        # '9999-12-31' не помещается в datetime64[ns] - открытая версия
+        versions['_expiration'] = pd.to_datetime(versions['expiration_date'], errors='coerce').fillna(pd.Timestamp.max)
+
+        versions = versions.dropna(subset=['_key', '_effective'])
+        versions['_key'] = versions['_key'].astype('int64')
+        self.versions = versions.sort_values(['_effective', spec.surrogate_key]).reset_index(drop=True)
+
+        print(f"🕒 Версии {spec.table_name}: {len(self.versions)} для "
+              f"{self.versions['_key'].nunique()} ключей")
+        return self
+
+    def lookup(self, values, event_dates):
+        """
+        Версии измерения на даты событий
+
+        Returns:
+            DataFrame (индекс как у values) с суррогатным ключом (Int64) и атрибутами
+        """
+        self.load()
+        spec = self.spec
+        index = getattr(values, 'index', None)
+
+        events = pd.DataFrame({
+            '_key': normalize_keys(values, spec.key_type).values,
+            '_event': pd.to_datetime(pd.Series(event_dates).values, errors='coerce'),
+        })
+        events['_event'] = events['_event'].dt.normalize()
+        events['_row'] = np.arange(len(events))
+
+        result_columns = [spec.surrogate_key] + spec.attributes
+        result = pd.DataFrame({col: pd.Series([None] * len(events), dtype=object) for col in result_columns})
+
+        valid = events.dropna(subset=['_key', '_event']).astype({'_key': 'int64'})
+        if not valid.empty and not self.versions.empty:
+            matched = pd.merge_asof(
+                valid.sort_values('_event'),
+                self.versions[['_key', '_effective', '_expiration'] + result_columns],
+                left_on='_event', right_on='_effective',
+                by='_key', direction='backward'
+            )
+            hit = matched[spec.surrogate_key].notna() & (matched['_event'] < matched['_expiration'])
+
+            if self.fallback_to_earliest:
+                earliest = self.versions.drop_duplicates('_key', keep='first').set_index('_key')
+                early = ~hit & matched[spec.surrogate_key].isna() & matched['_key'].isin(earliest.index)
+                for col in result_columns:
+                    matched.loc[early, col] = earliest.loc[matched.loc[early, '_key'], col].values
+                hit = hit | early
+
+            matched = matched[hit]
+            for col in result_columns:
+                result.loc[matched['_row'].values, col] = matched[col].values
+
+        result[spec.surrogate_key] = pd.to_numeric(result[spec.surrogate_key]).astype('Int64')
+        if index is not None:
+            result.index = index
+        return result
+
+    def resolve(self, values, event_dates):
+        """Суррогатные ключи версий на даты событий (Int64, NA - версия не найдена)"""
+        return self.lookup(values, event_dates)[self.spec.surrogate_key]
+
+
+class KeyLookupCache:
+    """Карты ключей всех измерений; каждая строится один раз за запуск"""
+
+    def __init__(self, conn_id, specs=None):
+        self.conn_id = conn_id
+        self.specs = specs or LOOKUP_SPECS
+        self._lookups = {}
+        self._as_of_lookups = {}
+
+    def get(self, name):
+        if name not in self._lookups:
+            self._lookups[name] = SurrogateKeyLookup(self.conn_id, self.specs[name]).load()
+        return self._lookups[name]
+
+    def resolve(self, name, values):
+        """Суррогатные ключи измерения name"""
+        return self.get(name).resolve(values)
+
+    def get_as_of(self, name):
+        if name not in self._as_of_lookups:
+            self._as_of_lookups[name] = AsOfKeyLookup(self.conn_id, self.specs[name]).load()
+        return self._as_of_lookups[name]
+
+    def resolve_as_of(self, name, values, event_dates):
+        """Суррогатные ключи версий измерения name, действовавших на даты событий"""
+        return self.get_as_of(name).resolve(values, event_dates)
+
+    def stats(self):
+        stats = {name: len(lookup.table) for name, lookup in self._lookups.items()}
+        stats.update({f"{name}_versions": len(lookup.versions) for name, lookup in self._as_of_lookups.items()})
+        return stats
@@ -0,0 +1,79 @@
+"""
+Watermark Store - хранение high-watermark инкрементальной загрузки источников
+"""
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+WATERMARK_TABLE = 'etl_watermarks'
+
+
+class WatermarkStore:
+    """Контрольная таблица watermark'ов в целевой БД"""
+
+    def __init__(self, conn_id, table_name=WATERMARK_TABLE):
+        self.conn_id = conn_id
+        self.table_name = table_name
+        self.hook = PostgresHook(postgres_conn_id=self.conn_id)
+        self._table_checked = False
+
+    def ensure_table(self):
+        """Создание контрольной таблицы, если её нет"""
+        if self._table_checked:
+            return
+        self.hook.run(f"""
+            CREATE TABLE IF NOT EXISTS {self.table_name} (
+                source_name VARCHAR(100) PRIMARY KEY,
+                watermark_column VARCHAR(100) NOT NULL,
+                watermark_value TIMESTAMP,
+                rows_loaded INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self._table_checked = True
+
+    def get(self, source_name):
+        """Текущий watermark источника или None, если источник еще не загружался"""
+        self.ensure_table()
+        row = self.hook.get_first(
+            f"SELECT watermark_value FROM {self.table_name} WHERE source_name = %s",
+            parameters=(source_name,)
+        )
+        return row[0] if row else None
+
+    def advance(self, source_name, column, value, rows_loaded=0, cursor=None):
+        """
+        Сдвиг watermark источника (только вперед)
+
+        Args:
+            source_name: Имя источника (таблицы)
+            column: Колонка, по которой ведется инкремент
+            value: Новое значение watermark
+            rows_loaded: Число загруженных строк
+            cursor: Курсор транзакции загрузки - watermark фиксируется вместе с данными;
+                    без курсора используется отдельная транзакция
+        """
+        self.ensure_table()
+        sql = f"""
+            INSERT INTO {self.table_name}
+                (source_name, watermark_column, watermark_value, rows_loaded, updated_at)
+            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (source_name) DO UPDATE SET
+                watermark_column = EXCLUDED.watermark_column,
+                watermark_value = GREATEST({self.table_name}.watermark_value, EXCLUDED.watermark_value),
+                rows_loaded = EXCLUDED.rows_loaded,
+                updated_at = CURRENT_TIMESTAMP
+        """
+        parameters = (source_name, column, value, rows_loaded)
+
+        if cursor is not None:
+            cursor.execute(sql, parameters)
+        else:
+            self.hook.run(sql, parameters=parameters)
+        print(f"🔖 Watermark {source_name}.{column} -> {value}")
+
+    def advance_pending(self, pending, source_names, cursor=None):
+        """Сдвиг watermark'ов из словаря, полученного от задачи извлечения"""
+        for source_name in source_names:
+            mark = (pending or {}).get(source_name)
+            if mark:
+                self.advance(source_name, mark['column'], mark['value'],
+                             rows_loaded=mark.get('rows', 0), cursor=cursor)
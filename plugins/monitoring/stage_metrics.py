@@ -0,0 +1,295 @@
+"""
+Stage Metrics - измерение этапов ETL в data_quality_metrics
+
+Этап (задача DAG или вложенный блок track_stage) записывает время,
+строки на входе и выходе, объем данных, пиковый RSS процесса и число
+обращений к PostgreSQL. Плагины сообщают строки и байты через report()
+(без активного этапа вызов ничего не делает), обращения к БД считают
+курсоры соединений, открытых плагинами через counting_connection().
+Стек активных этапов свой у каждого потока; рабочие потоки этапа
+оборачиваются in_current_stages(). Записи задач передаются через XCom
+и пишутся в data_quality_metrics одной пачкой в конце запуска.
+"""
+import functools
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+METRICS_XCOM_KEY = 'stage_metrics'
+METRICS_TABLE = 'data_quality_metrics'
+
+# Колонки data_quality_metrics, заполняемые из записей этапов
+METRICS_COLUMNS = ['run_date', 'dag_id', 'task_id', 'source_name', 'total_records', 'error_count',
+                   'processing_time_seconds', 'start_time', 'end_time', 'status', 'error_message',
+                   'rows_in', 'rows_out', 'bytes_moved', 'peak_rss_mb', 'db_round_trips']
+
+_lock = threading.Lock()
+_state = threading.local()
+_completed = []
+
+
+def _active():
+    """Стек активных этапов текущего потока"""
+    if not hasattr(_state, 'active'):
+        _state.active = []
+    return _state.active
+
+
+class _CountingCursor(psycopg2.extensions.cursor):
+    """Курсор, считающий обращения к серверу (выполнение, COPY, выборки серверного курсора)"""
+
+    def execute(self, query, vars=None):
+        _count_round_trips()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        _count_round_trips(len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def callproc(self, procname, parameters=None):
+        _count_round_trips()
+        return super().callproc(procname, parameters)
+
+    def copy_expert(self, sql, file, size=8192):
+        _count_round_trips()
+        return super().copy_expert(sql, file, size)
+
+    def fetchone(self):
+        if self.name:
+            _count_round_trips()
+        return super().fetchone()
+
+    def fetchmany(self, size=None):
+        if self.name:
+            _count_round_trips()
+        return super().fetchmany(size) if size is not None else super().fetchmany()
+
+    def fetchall(self):
+        if self.name:
+            _count_round_trips()
+        return super().fetchall()
+
+
+def _count_round_trips(count=1):
+    """Обращения к БД учитываются во всех активных этапах потока (вложенных и внешних)"""
+    for record in _active():
+        record.add(db_round_trips=count)
+
+
+def counting_connection(conn):
+    """
+    Курсоры соединения (созданные без явной фабрики) считают обращения
+    к серверу в активных этапах; глобальное состояние psycopg2 не меняется
+
+    Returns:
+        То же соединение
+    """
+    if conn.cursor_factory is None:
+        conn.cursor_factory = _CountingCursor
+    return conn
+
+
+def in_current_stages(func):
+    """
+    Функция для рабочего потока, выполняемая в этапах вызывающего потока:
+    отчеты и обращения к БД потока попадают в те же записи
+    """
+    stages = list(_active())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_state, 'active', None)
+        _state.active = list(stages)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _state.active = previous if previous is not None else []
+
+    return wrapper
+
+
+def _peak_rss_mb():
+    """Пиковый RSS процесса (ru_maxrss в Linux - в килобайтах)"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class StageRecord:
+    """Измерения одного этапа"""
+
+    def __init__(self, stage, dag_id=None, task_id=None, run_date=None):
+        self.stage = stage
+        self.dag_id = dag_id
+        self.task_id = task_id
+        self.run_date = run_date or datetime.now().date().isoformat()
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_moved = 0
+        self.db_round_trips = 0
+        self.status = 'running'
+        self.error_message = None
+        self.start_time = datetime.now()
+        self.end_time = None
+        self._started = time.perf_counter()
+        self.duration = None
+        self.peak_rss_mb = None
+
+    def add(self, rows_in=0, rows_out=0, bytes_moved=0, db_round_trips=0):
+        with _lock:
+            self.rows_in += int(rows_in)
+            self.rows_out += int(rows_out)
+            self.bytes_moved += int(bytes_moved)
+            self.db_round_trips += int(db_round_trips)
+
+    def finish(self, status='success', error_message=None):
+        self.end_time = datetime.now()
+        self.duration = round(time.perf_counter() - self._started, 3)
+        self.peak_rss_mb = _peak_rss_mb()
+        self.status = status
+        self.error_message = error_message
+
+    def as_dict(self):
+        """Запись для XCom (только JSON-совместимые значения)"""
+        return {
+            'run_date': self.run_date,
+            'dag_id': self.dag_id,
+            'task_id': self.task_id,
+            'source_name': self.stage,
+            'total_records': self.rows_in,
+            'error_count': int(self.status == 'error'),
+            'processing_time_seconds': self.duration,
+            'start_time': self.start_time.isoformat(),
+            'end_time': self.end_time.isoformat() if self.end_time else None,
+            'status': self.status,
+            'error_message': self.error_message,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes_moved': self.bytes_moved,
+            'peak_rss_mb': self.peak_rss_mb,
+            'db_round_trips': self.db_round_trips,
+        }
+
+    def summary(self):
+        return (f"⏱ {self.stage}: {self.duration:.2f} с, строк {self.rows_in} -> {self.rows_out}, "
+                f"{self.bytes_moved / 1024 / 1024:.1f} МБ, RSS {self.peak_rss_mb} МБ, "
+                f"обращений к БД {self.db_round_trips}")
+
+
+@contextmanager
+def track_stage(stage, dag_id=None, task_id=None, run_date=None):
+    """
+    Измерение блока кода как этапа
+
+    Вложенный этап получает отчеты плагинов, пока он активен; обращения
+    к БД учитываются и во внешнем этапе.
+
+    Yields:
+        StageRecord
+    """
+    active = _active()
+    parent = active[-1] if active else None
+    record = StageRecord(
+        stage,
+        dag_id=dag_id or (parent.dag_id if parent else None),
+        task_id=task_id or (parent.task_id if parent else None),
+        run_date=run_date or (parent.run_date if parent else None)
+    )
+    active.append(record)
+    try:
+        yield record
+    except Exception as e:
+        record.finish('error', str(e)[:1000])
+        raise
+    else:
+        record.finish(record.status if record.status != 'running' else 'success', record.error_message)
+    finally:
+        active.remove(record)
+        with _lock:
+            _completed.append(record)
+        print(record.summary())
+
+
+def report(rows_in=0, rows_out=0, bytes_moved=0, db_round_trips=0):
+    """
+    Учет строк и байтов в текущем (самом вложенном) этапе потока, обращений
+    к БД - во всех активных этапах; без этапа - ничего
+    """
+    active = _active()
+    if active:
+        active[-1].add(rows_in, rows_out, bytes_moved)
+    if db_round_trips:
+        _count_round_trips(db_round_trips)
+
+
+def instrumented_task(func=None, stage=None):
+    """
+    Декоратор задачи Airflow: задача измеряется как этап, записи этапов
+    задачи (включая вложенные) отправляются в XCom для общей записи
+
+    Статус берется из результата {'status': ...}: задачи пайплайна
+    перехватывают ошибки и возвращают 'error'.
+    """
+    if func is None:
+        return functools.partial(instrumented_task, stage=stage)
+
+    @functools.wraps(func)
+    def wrapper(**kwargs):
+        ti = kwargs.get('ti')
+        first = len(_completed)
+        try:
+            with track_stage(stage or func.__name__,
+                             dag_id=getattr(ti, 'dag_id', None),
+                             task_id=getattr(ti, 'task_id', None),
+                             run_date=kwargs.get('ds')) as record:
+                result = func(**kwargs)
+                if isinstance(result, dict) and result.get('status') == 'error':
+                    record.status = 'error'
+                    record.error_message = str(result.get('error'))[:1000]
+                elif isinstance(result, dict) and result.get('status'):
+                    record.status = result['status']
+            return result
+        finally:
+            if ti is not None:
+                ti.xcom_push(key=METRICS_XCOM_KEY, value=[r.as_dict() for r in _completed[first:]])
+
+    return wrapper
+
+
+def write_stage_metrics(hook, records):
+    """
+    Запись этапов в data_quality_metrics одним INSERT
+
+    Args:
+        hook: PostgresHook к аналитической БД
+        records: Список dict (StageRecord.as_dict)
+
+    Returns:
+        Число записанных строк
+    """
+    if not records:
+        return 0
+
+    conn = hook.get_conn()
+    cursor = conn.cursor()
+    try:
+        # Колонки измерений этапов объявлены в init_analytics_db.sql
+        execute_values(
+            cursor,
+            f"INSERT INTO {METRICS_TABLE} ({', '.join(METRICS_COLUMNS)}) VALUES %s",
+            [tuple(record.get(col) for col in METRICS_COLUMNS) for record in records]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+    print(f"📊 В {METRICS_TABLE} записано этапов: {len(records)}")
+    return len(records)
@@ -0,0 +1,272 @@
+"""
+Artifact Store - передача DataFrame между задачами через файлы Arrow/Parquet
+
+В XCom передается только небольшая ссылка на артефакт (путь, схема,
+число строк, контрольная сумма), сами данные лежат на диске в каталоге
+конкретного запуска DAG.
+"""
+import hashlib
+import os
+import re
+import shutil
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from monitoring.stage_metrics import report
+
+# Корневой каталог артефактов (смонтирован в контейнеры Airflow как ./data)
+DEFAULT_ARTIFACT_DIR = os.getenv('ETL_ARTIFACT_DIR', '/opt/airflow/data/artifacts')
+
+# Размер порции при чтении Parquet-артефактов порциями
+DEFAULT_BATCH_SIZE = 50000
+
+# Срок хранения артефактов старых запусков
+DEFAULT_RETENTION_DAYS = 7
+
+FORMAT_EXTENSIONS = {
+    'arrow': '.arrow',
+    'parquet': '.parquet',
+}
+
+
+class ArtifactStore:
+    """Хранилище артефактов запуска DAG"""
+
+    def __init__(self, dag_id='manual', run_id='manual', base_dir=None, fmt='arrow'):
+        """
+        Args:
+            dag_id: ID DAG (первый уровень каталога)
+            run_id: ID запуска (второй уровень каталога)
+            base_dir: Корневой каталог артефактов
+            fmt: 'arrow' - Arrow IPC (Feather V2) без сжатия, читается через memory-map;
+                 'parquet' - компактнее на диске, но требует декодирования
+        """
+        if fmt not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Неизвестный формат артефакта: {fmt}")
+
+        self.base_dir = base_dir or DEFAULT_ARTIFACT_DIR
+        self.dag_dir = os.path.join(self.base_dir, _safe_name(dag_id))
+        self.run_dir = os.path.join(self.dag_dir, _safe_name(run_id))
+        self.fmt = fmt
+
+    @classmethod
+    def from_context(cls, context, **kwargs):
+        """Хранилище для текущего запуска по контексту задачи Airflow"""
+        dag = context.get('dag')
+        dag_id = dag.dag_id if dag is not None else 'manual'
+        run_id = context.get('run_id') or 'manual'
+        return cls(dag_id=dag_id, run_id=run_id, **kwargs)
+
+    def write(self, name, df):
+        """
+        Сохранение DataFrame в артефакт
+
+        Returns:
+            dict-ссылка для XCom: path, format, schema, rows, bytes, checksum
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        path = os.path.join(self.run_dir, _safe_name(name) + FORMAT_EXTENSIONS[self.fmt])
+        tmp_path = path + '.tmp'
+
+        table = _to_arrow_table(df)
+        if self.fmt == 'arrow':
+            feather.write_feather(table, tmp_path, compression='uncompressed')
+        else:
+            pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+        ref = {
+            'path': path,
+            'format': self.fmt,
+            'schema': {field.name: str(field.type) for field in table.schema},
+            'rows': table.num_rows,
+            'bytes': os.path.getsize(path),
+            'checksum': file_checksum(path),
+        }
+        report(rows_out=ref['rows'], bytes_moved=ref['bytes'])
+        print(f"💾 Артефакт {name}: {ref['rows']} строк, {ref['bytes']} байт -> {path}")
+        return ref
+
+    def write_chunks(self, name, chunks):
+        """
+        Потоковая запись порций DataFrame в один артефакт без сборки
+        таблицы в памяти; схема берется из первой порции
+
+        Returns:
+            dict-ссылка для XCom (как у write)
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        path = os.path.join(self.run_dir, _safe_name(name) + FORMAT_EXTENSIONS[self.fmt])
+        tmp_path = path + '.tmp'
+
+        writer = None
+        schema = None
+        rows = 0
+        try:
+            for chunk in chunks:
+                if schema is None:
+                    table = _decode_dictionaries(_to_arrow_table(chunk))
+                    schema = table.schema
+                    if self.fmt == 'arrow':
+                        writer = pa.ipc.new_file(tmp_path, schema)
+                    else:
+                        writer = pq.ParquetWriter(tmp_path, schema)
+                else:
+                    table = _decode_dictionaries(_to_arrow_table(chunk))
+                    if not table.schema.equals(schema):
+                        table = table.cast(schema)
+
+                writer.write_table(table)
+                rows += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if writer is None:
+            # Ни одной порции - пустой артефакт
+            return self.write(name, pd.DataFrame())
+        os.replace(tmp_path, path)
+
+        ref = {
+            'path': path,
+            'format': self.fmt,
+            'schema': {field.name: str(field.type) for field in schema},
+            'rows': rows,
+            'bytes': os.path.getsize(path),
+            'checksum': file_checksum(path),
+        }
+        report(rows_out=ref['rows'], bytes_moved=ref['bytes'])
+        print(f"💾 Артефакт {name}: {ref['rows']} строк, {ref['bytes']} байт -> {path}")
+        return ref
+
+    def cleanup(self):
+        """Удаление артефактов текущего запуска"""
+        if os.path.isdir(self.run_dir):
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            print(f"🧹 Удалены артефакты запуска: {self.run_dir}")
+
+    def purge_expired(self, retention_days=DEFAULT_RETENTION_DAYS):
+        """Удаление артефактов запусков старше retention_days"""
+        if not os.path.isdir(self.dag_dir):
+            return 0
+
+        threshold = time.time() - retention_days * 86400
+        removed = 0
+        for entry in os.scandir(self.dag_dir):
+            if entry.is_dir() and entry.path != self.run_dir and entry.stat().st_mtime < threshold:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+
+        if removed:
+            print(f"🧹 Удалено устаревших запусков: {removed}")
+        return removed
+
+
+def read_artifact(ref, columns=None, verify=False):
+    """
+    Чтение артефакта по ссылке из XCom
+
+    Args:
+        ref: dict-ссылка, возвращенная ArtifactStore.write
+        columns: Список нужных колонок (отсутствующие в схеме пропускаются)
+        verify: Проверить контрольную сумму файла перед чтением
+
+    Returns:
+        pandas.DataFrame
+    """
+    if not ref:
+        return pd.DataFrame()
+
+    if verify and file_checksum(ref['path']) != ref['checksum']:
+        raise ValueError(f"Контрольная сумма артефакта не совпадает: {ref['path']}")
+
+    if columns is not None:
+        columns = [col for col in columns if col in ref['schema']]
+
+    # Оба формата читаются через memory-map; для Arrow IPC без сжатия
+    # проекция колонок не копирует данные с диска целиком
+    if ref['format'] == 'arrow':
+        table = feather.read_table(ref['path'], columns=columns, memory_map=True)
+    else:
+        table = pq.read_table(ref['path'], columns=columns, memory_map=True)
+
+    report(rows_in=table.num_rows, bytes_moved=table.nbytes)
+    return table.to_pandas()
+
+
+def iter_artifact(ref, columns=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Чтение артефакта порциями для обработки в ограниченной памяти
+
+    Yields:
+        pandas.DataFrame с очередной порцией строк
+    """
+    if not ref:
+        return
+
+    if columns is not None:
+        columns = [col for col in columns if col in ref['schema']]
+
+    if ref['format'] == 'arrow':
+        with pa.memory_map(ref['path'], 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                table = pa.Table.from_batches([reader.get_batch(i)])
+                if columns is not None:
+                    table = table.select(columns)
+                report(rows_in=table.num_rows, bytes_moved=table.nbytes)
+                yield table.to_pandas()
+    else:
+        parquet_file = pq.ParquetFile(ref['path'], memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            report(rows_in=batch.num_rows, bytes_moved=batch.nbytes)
+            yield batch.to_pandas()
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """SHA-256 файла, читается блоками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _safe_name(value):
+    """Имя, пригодное для файловой системы (run_id содержит ':' и '+')"""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(value))
+
+
+def _to_arrow_table(df):
+    """
+    Конвертация DataFrame в Arrow; object-колонки со смешанными типами
+    (например, документы MongoDB) приводятся к строкам
+    """
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df = df.copy()
+        for col in df.columns[df.dtypes == object]:
+            try:
+                pa.array(df[col], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[col] = df[col].astype(str).where(df[col].notna(), None)
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _decode_dictionaries(table):
+    """
+    Dictionary-колонки (pandas category) приводятся к типу значений:
+    словари разных порций различаются, а файл Arrow IPC не допускает их замены
+    """
+    fields = [
+        pa.field(field.name, field.type.value_type, field.nullable)
+        if pa.types.is_dictionary(field.type) else field
+        for field in table.schema
+    ]
+    schema = pa.schema(fields, metadata=table.schema.metadata)
+    return table if schema.equals(table.schema) else table.cast(schema)
@@ -0,0 +1,202 @@
+"""
+Column Coercer - векторизованное приведение DataFrame к колонкам целевой таблицы
+"""
+import re
+import numpy as np
+import pandas as pd
+
+# Значения по умолчанию для пропусков по виду колонки
+DEFAULT_FILL_VALUES = {
+    'integer': 0,
+    'numeric': 0.0,
+    'string': '',
+    'boolean': False,
+    'date': None,
+    'timestamp': None,
+}
+
+_INTEGER_TYPES = ('smallint', 'integer', 'bigint', 'int', 'int2', 'int4', 'int8', 'serial', 'bigserial')
+_NUMERIC_TYPES = ('numeric', 'decimal', 'real', 'double precision', 'float4', 'float8')
+_STRING_TYPES = ('character varying', 'varchar', 'character', 'char', 'text')
+_TRUE_VALUES = ['true', 't', '1', 'yes', 'y']
+
+
+def parse_column_type(sql_type):
+    """
+    Разбор типа PostgreSQL ('VARCHAR(100)', 'numeric(10,2)', 'integer', ...)
+
+    Returns:
+        dict: kind, length, precision, scale
+    """
+    match = re.match(r'^\s*([a-z ]+?)\s*(?:\(\s*(\d+)\s*(?:,\s*(\d+)\s*)?\))?\s*$', str(sql_type).lower())
+    if not match:
+        raise ValueError(f"Неподдерживаемый тип колонки: {sql_type}")
+
+    base, first, second = match.groups()
+    parsed = {'kind': None, 'length': None, 'precision': None, 'scale': None}
+
+    if base in _INTEGER_TYPES:
+        parsed['kind'] = 'integer'
+    elif base in _NUMERIC_TYPES:
+        parsed['kind'] = 'numeric'
+        parsed['precision'] = int(first) if first else None
+        parsed['scale'] = int(second) if second else (0 if first else None)
+    elif base in _STRING_TYPES:
+        parsed['kind'] = 'string'
+        parsed['length'] = int(first) if first else None
+    elif base in ('boolean', 'bool'):
+        parsed['kind'] = 'boolean'
+    elif base == 'date':
+        parsed['kind'] = 'date'
+    elif base.startswith('timestamp'):
+        parsed['kind'] = 'timestamp'
+    else:
+        raise ValueError(f"Неподдерживаемый тип колонки: {sql_type}")
+
+    return parsed
+
+
+def to_numpy_backed(df):
+    """
+    Arrow-колонки (dtype_backend='pyarrow', порции движка pyarrow) -> колонки
+    NumPy той же семантики (стандартное преобразование pyarrow to_pandas):
+    маски и fillna коэрсера рассчитаны на NaN, а не на pd.NA
+    """
+    arrow_columns = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.ArrowDtype)]
+    if not arrow_columns:
+        return df
+
+    import pyarrow as pa
+
+    converted = df.copy()
+    for col in arrow_columns:
+        column = pa.array(df[col]).to_pandas()
+        column.index = df.index
+        converted[col] = column
+    return converted
+
+
+class ColumnCoercer:
+    """
+    Приведение типов, обрезка строк и заполнение пропусков по описанию колонок таблицы
+
+    Ключевые колонки не заполняются значениями по умолчанию: строка с пустым
+    или неприводимым ключом отбрасывается. Числа вне диапазона NUMERIC(p, s)
+    тоже не заменяются нулем - такие строки отбрасываются и учитываются
+    в статистике.
+    """
+
+    def __init__(self):
+        self.stats = {
+            'rows_coerced': 0,
+            'rows_rejected': 0,
+            'invalid_keys': 0,
+            'nulls_filled': 0,
+            'values_truncated': 0,
+            'values_invalid': 0,
+            'values_out_of_range': 0
+        }
+
+    def transform(self, data, **kwargs):
+        """
+        Приведение DataFrame к колонкам kwargs['column_types']
+
+        Args:
+            data: DataFrame с исходными данными
+            column_types: dict {колонка: тип PostgreSQL} в порядке колонок результата
+            key_columns: Ключевые колонки (без значений по умолчанию)
+            defaults: dict {колонка: значение} вместо DEFAULT_FILL_VALUES
+
+        Returns:
+            DataFrame только с колонками column_types без отброшенных строк
+        """
+        df = to_numpy_backed(data if isinstance(data, pd.DataFrame) else pd.DataFrame(data))
+        column_types = kwargs['column_types']
+        key_columns = set(kwargs.get('key_columns') or ())
+        defaults = kwargs.get('defaults', {})
+
+        missing_keys = key_columns - set(column_types)
+        if missing_keys:
+            raise ValueError(f"Ключевых колонок нет в column_types: {sorted(missing_keys)}")
+
+        result = {}
+        rejected = pd.Series(False, index=df.index)
+        for col, sql_type in column_types.items():
+            spec = parse_column_type(sql_type)
+            is_key = col in key_columns
+            default = None if is_key else defaults.get(col, DEFAULT_FILL_VALUES[spec['kind']])
+            source = df[col] if col in df.columns else pd.Series(np.nan, index=df.index, dtype=object)
+            values, out_of_range = self._coerce(source, spec, default)
+            if is_key:
+                invalid = values.isna()
+                self.stats['invalid_keys'] += int(invalid.sum())
+                rejected |= invalid
+            rejected |= out_of_range
+            result[col] = values
+
+        self.stats['rows_coerced'] += len(df)
+        coerced = pd.DataFrame(result, index=df.index)
+        if rejected.any():
+            self.stats['rows_rejected'] += int(rejected.sum())
+            print(f"⚠ Отброшено строк с пустым ключом или значением вне диапазона: {int(rejected.sum())}")
+            coerced = coerced[~rejected]
+            for col, sql_type in column_types.items():
+                if col in key_columns and parse_column_type(sql_type)['kind'] == 'integer':
+                    coerced[col] = coerced[col].astype('int64')
+        return coerced
+
+    def _coerce(self, series, spec, default):
+        """
+        Приведение одной колонки
+
+        Returns:
+            (значения, маска значений вне диапазона типа)
+        """
+        kind = spec['kind']
+        present = series.notna()
+        out_of_range = pd.Series(False, index=series.index)
+
+        if kind in ('integer', 'numeric'):
+            # float64: маски ниже - обычные bool без pd.NA (в том числе для Int64)
+            values = pd.to_numeric(series, errors='coerce').astype('float64')
+            if kind == 'numeric' and spec['precision']:
+                values = values.round(spec['scale'] or 0)
+                # Значения за пределами NUMERIC(p, s) COPY не примет
+                limit = 10.0 ** (spec['precision'] - (spec['scale'] or 0))
+                out_of_range = values.abs() >= limit
+                self.stats['values_out_of_range'] += int(out_of_range.sum())
+                values = values.mask(out_of_range)
+            elif kind == 'integer':
+                values = values.round()
+        elif kind == 'string':
+            values = series.astype('string').str.strip()
+            if spec['length']:
+                too_long = values.str.len() > spec['length']
+                self.stats['values_truncated'] += int(too_long.sum())
+                values = values.str.slice(0, spec['length'])
+        elif kind == 'boolean':
+            if pd.api.types.is_bool_dtype(series):
+                values = series
+            else:
+                values = series.astype('string').str.strip().str.lower().isin(_TRUE_VALUES).where(present)
+        else:
+            values = pd.to_datetime(series, errors='coerce')
+            if kind == 'date':
+                values = values.dt.date.where(values.notna())
+
+        self.stats['values_invalid'] += int((present & values.isna() & ~out_of_range).sum())
+
+        # Значения вне диапазона не заполняются: строка будет отброшена
+        missing = values.isna() & ~out_of_range
+        if default is not None and missing.any():
+            self.stats['nulls_filled'] += int(missing.sum())
+            values = values.mask(missing, default)
+
+        if kind == 'integer':
+            values = values.astype('int64') if not values.isna().any() else values.astype('Int64')
+        elif kind == 'string':
+            values = values.astype(object).where(values.notna(), None)
+        return values, out_of_range
+
+    def get_stats(self):
+        return self.stats
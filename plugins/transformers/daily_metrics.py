@@ -0,0 +1,208 @@
+"""
+Daily Metrics - расчет ежедневных метрик daily_business_analytics
+
+Основной путь - метрики из сливаемых частичных агрегатов DWH
+(loaders.partial_aggregates): суммы складываются, число уникальных заказов
+и клиентов берется из объединенных множеств идентификаторов, поэтому те же функции
+дают метрики дня, недели или месяца. Для DataFrame-входа (порции
+артефакта заказов) есть потоковый агрегатор с теми же метриками.
+"""
+import json
+from collections import defaultdict
+
+import pandas as pd
+from psycopg2.extras import execute_values
+
+from loaders.partial_aggregates import (
+    NEW_ORDER_STATUSES, CANCELLED_ORDER_STATUSES, UNKNOWN_CITY
+)
+
+# Колонки метрик daily_business_analytics, которые заполняет расчет
+DAILY_ANALYTICS_COLUMNS = [
+    'total_orders', 'new_orders', 'cancelled_orders', 'total_revenue', 'avg_order_value',
+    'total_cost', 'total_profit', 'profit_margin', 'active_customers',
+    'top_product_id', 'top_product_name', 'top_product_revenue',
+    'top_city', 'orders_by_city', 'top_category', 'revenue_by_category',
+]
+
+
+def metrics_from_partials(analytics_date, grains):
+    """
+    Метрики периода из частичных агрегатов
+
+    Args:
+        analytics_date: Дата (начало периода для сверток)
+        grains: dict {grain: {grain_value: PartialAggregate}} (PartialAggregateStore.daily/rollup)
+
+    Returns:
+        dict метрик (колонки daily_business_analytics) или None, если заказов нет
+    """
+    day = grains.get('day', {}).get('')
+    if day is None or not day.count('order_ids'):
+        return None
+
+    cities = {city: partial.count('order_ids') for city, partial in grains.get('city', {}).items()}
+    categories = {category: float(partial.sums['total_amount'])
+                  for category, partial in grains.get('category', {}).items()}
+    products = {int(product_id): float(partial.sums['total_amount'])
+                for product_id, partial in grains.get('product', {}).items()}
+    top_product_id = min(products, key=lambda pid: (-products[pid], pid)) if products else None
+
+    return finalize_metrics({
+        'analytics_date': analytics_date,
+        'total_orders': day.count('order_ids'),
+        'new_orders': day.count('new_order_ids'),
+        'cancelled_orders': day.count('cancelled_order_ids'),
+        'total_revenue': day.sums['total_amount'],
+        'total_cost': day.sums['cost_amount'],
+        'total_profit': day.sums['profit_amount'],
+        'active_customers': day.count('customer_ids'),
+        'top_city': _top_key(cities),
+        'orders_by_city': cities,
+        'top_category': _top_key(categories),
+        'revenue_by_category': categories,
+        'top_product_id': top_product_id,
+        'top_product_revenue': products.get(top_product_id),
+    })
+
+
+def _top_key(values):
+    """Ключ с наибольшим значением (при равенстве - первый по алфавиту)"""
+    return min(values, key=lambda key: (-values[key], key)) if values else None
+
+
+def finalize_metrics(row):
+    """Производные метрики и приведение типов для записи в аналитическую БД"""
+    revenue = float(row.get('total_revenue') or 0)
+    profit = row.get('total_profit')
+    orders = row.get('total_orders') or 0
+
+    row['total_revenue'] = round(revenue, 2)
+    row['avg_order_value'] = round(revenue / orders, 2) if orders else 0.0
+    if row.get('total_cost') is not None:
+        row['total_cost'] = round(float(row['total_cost']), 2)
+    if profit is not None:
+        row['total_profit'] = round(float(profit), 2)
+        row['profit_margin'] = round(float(profit) / revenue * 100, 2) if revenue else 0.0
+    if row.get('top_product_revenue') is not None:
+        row['top_product_revenue'] = round(float(row['top_product_revenue']), 2)
+
+    for column in ('orders_by_city', 'revenue_by_category'):
+        value = row.get(column)
+        if isinstance(value, dict):
+            row[column] = {key: round(v, 2) if isinstance(v, float) else v for key, v in value.items()}
+    return row
+
+
+class DailyMetricsAggregator:
+    """
+    Потоковый расчет дневных метрик по порциям заказов
+
+    Хранит только частичные суммы по датам (и множества клиентов для
+    точного числа активных клиентов), поэтому память не зависит от числа
+    строк во входе.
+    """
+
+    def __init__(self, date_column='order_date'):
+        self.date_column = date_column
+        self.totals = defaultdict(lambda: defaultdict(float))
+        self.customers = defaultdict(set)
+        self.cities = defaultdict(lambda: defaultdict(int))
+        self.stats = {
+            'rows_aggregated': 0,
+            'chunks': 0
+        }
+
+    def update(self, chunk):
+        """Добавление порции заказов (order_date, total_amount, status, customer_id, shipping_city)"""
+        if chunk is None or chunk.empty:
+            return self
+
+        df = pd.DataFrame({
+            'day': pd.to_datetime(chunk[self.date_column], errors='coerce').dt.date,
+            'amount': pd.to_numeric(chunk.get('total_amount'), errors='coerce'),
+            'status': chunk['status'].astype('string').str.upper() if 'status' in chunk.columns else pd.NA,
+            'city': chunk['shipping_city'].fillna(UNKNOWN_CITY) if 'shipping_city' in chunk.columns else UNKNOWN_CITY,
+            'customer_id': chunk.get('customer_id'),
+        }).dropna(subset=['day'])
+
+        df['is_new'] = df['status'].isin(NEW_ORDER_STATUSES)
+        df['is_cancelled'] = df['status'].isin(CANCELLED_ORDER_STATUSES)
+
+        grouped = df.groupby('day').agg(
+            total_orders=('day', 'size'),
+            new_orders=('is_new', 'sum'),
+            cancelled_orders=('is_cancelled', 'sum'),
+            total_revenue=('amount', 'sum'),
+        )
+        for day, values in grouped.iterrows():
+            for metric, value in values.items():
+                self.totals[day][metric] += float(value)
+
+        for (day, city), count in df.groupby(['day', 'city']).size().items():
+            self.cities[day][city] += int(count)
+
+        if 'customer_id' in chunk.columns:
+            for day, ids in df.dropna(subset=['customer_id']).groupby('day')['customer_id']:
+                self.customers[day].update(ids.astype('int64').tolist())
+
+        self.stats['rows_aggregated'] += len(df)
+        self.stats['chunks'] += 1
+        return self
+
+    def results(self):
+        """Список dict метрик по датам"""
+        rows = []
+        for day in sorted(self.totals):
+            totals = self.totals[day]
+            cities = self.cities[day]
+            rows.append(finalize_metrics({
+                'analytics_date': day,
+                'total_orders': int(totals['total_orders']),
+                'new_orders': int(totals['new_orders']),
+                'cancelled_orders': int(totals['cancelled_orders']),
+                'total_revenue': totals['total_revenue'],
+                'active_customers': len(self.customers[day]),
+                'top_city': _top_key(cities),
+                'orders_by_city': dict(cities),
+            }))
+        return rows
+
+    def get_stats(self):
+        return self.stats
+
+
+def upsert_daily_metrics(cursor, rows, data_source):
+    """
+    Upsert строк метрик в daily_business_analytics по analytics_date
+
+    Обновляются только колонки, присутствующие в строках: потоковый
+    агрегатор не затирает метрики, которые считаются только в DWH.
+
+    Returns:
+        Число записанных строк
+    """
+    if not rows:
+        return 0
+
+    columns = ['analytics_date'] + [
+        col for col in DAILY_ANALYTICS_COLUMNS if any(col in row for row in rows)
+    ] + ['data_source']
+    updates = ',\n        '.join(f"{col} = EXCLUDED.{col}" for col in columns[1:])
+
+    execute_values(cursor, f"""
+    INSERT INTO daily_business_analytics ({', '.join(columns)})
+    VALUES %s
+    ON CONFLICT (analytics_date) DO UPDATE SET
+        {updates},
+        updated_at = CURRENT_TIMESTAMP
+    """, [_to_record(dict(row, data_source=data_source), columns) for row in rows])
+    return len(rows)
+
+
+def _to_record(row, columns):
+    """Значения метрик в порядке columns; JSON-поля сериализуются для JSONB"""
+    return tuple(
+        json.dumps(row.get(col), ensure_ascii=False) if isinstance(row.get(col), dict) else row.get(col)
+        for col in columns
+    )
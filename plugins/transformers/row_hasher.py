@@ -0,0 +1,94 @@
+"""
+Row Hasher - векторизованный расчет хэша атрибутов строки
+"""
+import pandas as pd
+
+
+# Виды колонок (как parse_column_type в column_coercer), для которых
+# значение нормализуется как число или дата; остальные - как строка
+NUMERIC_KINDS = ('integer', 'numeric')
+DATE_KINDS = ('date', 'timestamp')
+
+
+def normalize_for_hash(series, kind='string'):
+    """
+    Приведение колонки к строковому виду, не зависящему от способа доставки
+    данных (Decimal из БД, float после JSON, лишние пробелы, регистр)
+
+    Способ нормализации задается объявленным видом колонки, а не содержимым
+    пакета: одно и то же значение дает одну строку в любом пакете.
+
+    Args:
+        series: Колонка
+        kind: Вид колонки ('integer', 'numeric', 'date', 'timestamp', 'boolean', 'string')
+    """
+    present = series.notna()
+
+    if kind in NUMERIC_KINDS:
+        numeric = pd.to_numeric(series, errors='coerce').astype('float64').round(6)
+        if kind == 'integer':
+            normalized = numeric.round().astype('Int64').astype(str)
+        else:
+            normalized = numeric.astype(str)
+        # Нечисловое значение в числовой колонке сравнивается как строка
+        normalized = normalized.where(numeric.notna(), series.astype(str).str.strip().str.lower())
+    elif kind in DATE_KINDS:
+        parsed = pd.to_datetime(series, errors='coerce')
+        normalized = parsed.dt.strftime('%Y-%m-%d' if kind == 'date' else '%Y-%m-%d %H:%M:%S')
+        normalized = normalized.where(parsed.notna(), series.astype(str).str.strip().str.lower())
+    else:
+        normalized = series.astype(str).str.strip().str.lower()
+
+    return normalized.where(present, '')
+
+
+def compute_row_hash(df, columns, column_kinds=None):
+    """
+    Хэш набора колонок для каждой строки DataFrame
+
+    Args:
+        df: DataFrame с данными
+        columns: Список колонок, участвующих в хэше (отсутствующие считаются пустыми)
+        column_kinds: dict {колонка: вид} (по умолчанию колонки строковые)
+
+    Returns:
+        pandas.Series int64 (помещается в колонку BIGINT)
+    """
+    if not columns:
+        return pd.Series(0, index=df.index, dtype='int64')
+
+    column_kinds = column_kinds or {}
+    frame = pd.DataFrame(
+        {col: normalize_for_hash(df[col], column_kinds.get(col, 'string')) if col in df.columns else ''
+         for col in columns},
+        index=df.index
+    )
+    hashes = pd.util.hash_pandas_object(frame, index=False)
+    return pd.Series(hashes.values.view('int64'), index=df.index)
+
+
+class RowHasher:
+    """Добавление колонки с хэшем атрибутов строки"""
+
+    def __init__(self):
+        self.stats = {
+            'rows_hashed': 0
+        }
+
+    def transform(self, data, **kwargs):
+        """
+        Расчет хэша по колонкам kwargs['columns'] в колонку kwargs['hash_column']
+        (виды колонок - kwargs['column_kinds'])
+        """
+        df = data.copy() if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+
+        columns = kwargs.get('columns') or list(df.columns)
+        hash_column = kwargs.get('hash_column', 'attr_hash')
+
+        df[hash_column] = compute_row_hash(df, columns, kwargs.get('column_kinds'))
+        self.stats['rows_hashed'] += len(df)
+
+        return df
+
+    def get_stats(self):
+        return self.stats
@@ -0,0 +1,101 @@
+# /opt/airflow/scripts/test_loaders.py
+"""
+Проверки загрузчиков и трансформеров плагинов (запуск в контейнере Airflow)
+
+    python /opt/airflow/scripts/test_loaders.py
+"""
+import os
+import sys
+import tempfile
+import traceback
+
+# Добавляем путь к плагинам
+sys.path.insert(0, '/opt/airflow/plugins')
+
+import pandas as pd
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+from extractors.csv_extractor import CSVExtractor, PRODUCT_FEED_DTYPES
+from loaders.postgres_copy_loader import PostgresCopyLoader
+from transformers.column_coercer import ColumnCoercer
+
+failures = []
+
+
+def check(name, func):
+    print(f"\nTesting {name}...")
+    try:
+        func()
+        print(f"✅ {name}")
+    except Exception as e:
+        failures.append(name)
+        print(f"❌ {name}: {e}")
+        traceback.print_exc()
+
+
+def test_merge_into_serial_key_table():
+    """Merge в таблицу с SERIAL-ключом, которого нет в загружаемых колонках"""
+    hook = PostgresHook(postgres_conn_id='postgres_dwh')
+    table = 'test_merge_serial'
+    hook.run(f"""
+        DROP TABLE IF EXISTS {table};
+        CREATE TABLE {table} (
+            row_key SERIAL PRIMARY KEY,
+            item_id INTEGER NOT NULL,
+            item_name VARCHAR(50),
+            load_date DATE DEFAULT CURRENT_DATE,
+            row_digest BIGINT
+        );
+    """)
+    try:
+        loader = PostgresCopyLoader(conn_id='postgres_dwh', table_name=table, mode='merge')
+        first = pd.DataFrame({'item_id': [1, 2, 3], 'item_name': ['a', 'b', 'c']})
+        stats = loader.load(first, key_columns=['item_id'])
+        assert stats['inserted'] == 3, stats
+
+        second = pd.DataFrame({'item_id': [2, 3, 4], 'item_name': ['b', 'C', 'd']})
+        stats = loader.load(second, key_columns=['item_id'])
+        assert (stats['inserted'], stats['updated'], stats['deleted'], stats['unchanged']) == (1, 1, 1, 1), stats
+
+        rows = hook.get_records(f"SELECT item_id, item_name FROM {table} WHERE row_key IS NOT NULL ORDER BY item_id")
+        assert rows == [(2, 'b'), (3, 'C'), (4, 'd')], rows
+    finally:
+        hook.run(f"DROP TABLE IF EXISTS {table}")
+
+
+def test_pyarrow_chunks_through_coercer():
+    """Порции движка pyarrow (Arrow-колонки с пропусками) -> ColumnCoercer"""
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+        f.write("product_id,product_name,unit_price,stock_quantity\n")
+        f.write("1,a,10.5,3\n2,,99999.99,\n,c,1.25,7\n4,d,,1\n5,e,100000,2\n")
+        path = f.name
+    try:
+        dtype = {col: PRODUCT_FEED_DTYPES[col]
+                 for col in ('product_id', 'product_name', 'unit_price', 'stock_quantity')}
+        chunks = list(CSVExtractor().extract_csv_chunks(path, chunksize=2, dtype=dtype, engine='pyarrow'))
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1], [len(chunk) for chunk in chunks]
+        assert isinstance(chunks[0]['stock_quantity'].dtype, pd.ArrowDtype), chunks[0].dtypes
+
+        coercer = ColumnCoercer()
+        column_types = {
+            'product_id': 'integer',
+            'product_name': 'character varying(50)',
+            'unit_price': 'numeric(7,2)',
+            'stock_quantity': 'integer',
+        }
+        result = pd.concat([coercer.transform(chunk, column_types=column_types, key_columns=['product_id'])
+                            for chunk in chunks])
+        # Строка без ключа и строка с unit_price вне numeric(7,2) отброшены
+        assert result['product_id'].tolist() == [1, 2, 4], result
+        assert str(result['product_id'].dtype) == 'int64', result.dtypes
+        assert result['stock_quantity'].tolist() == [3, 0, 1], result
+        assert coercer.get_stats()['rows_rejected'] == 2, coercer.get_stats()
+    finally:
+        os.unlink(path)
+
+
+check('pyarrow CSV chunks through ColumnCoercer', test_pyarrow_chunks_through_coercer)
+check('PostgresCopyLoader merge into SERIAL key table', test_merge_into_serial_key_table)
+
+print(f"\n{'❌ Ошибок: ' + str(len(failures)) if failures else '✅ Все проверки пройдены'}")
+sys.exit(1 if failures else 0)